@@ -8,26 +8,36 @@ import time
 import trio
 
 from kabomu.abstractions import DefaultQuasiHttpRequest,\
+    DefaultSendManyItem,\
     QuasiHttpProcessingOptions
 from kabomu import quasi_http_utils
 
 from shared import io_utils_extra
 
 async def start_transferring_files(
-        instance, server_endpoint, upload_dir_path):
+        instance, server_endpoint, upload_dir_path, concurrency=None):
     count = 0
+    error_count = 0
     bytes_transferred = 0
     start_time = time.perf_counter()
 
-    with os.scandir(upload_dir_path) as dir_scanner:
-        for entry in dir_scanner:
-            if not entry.is_file():
-                continue
-            sz = entry.stat().st_size
-            await transfer_file(instance, server_endpoint, entry.path,
-                                sz)
-            bytes_transferred += sz
-            count += 1
+    async with instance.send_many(
+            _generate_transfers(server_endpoint, upload_dir_path),
+            concurrency=concurrency) as results:
+        async for result in results:
+            transfer = result.item
+            try:
+                await check_transfer_result(transfer, result)
+                bytes_transferred += transfer.f_size
+                count += 1
+            except:
+                logging.warning(f"File {transfer.f} sent with error: {sys.exc_info()[1]}")
+                error_count += 1
+            finally:
+                if result.response:
+                    await result.response.release()
+                if transfer.file_stream:
+                    await transfer.file_stream.aclose()
 
     time_taken = time.perf_counter() - start_time
     mega_bytes_transferred = bytes_transferred / (1024.0 * 1024.0)
@@ -36,8 +46,19 @@ async def start_transferring_files(
         " in {3} seconds = {4} MB/s"
     logging.info(t.format(bytes_transferred, round(mega_bytes_transferred, 2),
                     count, round(time_taken, 2), rate))
+    if error_count:
+        raise Exception(f"{error_count} file(s) could not be transferred")
 
-async def transfer_file(instance, server_endpoint, f, f_size):
+async def _generate_transfers(server_endpoint, upload_dir_path):
+    # files are only opened as send_many() gets room for them.
+    with os.scandir(upload_dir_path) as dir_scanner:
+        for entry in dir_scanner:
+            if not entry.is_file():
+                continue
+            yield await create_transfer(server_endpoint, entry.path,
+                                        entry.stat().st_size)
+
+async def create_transfer(server_endpoint, f, f_size):
     request = DefaultQuasiHttpRequest()
 
     f_name = os.path.basename(f)
@@ -51,54 +72,60 @@ async def transfer_file(instance, server_endpoint, f, f_size):
         request.headers["echo-body"] = [
             f_path_encoded
         ]
-    
+
+    request.content_length = -1
+    if random.randint(0, 1):
+        request.content_length = f_size
+
+    # determine options
+    send_options = None
+    if random.randint(0, 1):
+        send_options = QuasiHttpProcessingOptions(
+            max_response_body_size = -1
+        )
+
+    transfer = DefaultSendManyItem(remote_endpoint=server_endpoint,
+                                   options=send_options)
+    transfer.f = f
+    transfer.f_size = f_size
+    transfer.echo_body_on = echo_body_on
+    transfer.file_stream = None
+
     # add body
-    async with await trio.open_file(f, 'rb', buffering=0) as file_stream:
-        request.body = file_stream
-        request.content_length = -1
-        if random.randint(0, 1):
-            request.content_length = f_size
-        
-        # determine options
-        send_options = None
-        if random.randint(0, 1):
-            send_options = QuasiHttpProcessingOptions(
-                max_response_body_size = -1
-            )
-        
-        res = None
-        try:
-            if random.randint(0, 1):
-                res = await instance.send(server_endpoint, request,
-                                        send_options)
-            else:
-                async def request_generator(ignored_env):
-                    return request
-                res = await instance.send2(server_endpoint, request_generator,
-                                        send_options)
-                if res.status_code == quasi_http_utils.STATUS_CODE_OK:
-                    if echo_body_on:
-                        actual_res_body = await io_utils_extra.read_all_bytes(
-                            res.body
-                        )
-                        actual_res_body = base64.b64decode(
-                            actual_res_body).decode()
-                        if actual_res_body != f:
-                            raise Exception("expected echo body to be " +
-                                f"{f} but got {actual_res_body}")
-                    logging.info(f"File {f} sent successfully")
-                else:
-                    response_msg = ""
-                    if res.body:
-                        try:
-                            response_msg = await io_utils_extra.read_string_tobyes(res.body)
-                        except:
-                            pass # ignore.
-                    raise Exception(f"status code indicates error: {res.status_code}\n{response_msg}")
-        except:
-            logging.warning(f"File {f} sent with error: {sys.exc_info()[1]}")
-            raise
-        finally:
-            if res:
-                await res.release()         
+    async def open_body():
+        transfer.file_stream = await trio.open_file(f, 'rb', buffering=0)
+        request.body = transfer.file_stream
+    if random.randint(0, 1):
+        await open_body()
+        transfer.request = request
+    else:
+        async def request_generator(ignored_env):
+            await open_body()
+            return request
+        transfer.request_func = request_generator
+    return transfer
 
+async def check_transfer_result(transfer, result):
+    if result.error:
+        raise result.error
+    res = result.response
+    f = transfer.f
+    if res.status_code == quasi_http_utils.STATUS_CODE_OK:
+        if transfer.echo_body_on:
+            actual_res_body = await quasi_http_utils.read_body_fully(
+                res
+            )
+            actual_res_body = base64.b64decode(
+                actual_res_body).decode()
+            if actual_res_body != f:
+                raise Exception("expected echo body to be " +
+                    f"{f} but got {actual_res_body}")
+        logging.info(f"File {f} sent successfully")
+    else:
+        response_msg = ""
+        if res.body:
+            try:
+                response_msg = await io_utils_extra.read_string_tobyes(res.body)
+            except:
+                pass # ignore.
+        raise Exception(f"status code indicates error: {res.status_code}\n{response_msg}")
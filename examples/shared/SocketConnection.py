@@ -19,9 +19,11 @@ class SocketConnection(IQuasiHttpConnection):
         self.timeout_scope = None
         self.cancel_scope = None
 
+    @property
     def environment(self):
         return None
     
+    @property
     def processing_options(self):
         return self._processing_options
     
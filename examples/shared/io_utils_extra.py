@@ -45,10 +45,4 @@ async def read_as_string(stream: ReceiveStream):
     return raw_data.decode()
 
 async def read_all_bytes(stream: ReceiveStream):
-    raw_data = bytearray()
-    while True:
-        next_chunk = await io_utils_internal.receive_some(stream)
-        if not next_chunk:
-            break
-        raw_data.extend(next_chunk)
-    return raw_data
+    return await io_utils_internal.read_all_bytes(stream)
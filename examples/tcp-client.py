@@ -3,6 +3,8 @@ import configparser
 import trio
 
 from kabomu.StandardQuasiHttpClient import StandardQuasiHttpClient
+from kabomu.PooledQuasiHttpClientTransport import\
+    PooledQuasiHttpClientTransport
 from kabomu.abstractions import QuasiHttpProcessingOptions
 
 from shared import AppLogger
@@ -16,9 +18,11 @@ async def main():
     default_section = config["DEFAULT"]
     server_port = int(default_section.get('SERVER_PORT', 5001))
     upload_dir_path = default_section.get("UPLOAD_DIR", "logs/client")
-    transport = LocalhostTcpClientTransport(
-        default_send_options=QuasiHttpProcessingOptions(
-            timeout_millis=5_000
+    transport = PooledQuasiHttpClientTransport(
+        LocalhostTcpClientTransport(
+            default_send_options=QuasiHttpProcessingOptions(
+                timeout_millis=5_000
+            )
         )
     )
     instance = StandardQuasiHttpClient(transport=transport)
@@ -31,5 +35,7 @@ async def main():
     except BaseException as ex:
         print(f"Fatal error encountered: {ex}")
         raise
+    finally:
+        await transport.close_idle_connections()
 
 trio.run(main)
\ No newline at end of file
@@ -24,7 +24,8 @@ async def main():
         port=port,
         quasi_http_server=instance,
         default_processing_options=QuasiHttpProcessingOptions(
-            timeout_millis=5_000
+            timeout_millis=5_000,
+            keep_alive_enabled=True
         )
     )
     instance.transport = transport
@@ -0,0 +1,276 @@
+import random
+from types import SimpleNamespace
+
+import trio
+
+from kabomu.quasi_http_utils import _get_optional_attr, _bind_method
+from kabomu.errors import MissingDependencyError,\
+    QuasiHttpError,\
+    QUASI_HTTP_ERROR_REASON_GENERAL,\
+    QUASI_HTTP_ERROR_REASON_TIMEOUT
+
+STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+STRATEGY_POWER_OF_TWO_CHOICES = "p2c"
+
+DEFAULT_EWMA_ALPHA = 0.2
+
+# Number of failures in a row after which an endpoint is ejected.
+DEFAULT_EJECTION_FAILURE_THRESHOLD = 3
+
+# Duration of first ejection of an endpoint, which is multiplied by
+# the number of times it has been ejected in a row for later ejections.
+DEFAULT_BASE_EJECTION_TIME_MILLIS = 10_000
+
+DEFAULT_MAX_EJECTION_TIME_MILLIS = 300_000
+
+# Upper bound on ratio of endpoints which can be ejected at once, so
+# that widespread failures don't leave too few endpoints to carry load.
+DEFAULT_MAX_EJECTED_RATIO = 0.5
+
+DEFAULT_SLOW_START_MILLIS = 10_000
+
+# Weight of endpoints at start of slow start.
+MIN_SLOW_START_WEIGHT = 0.1
+
+_EJECTING_REASON_CODES = (QUASI_HTTP_ERROR_REASON_GENERAL,
+                          QUASI_HTTP_ERROR_REASON_TIMEOUT)
+
+class _EndpointState:
+    __slots__ = ("endpoint", "outstanding", "ewma_latency_millis",
+                 "consecutive_failures", "failures", "ejection_count",
+                 "ejected_until", "slow_start_since")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.outstanding = 0
+        self.ewma_latency_millis = None
+        self.consecutive_failures = 0
+        self.failures = 0
+        # number of ejections since last success.
+        self.ejection_count = 0
+        self.ejected_until = None
+        self.slow_start_since = None
+
+class BalancingQuasiHttpClient:
+    # wraps a client (e.g. StandardQuasiHttpClient), and spreads
+    # requests across endpoints which serve the same thing.
+    # requests sent to a remote endpoint of None get an endpoint picked
+    # for them, either the one with least outstanding requests, or the
+    # less loaded of two picked at random, where load takes latency
+    # into account (p2c strategy). other remote endpoints are used
+    # as they are.
+    # a request is outstanding until its response is received, or
+    # until response is released if it has a body.
+    # endpoints whose requests fail with general or timeout errors a
+    # number of times in a row get ejected for a while, and after
+    # ejection they get a growing share of requests during slow start.
+
+    def __init__(self, client=None, endpoints=None,
+                 strategy=None,
+                 ewma_alpha=None,
+                 ejection_failure_threshold=None,
+                 base_ejection_time_millis=None,
+                 max_ejection_time_millis=None,
+                 max_ejected_ratio=None,
+                 slow_start_millis=None):
+        self.client = client
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.ejection_failure_threshold = ejection_failure_threshold
+        self.base_ejection_time_millis = base_ejection_time_millis
+        self.max_ejection_time_millis = max_ejection_time_millis
+        self.max_ejected_ratio = max_ejected_ratio
+        self.slow_start_millis = slow_start_millis
+        self._states = {}
+        self._next_index = 0
+        if endpoints:
+            for endpoint in endpoints:
+                self.add_endpoint(endpoint)
+
+    @property
+    def endpoints(self):
+        return list(self._states)
+
+    def add_endpoint(self, endpoint):
+        if endpoint not in self._states:
+            self._states[endpoint] = _EndpointState(endpoint)
+
+    def remove_endpoint(self, endpoint):
+        self._states.pop(endpoint, None)
+
+    def get_endpoint_stats(self, endpoint):
+        state = self._states.get(endpoint)
+        if state is None:
+            return None
+        now = trio.current_time()
+        return SimpleNamespace(outstanding=state.outstanding,
+            ewma_latency_millis=state.ewma_latency_millis,
+            failures=state.failures,
+            ejected=self._is_ejected(state, now),
+            weight=self._get_weight(state, now))
+
+    async def send(self, remote_endpoint, request, options=None):
+        if not request:
+            raise ValueError("request argument is null")
+        async def send(client, endpoint):
+            return await client.send(endpoint, request, options)
+        return await self._send_internal(remote_endpoint, send)
+
+    async def send2(self, remote_endpoint, request_func, options=None):
+        if not request_func:
+            raise ValueError("request_func argument is null")
+        async def send(client, endpoint):
+            return await client.send2(endpoint, request_func, options)
+        return await self._send_internal(remote_endpoint, send)
+
+    async def _send_internal(self, remote_endpoint, send):
+        client = self.client
+        if not client:
+            raise MissingDependencyError("client")
+        if remote_endpoint is None:
+            state = self._pick()
+            remote_endpoint = state.endpoint
+        else:
+            state = self._states.get(remote_endpoint)
+        if state is None:
+            return await send(client, remote_endpoint)
+
+        state.outstanding += 1
+        start_time = trio.current_time()
+        try:
+            response = await send(client, remote_endpoint)
+        except QuasiHttpError as ex:
+            state.outstanding -= 1
+            if ex.reason_code in _EJECTING_REASON_CODES:
+                self._on_failure(state)
+            raise
+        except BaseException:
+            state.outstanding -= 1
+            raise
+        self._on_success(state, (trio.current_time() - start_time) * 1000)
+        if _get_optional_attr(response, "body"):
+            _end_outstanding_on_release(response, state)
+        else:
+            state.outstanding -= 1
+        return response
+
+    def _pick(self):
+        states = self._states
+        if not states:
+            raise MissingDependencyError("endpoints")
+        now = trio.current_time()
+        candidates = [s for s in states.values()
+                      if not self._is_ejected(s, now)]
+        if not candidates:
+            # better to try ejected endpoints than fail outright.
+            candidates = list(states.values())
+        strategy = self.strategy
+        if strategy == STRATEGY_POWER_OF_TWO_CHOICES:
+            if len(candidates) == 1:
+                return candidates[0]
+            a, b = random.sample(candidates, 2)
+            if self._get_latency_load(b, now) < \
+                    self._get_latency_load(a, now):
+                return b
+            return a
+        # start from a rotating position, so that ties are spread
+        # across endpoints.
+        start = self._next_index % len(candidates)
+        self._next_index = start + 1
+        best = None
+        best_load = None
+        for i in range(len(candidates)):
+            state = candidates[(start + i) % len(candidates)]
+            load = (state.outstanding + 1) / self._get_weight(state, now)
+            if best is None or load < best_load:
+                best = state
+                best_load = load
+        return best
+
+    def _get_latency_load(self, state, now):
+        latency = state.ewma_latency_millis
+        if latency is None:
+            # unknown latency, so favour endpoint to learn it.
+            latency = 0
+        return (latency + 1) * (state.outstanding + 1) / \
+            self._get_weight(state, now)
+
+    def _get_weight(self, state, now):
+        slow_start_since = state.slow_start_since
+        if slow_start_since is None:
+            return 1.0
+        slow_start_millis = self.slow_start_millis
+        if slow_start_millis is None or slow_start_millis < 0:
+            slow_start_millis = DEFAULT_SLOW_START_MILLIS
+        elapsed_millis = (now - slow_start_since) * 1000
+        if elapsed_millis >= slow_start_millis:
+            state.slow_start_since = None
+            return 1.0
+        return max(elapsed_millis / slow_start_millis,
+                   MIN_SLOW_START_WEIGHT)
+
+    def _is_ejected(self, state, now):
+        ejected_until = state.ejected_until
+        if ejected_until is None:
+            return False
+        if now < ejected_until:
+            return True
+        # reintroduce endpoint.
+        state.ejected_until = None
+        state.slow_start_since = now
+        return False
+
+    def _on_success(self, state, latency_millis):
+        state.consecutive_failures = 0
+        state.ejection_count = 0
+        ewma_latency_millis = state.ewma_latency_millis
+        if ewma_latency_millis is None:
+            state.ewma_latency_millis = latency_millis
+        else:
+            alpha = self.ewma_alpha
+            if not alpha or alpha <= 0 or alpha > 1:
+                alpha = DEFAULT_EWMA_ALPHA
+            state.ewma_latency_millis = ewma_latency_millis + \
+                alpha * (latency_millis - ewma_latency_millis)
+
+    def _on_failure(self, state):
+        state.failures += 1
+        state.consecutive_failures += 1
+        threshold = self.ejection_failure_threshold
+        if not threshold or threshold <= 0:
+            threshold = DEFAULT_EJECTION_FAILURE_THRESHOLD
+        if state.consecutive_failures < threshold:
+            return
+        now = trio.current_time()
+        if self._is_ejected(state, now):
+            return
+        max_ejected_ratio = self.max_ejected_ratio
+        if max_ejected_ratio is None or max_ejected_ratio < 0:
+            max_ejected_ratio = DEFAULT_MAX_EJECTED_RATIO
+        ejected_count = sum(1 for s in self._states.values()
+                            if self._is_ejected(s, now))
+        if ejected_count + 1 > max_ejected_ratio * len(self._states):
+            return
+        base_ejection_time_millis = self.base_ejection_time_millis
+        if not base_ejection_time_millis or base_ejection_time_millis < 0:
+            base_ejection_time_millis = DEFAULT_BASE_EJECTION_TIME_MILLIS
+        max_ejection_time_millis = self.max_ejection_time_millis
+        if not max_ejection_time_millis or max_ejection_time_millis < 0:
+            max_ejection_time_millis = DEFAULT_MAX_EJECTION_TIME_MILLIS
+        state.ejection_count += 1
+        ejection_time_millis = min(
+            base_ejection_time_millis * state.ejection_count,
+            max_ejection_time_millis)
+        state.ejected_until = now + ejection_time_millis / 1000.0
+        state.consecutive_failures = 0
+        state.slow_start_since = None
+
+def _end_outstanding_on_release(response, state):
+    release = response.release
+    pending = [state]
+    async def release_func(self):
+        # count release at most once.
+        if pending:
+            pending.pop().outstanding -= 1
+        await release()
+    response.release = _bind_method(release_func, response)
@@ -0,0 +1,276 @@
+import copy
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import trio
+
+from kabomu.quasi_http_utils import _get_optional_attr
+from kabomu import io_utils_internal, protocol_utils_internal,\
+    quasi_http_utils
+from kabomu.errors import MissingDependencyError
+
+DEFAULT_MAX_CACHE_SIZE = 4_194_304
+
+DEFAULT_MAX_CACHED_BODY_SIZE = 65_536
+
+# Rough number of bytes charged per entry on top of its body, to account
+# for headers and bookkeeping.
+ENTRY_OVERHEAD_SIZE = 512
+
+_CACHEABLE_METHODS = (quasi_http_utils.METHOD_GET,
+                      quasi_http_utils.METHOD_HEAD)
+
+# Status codes of responses which can be cached by default.
+_CACHEABLE_STATUS_CODES = (200, 203, 204, 300, 301, 404, 410)
+
+class _CacheEntry:
+    __slots__ = ("snapshot", "size", "expires_at", "etag",
+                 "last_modified")
+
+    def __init__(self, response, body, now):
+        self.snapshot = protocol_utils_internal.create_response_snapshot(
+            response, body)
+        self.size = len(body) + ENTRY_OVERHEAD_SIZE
+        self.expires_at = now
+        self.etag = None
+        self.last_modified = None
+        self._update(self.snapshot.headers, now)
+
+    def _update(self, headers, now):
+        # applies headers of a response which stored response
+        # or revalidated it.
+        directives = _parse_cache_control(headers)
+        max_age = _parse_max_age(directives)
+        if "no-cache" in directives or max_age is None:
+            self.expires_at = now
+        else:
+            self.expires_at = now + max_age
+        etag = _get_header(headers, quasi_http_utils.HEADER_NAME_ETAG)
+        if etag is not None:
+            self.etag = etag
+        last_modified = _get_header(headers,
+            quasi_http_utils.HEADER_NAME_LAST_MODIFIED)
+        if last_modified is not None:
+            self.last_modified = last_modified
+
+class CachingQuasiHttpClient:
+    # wraps a client (e.g. StandardQuasiHttpClient), and keeps fully
+    # read bodies of small responses to GET and HEAD requests in memory,
+    # to answer repeated requests for the same target of the same
+    # endpoint without going over the network.
+    # entries are keyed on remote endpoint, method, target, and values
+    # of vary_header_names in request headers, and are evicted in least
+    # recently used order once their total size exceeds max_cache_size.
+    # responses are only stored if cache-control header permits it, and
+    # are only served without revalidation while their max-age lasts.
+    # stale entries with etag or last-modified headers are
+    # revalidated with a conditional request.
+    # send2() always goes to wrapped client, since its request
+    # isn't known in advance.
+
+    def __init__(self, client=None,
+                 max_cache_size=None,
+                 max_cached_body_size=None,
+                 vary_header_names=None):
+        self.client = client
+        self.max_cache_size = max_cache_size
+        self.max_cached_body_size = max_cached_body_size
+        self.vary_header_names = vary_header_names
+        self.stats = SimpleNamespace(hits=0, misses=0, revalidated=0,
+                                     evictions=0)
+        self._entries = OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def entry_count(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    async def send(self, remote_endpoint, request, options=None):
+        client = self.client
+        if not client:
+            raise MissingDependencyError("client")
+        if not request:
+            raise ValueError("request argument is null")
+        key = self._get_key(remote_endpoint, request)
+        if key is None:
+            return await client.send(remote_endpoint, request, options)
+        request_directives = _parse_cache_control(
+            _get_optional_attr(request, "headers"))
+        if "no-store" in request_directives:
+            return await client.send(remote_endpoint, request, options)
+
+        entry = self._entries.get(key)
+        now = trio.current_time()
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if now < entry.expires_at and \
+                    "no-cache" not in request_directives:
+                self.stats.hits += 1
+                return entry.snapshot.create_response()
+            if entry.etag is not None or entry.last_modified is not None:
+                request = _create_conditional_request(request, entry)
+        self.stats.misses += 1
+        response = await client.send(remote_endpoint, request, options)
+        now = trio.current_time()
+        if entry is not None and _get_optional_attr(response,
+                "status_code") == quasi_http_utils.STATUS_CODE_NOT_MODIFIED:
+            await response.release()
+            self.stats.revalidated += 1
+            entry._update(_get_optional_attr(response, "headers") or {},
+                          now)
+            return entry.snapshot.create_response()
+        return await self._store(key, response, now)
+
+    async def send2(self, remote_endpoint, request_func, options=None):
+        client = self.client
+        if not client:
+            raise MissingDependencyError("client")
+        return await client.send2(remote_endpoint, request_func, options)
+
+    def _get_key(self, remote_endpoint, request):
+        # returns None for requests which can't be cached.
+        method = _get_optional_attr(request, "http_method")
+        if not method or method.upper() not in _CACHEABLE_METHODS:
+            return None
+        if _get_optional_attr(request, "body"):
+            return None
+        vary_values = ()
+        vary_header_names = self.vary_header_names
+        if vary_header_names:
+            headers = _get_optional_attr(request, "headers")
+            vary_values = tuple(_get_header_values(headers, n)
+                                for n in vary_header_names)
+        key = (remote_endpoint, method.upper(),
+               _get_optional_attr(request, "target"), vary_values)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    async def _store(self, key, response, now):
+        # replaces entry for key with response if it can be cached,
+        # and returns response to give to caller.
+        self._remove(key)
+        if _get_optional_attr(response, "status_code") not in \
+                _CACHEABLE_STATUS_CODES:
+            return response
+        directives = _parse_cache_control(
+            _get_optional_attr(response, "headers"))
+        if "no-store" in directives:
+            return response
+        headers = _get_optional_attr(response, "headers")
+        if _parse_max_age(directives) is None and \
+                not _get_header(headers,
+                    quasi_http_utils.HEADER_NAME_ETAG) and \
+                not _get_header(headers,
+                    quasi_http_utils.HEADER_NAME_LAST_MODIFIED):
+            # neither fresh nor revalidatable.
+            return response
+        max_cached_body_size = self.max_cached_body_size
+        if not max_cached_body_size or max_cached_body_size < 0:
+            max_cached_body_size = DEFAULT_MAX_CACHED_BODY_SIZE
+        body = _get_optional_attr(response, "body")
+        content_length = _get_optional_attr(response, "content_length")
+        if not body:
+            data = b""
+        elif content_length and content_length > max_cached_body_size:
+            return response
+        else:
+            try:
+                data = await io_utils_internal.read_up_to(body,
+                    max_cached_body_size + 1)
+            except:
+                await response.release()
+                raise
+            if len(data) > max_cached_body_size:
+                # too large after all, so hand over what was read
+                # together with the rest.
+                response.body = io_utils_internal.create_bytes_readable_stream(
+                    data, body)
+                return response
+            await response.release()
+        entry = _CacheEntry(response, data, now)
+        self._add(key, entry)
+        return entry.snapshot.create_response()
+
+    def _add(self, key, entry):
+        max_cache_size = self.max_cache_size
+        if not max_cache_size or max_cache_size < 0:
+            max_cache_size = DEFAULT_MAX_CACHE_SIZE
+        if entry.size > max_cache_size:
+            return
+        entries = self._entries
+        entries[key] = entry
+        self._size += entry.size
+        while self._size > max_cache_size:
+            _, evicted = entries.popitem(last=False)
+            self._size -= evicted.size
+            self.stats.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+def _create_conditional_request(request, entry):
+    headers = dict(_get_optional_attr(request, "headers") or {})
+    if entry.etag is not None:
+        headers[quasi_http_utils.HEADER_NAME_IF_NONE_MATCH] = [entry.etag]
+    if entry.last_modified is not None:
+        headers[quasi_http_utils.HEADER_NAME_IF_MODIFIED_SINCE] = [
+            entry.last_modified]
+    # leave request of caller untouched.
+    conditional_request = copy.copy(request)
+    conditional_request.headers = headers
+    return conditional_request
+
+def _get_header_values(headers, name):
+    if not headers:
+        return ()
+    values = headers.get(name)
+    if values is None:
+        # request headers needn't be lower-cased.
+        name = name.lower()
+        for k, v in headers.items():
+            if k.lower() == name:
+                values = v
+                break
+    if values is None:
+        return ()
+    if isinstance(values, str):
+        return (values,)
+    return tuple(values)
+
+def _get_header(headers, name):
+    values = _get_header_values(headers, name)
+    return values[0] if values else None
+
+def _parse_cache_control(headers):
+    directives = {}
+    for value in _get_header_values(headers,
+            quasi_http_utils.HEADER_NAME_CACHE_CONTROL):
+        for directive in value.split(","):
+            name, _, argument = directive.strip().partition("=")
+            if name:
+                directives[name.lower()] = argument.strip().strip('"')
+    return directives
+
+def _parse_max_age(directives):
+    # returns None if max-age is absent or invalid.
+    max_age = directives.get("max-age")
+    if max_age is None:
+        return None
+    try:
+        max_age = int(max_age)
+    except ValueError:
+        return None
+    return max(max_age, 0)
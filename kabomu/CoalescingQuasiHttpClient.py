@@ -0,0 +1,153 @@
+from types import SimpleNamespace
+
+import trio
+
+from kabomu.quasi_http_utils import _get_optional_attr
+from kabomu import io_utils_internal, protocol_utils_internal,\
+    quasi_http_utils
+from kabomu.errors import MissingDependencyError,\
+    QuasiHttpError,\
+    QUASI_HTTP_ERROR_REASON_GENERAL
+
+DEFAULT_MAX_BUFFERED_BODY_SIZE = 1_048_576
+
+_COALESCABLE_METHODS = (quasi_http_utils.METHOD_GET,
+                        quasi_http_utils.METHOD_HEAD)
+
+class _Flight:
+    __slots__ = ("done", "snapshot", "error")
+
+    def __init__(self):
+        self.done = trio.Event()
+        # response with body buffered in memory, which can be handed
+        # out any number of times.
+        self.snapshot = None
+        self.error = None
+
+class CoalescingQuasiHttpClient:
+    # wraps a client (e.g. StandardQuasiHttpClient), and lets identical
+    # requests which are sent while one of them is in flight share the
+    # exchange of that one, instead of each going over the network.
+    # response body of shared exchange is read into memory, and every
+    # sender gets its own response with its own stream over it.
+    # key_func is called with remote endpoint, request and send options
+    # of requests to get the keys with which identical requests are
+    # detected, and None means request can't be shared. by default,
+    # bodiless GET and HEAD requests are keyed on remote endpoint,
+    # method, target, headers and values of send options.
+    # if response body exceeds max_buffered_body_size, first sender gets
+    # it as it is, and the rest send their own requests.
+    # if shared exchange fails, the rest get the error if share_errors
+    # is set, and send their own requests otherwise.
+
+    def __init__(self, client=None, key_func=None,
+                 max_buffered_body_size=None,
+                 share_errors=False):
+        self.client = client
+        self.key_func = key_func
+        self.max_buffered_body_size = max_buffered_body_size
+        self.share_errors = share_errors
+        self.stats = SimpleNamespace(exchanges=0, coalesced=0,
+                                     fallbacks=0)
+        self._flights = {}
+
+    async def send(self, remote_endpoint, request, options=None):
+        client = self.client
+        if not client:
+            raise MissingDependencyError("client")
+        if not request:
+            raise ValueError("request argument is null")
+        key_func = self.key_func
+        if key_func:
+            key = key_func(remote_endpoint, request, options)
+        else:
+            key = _get_default_key(remote_endpoint, request, options)
+        if key is None:
+            return await client.send(remote_endpoint, request, options)
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.stats.coalesced += 1
+            await flight.done.wait()
+            if flight.snapshot is not None:
+                return flight.snapshot.create_response()
+            if flight.error is not None and self.share_errors:
+                error = QuasiHttpError(QUASI_HTTP_ERROR_REASON_GENERAL,
+                    "coalesced request failed")
+                error.__cause__ = flight.error
+                raise error
+            self.stats.fallbacks += 1
+            return await client.send(remote_endpoint, request, options)
+
+        flight = _Flight()
+        self._flights[key] = flight
+        self.stats.exchanges += 1
+        try:
+            response = await client.send(remote_endpoint, request, options)
+            return await self._buffer(flight, response)
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done.set()
+
+    async def send2(self, remote_endpoint, request_func, options=None):
+        # requests of request_func aren't known in advance, and so
+        # can't be coalesced.
+        client = self.client
+        if not client:
+            raise MissingDependencyError("client")
+        return await client.send2(remote_endpoint, request_func, options)
+
+    async def _buffer(self, flight, response):
+        # sets snapshot of flight if response body fits into memory,
+        # and returns response to give to first sender.
+        max_buffered_body_size = self.max_buffered_body_size
+        if not max_buffered_body_size or max_buffered_body_size < 0:
+            max_buffered_body_size = DEFAULT_MAX_BUFFERED_BODY_SIZE
+        body = _get_optional_attr(response, "body")
+        data = b""
+        if body:
+            content_length = _get_optional_attr(response, "content_length")
+            if content_length and content_length > max_buffered_body_size:
+                return response
+            try:
+                data = await io_utils_internal.read_up_to(body,
+                    max_buffered_body_size + 1)
+            except:
+                await response.release()
+                raise
+            if len(data) > max_buffered_body_size:
+                response.body = io_utils_internal.create_bytes_readable_stream(
+                    data, body)
+                return response
+        await response.release()
+        flight.snapshot = protocol_utils_internal.create_response_snapshot(
+            response, data)
+        return flight.snapshot.create_response()
+
+def _get_default_key(remote_endpoint, request, options):
+    method = _get_optional_attr(request, "http_method")
+    if not method or method.upper() not in _COALESCABLE_METHODS:
+        return None
+    if _get_optional_attr(request, "body"):
+        return None
+    # requests which can't share connections can't share
+    # exchanges either.
+    connection_key = protocol_utils_internal.get_connection_key(
+        remote_endpoint, options)
+    if connection_key is None:
+        return None
+    headers = _get_optional_attr(request, "headers") or {}
+    try:
+        header_items = tuple(sorted((k.lower(),
+            (v,) if isinstance(v, str) else tuple(v))
+            for k, v in headers.items()))
+        key = (connection_key, method.upper(),
+               _get_optional_attr(request, "target"), header_items)
+        hash(key)
+    except TypeError:
+        return None
+    return key
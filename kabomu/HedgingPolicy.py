@@ -0,0 +1,127 @@
+import math
+from collections import deque
+from types import SimpleNamespace
+
+DEFAULT_HEDGE_PERCENTILE = 95
+
+# Delay used until enough latencies have been observed for
+# percentile to be meaningful.
+DEFAULT_INITIAL_DELAY_MILLIS = 100
+
+DEFAULT_MIN_DELAY_MILLIS = 1
+
+# Upper bound on ratio of requests which get hedged, so that hedging
+# can't double load on servers which are slow across the board.
+DEFAULT_MAX_HEDGE_RATIO = 0.1
+
+DEFAULT_SAMPLE_SIZE = 1_000
+
+MIN_SAMPLE_COUNT = 20
+
+# Number of latencies to observe before recomputing percentile.
+REFRESH_INTERVAL = 16
+
+class HedgingPolicy:
+    # decides when StandardQuasiHttpClient should send a duplicate of
+    # an idempotent request whose response headers are late, and
+    # where to send it.
+    # delay is the given percentile of the most recent response
+    # latencies, so that only requests in the tail get hedged.
+    # hedge_endpoint_func, if set, is called with the remote endpoint
+    # of a request to get the endpoint to send its duplicate to;
+    # by default duplicate goes to the same endpoint, and so onto
+    # a different connection.
+
+    def __init__(self, percentile=None,
+                 initial_delay_millis=None,
+                 min_delay_millis=None,
+                 max_delay_millis=None,
+                 max_hedge_ratio=None,
+                 sample_size=None,
+                 hedge_endpoint_func=None):
+        self.percentile = percentile
+        self.initial_delay_millis = initial_delay_millis
+        self.min_delay_millis = min_delay_millis
+        self.max_delay_millis = max_delay_millis
+        self.max_hedge_ratio = max_hedge_ratio
+        self.hedge_endpoint_func = hedge_endpoint_func
+        self.stats = SimpleNamespace(requests=0, hedged=0, hedge_wins=0)
+        if not sample_size or sample_size <= 0:
+            sample_size = DEFAULT_SAMPLE_SIZE
+        self._latencies = deque(maxlen=sample_size)
+        self._delay_millis = None
+        self._delay_from_samples = False
+        self._unused_sample_count = 0
+
+    @property
+    def hedge_rate(self):
+        stats = self.stats
+        return stats.hedged / stats.requests if stats.requests else 0.0
+
+    @property
+    def hedge_win_rate(self):
+        stats = self.stats
+        return stats.hedge_wins / stats.hedged if stats.hedged else 0.0
+
+    def get_delay_millis(self):
+        delay_millis = self._delay_millis
+        if delay_millis is None:
+            delay_millis = self._compute_delay_millis()
+            self._delay_millis = delay_millis
+        return delay_millis
+
+    def get_hedge_endpoint(self, remote_endpoint):
+        hedge_endpoint_func = self.hedge_endpoint_func
+        if hedge_endpoint_func:
+            return hedge_endpoint_func(remote_endpoint)
+        return remote_endpoint
+
+    def _compute_delay_millis(self):
+        latencies = self._latencies
+        self._delay_from_samples = len(latencies) >= MIN_SAMPLE_COUNT
+        if not self._delay_from_samples:
+            delay_millis = self.initial_delay_millis
+            if not delay_millis or delay_millis <= 0:
+                delay_millis = DEFAULT_INITIAL_DELAY_MILLIS
+        else:
+            percentile = self.percentile
+            if not percentile or percentile <= 0 or percentile > 100:
+                percentile = DEFAULT_HEDGE_PERCENTILE
+            ordered = sorted(latencies)
+            index = math.ceil(percentile / 100 * len(ordered)) - 1
+            delay_millis = ordered[max(index, 0)]
+        min_delay_millis = self.min_delay_millis
+        if not min_delay_millis or min_delay_millis <= 0:
+            min_delay_millis = DEFAULT_MIN_DELAY_MILLIS
+        delay_millis = max(delay_millis, min_delay_millis)
+        max_delay_millis = self.max_delay_millis
+        if max_delay_millis and max_delay_millis > 0:
+            delay_millis = min(delay_millis, max_delay_millis)
+        return delay_millis
+
+    def _on_request(self):
+        self.stats.requests += 1
+
+    def _try_hedge(self):
+        max_hedge_ratio = self.max_hedge_ratio
+        if max_hedge_ratio is None or max_hedge_ratio < 0:
+            max_hedge_ratio = DEFAULT_MAX_HEDGE_RATIO
+        stats = self.stats
+        if stats.hedged + 1 > max_hedge_ratio * stats.requests:
+            return False
+        stats.hedged += 1
+        return True
+
+    def _on_response(self, latency_millis, hedge_won):
+        latencies = self._latencies
+        latencies.append(latency_millis)
+        # percentile is recomputed lazily, and not after every
+        # response, since that requires sorting.
+        self._unused_sample_count += 1
+        if self._unused_sample_count >= REFRESH_INTERVAL or \
+                (not self._delay_from_samples and
+                    len(latencies) >= MIN_SAMPLE_COUNT):
+            self._delay_millis = None
+            self._unused_sample_count = 0
+        if hedge_won:
+            self.stats.hedge_wins += 1
@@ -0,0 +1,429 @@
+from collections import deque
+
+import trio
+
+from kabomu.abstractions import DefaultTimeoutResult
+from kabomu.quasi_http_utils import _get_optional_attr
+from kabomu import io_utils_internal, misc_utils_internal
+from kabomu.tlv import tlv_utils
+from kabomu.errors import KabomuIOError
+
+# Number of bytes each side may send on a stream before it has to
+# wait for window updates. Receivers can allow more by sending
+# window updates as soon as streams are opened.
+INITIAL_WINDOW_SIZE = 65_536
+
+DEFAULT_RECEIVE_WINDOW_SIZE = 262_144
+
+DEFAULT_MAX_FRAME_SIZE = 16_384
+
+DEFAULT_MAX_CONCURRENT_STREAMS = 100
+
+class MultiplexedStream:
+    # one of many concurrent byte streams carried over a single
+    # connection, with its own flow control window.
+    __slots__ = ("stream_id", "_connection", "_chunks", "_chunk_offset",
+                 "_readable", "_receive_window", "_unacknowledged_count",
+                 "_send_window", "_send_window_changed",
+                 "local_closed", "remote_closed", "_reset_by_peer",
+                 "_error")
+
+    def __init__(self, connection, stream_id):
+        self.stream_id = stream_id
+        self._connection = connection
+        self._chunks = deque()
+        self._chunk_offset = 0
+        self._readable = trio.Event()
+        self._receive_window = INITIAL_WINDOW_SIZE
+        self._unacknowledged_count = 0
+        self._send_window = INITIAL_WINDOW_SIZE
+        self._send_window_changed = trio.Event()
+        self.local_closed = False
+        self.remote_closed = False
+        self._reset_by_peer = False
+        self._error = None
+
+    @property
+    def reset_by_peer(self):
+        return self._reset_by_peer
+
+    async def receive_some(self, max_bytes=None):
+        if not max_bytes:
+            max_bytes = 8_192
+        chunks = self._chunks
+        while not chunks:
+            if self.remote_closed:
+                return b""
+            if self._error is not None:
+                _raise_connection_error(self._error)
+            self._readable = trio.Event()
+            await self._readable.wait()
+        chunk = chunks[0]
+        offset = self._chunk_offset
+        count = min(len(chunk) - offset, int(max_bytes))
+        if not offset and count == len(chunk):
+            chunks.popleft()
+        else:
+            next_offset = offset + count
+            chunk, self._chunk_offset = chunk[offset:next_offset], next_offset
+            if next_offset == len(chunks[0]):
+                chunks.popleft()
+                self._chunk_offset = 0
+        await self._acknowledge(count)
+        return chunk
+
+    async def send_all(self, data):
+        with memoryview(data) as view:
+            view = view.cast("B")
+            while view:
+                while self._send_window <= 0:
+                    self._check_writable()
+                    self._send_window_changed = trio.Event()
+                    await self._send_window_changed.wait()
+                self._check_writable()
+                count = min(len(view), self._send_window,
+                            self._connection.max_frame_size)
+                self._send_window -= count
+                await self._connection._send_frame(self.stream_id,
+                    tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_DATA, view[:count])
+                view = view[count:]
+
+    async def send_eof(self):
+        if self.local_closed:
+            return
+        self._check_writable()
+        await self._close(tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_END)
+
+    def wait_send_all_might_not_block(self):
+        pass
+
+    async def aclose(self):
+        # let peer know that remaining data won't be read,
+        # unless it has finished sending already.
+        if self.local_closed:
+            if not self.remote_closed:
+                await self._close(tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_RESET)
+            return
+        if self.remote_closed:
+            await self._close(tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_END)
+        else:
+            await self._close(tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_RESET)
+
+    async def _close(self, frame_tag):
+        self.local_closed = True
+        if frame_tag == tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_RESET:
+            self.remote_closed = True
+            self._chunks.clear()
+        self._readable.set()
+        self._send_window_changed.set()
+        connection = self._connection
+        connection._remove_if_done(self)
+        if self._error is not None or self._reset_by_peer:
+            return
+        try:
+            await connection._send_frame(self.stream_id, frame_tag)
+        except Exception:
+            if frame_tag != tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_RESET:
+                raise
+
+    def _check_writable(self):
+        if self._error is not None:
+            _raise_connection_error(self._error)
+        if self._reset_by_peer:
+            raise KabomuIOError("stream reset by remote endpoint")
+        if self.local_closed:
+            raise KabomuIOError("stream closed")
+
+    async def _acknowledge(self, count):
+        # grant peer window for consumed bytes, once enough of them
+        # have accumulated.
+        self._unacknowledged_count += count
+        increment = self._unacknowledged_count
+        if increment < self._connection.receive_window_size // 2 or \
+                self.remote_closed or self._error is not None:
+            return
+        self._unacknowledged_count = 0
+        self._receive_window += increment
+        try:
+            await self._connection._send_frame(self.stream_id,
+                tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_WINDOW_UPDATE,
+                misc_utils_internal.serialize_int32_be(increment))
+        except Exception:
+            # connection has failed, but consumed bytes are still
+            # valid.
+            pass
+
+    def _on_data(self, payload):
+        self._receive_window -= len(payload)
+        if self._receive_window < 0:
+            raise KabomuIOError(
+                f"flow control window of stream {self.stream_id} exceeded")
+        self._chunks.append(payload)
+        self._readable.set()
+
+    def _on_window_update(self, increment):
+        self._send_window += increment
+        self._send_window_changed.set()
+
+    def _on_remote_close(self, reset):
+        self.remote_closed = True
+        if reset:
+            self._reset_by_peer = True
+            self._send_window_changed.set()
+        self._readable.set()
+
+    def _on_connection_error(self, error):
+        self._error = error
+        self._readable.set()
+        self._send_window_changed.set()
+
+class MultiplexedConnection:
+    # carries many concurrent streams over a single pair of readable
+    # and writable streams, as frames of at most max_frame_size bytes,
+    # so that large bodies don't hold up small ones.
+    # each stream has flow control windows, so that streams
+    # which aren't read don't hold up others either.
+    # streams opened by initiator of connection get odd ids, and
+    # those opened by its peer get even ids.
+    # run() has to be running for streams to receive anything.
+
+    def __init__(self, readable_stream, writable_stream, initiator,
+                 receive_window_size=None, max_frame_size=None,
+                 max_concurrent_streams=None):
+        self._readable_stream = readable_stream
+        self._writable_stream = writable_stream
+        if not receive_window_size:
+            receive_window_size = DEFAULT_RECEIVE_WINDOW_SIZE
+        self.receive_window_size = max(int(receive_window_size),
+                                       INITIAL_WINDOW_SIZE)
+        if not max_frame_size:
+            max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        self.max_frame_size = max(int(max_frame_size), 1)
+        if not max_concurrent_streams:
+            max_concurrent_streams = DEFAULT_MAX_CONCURRENT_STREAMS
+        self.max_concurrent_streams = max_concurrent_streams
+        self._write_lock = trio.Lock()
+        # frames waiting for lock, which get written all at once by
+        # next holder of lock.
+        self._pending_buffers = []
+        self._streams = {}
+        self._next_stream_id = 1 if initiator else 2
+        self._last_remote_stream_id = 0
+        self._accepted_streams = deque()
+        self._refused_stream_ids = deque()
+        self._stream_accepted = trio.Event()
+        self.closed = False
+        self._error = None
+
+    @property
+    def stream_count(self):
+        return len(self._streams)
+
+    async def open_stream(self):
+        if self.closed:
+            raise KabomuIOError("multiplexed connection closed")
+        stream_id = self._next_stream_id
+        self._next_stream_id += 2
+        stream = MultiplexedStream(self, stream_id)
+        self._streams[stream_id] = stream
+        await self._grant_extra_window(stream)
+        return stream
+
+    async def accept_stream(self):
+        # returns None once connection is closed.
+        while True:
+            # frames are only written outside of run(), since reading
+            # must not wait for writes to complete.
+            refused_stream_ids = self._refused_stream_ids
+            while refused_stream_ids and not self.closed:
+                await self._send_frame(refused_stream_ids.popleft(),
+                    tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_RESET)
+            if self._accepted_streams:
+                break
+            if self.closed:
+                return None
+            self._stream_accepted = trio.Event()
+            await self._stream_accepted.wait()
+        stream = self._accepted_streams.popleft()
+        await self._grant_extra_window(stream)
+        return stream
+
+    async def run(self):
+        # reads frames and dispatches them to streams until
+        # connection ends.
+        error = KabomuIOError("multiplexed connection closed")
+        try:
+            await self._read_frames()
+        except Exception as ex:
+            error = KabomuIOError("multiplexed connection failed")
+            error.__cause__ = ex
+            raise error
+        finally:
+            self._fail(error)
+
+    async def aclose(self):
+        self._fail(KabomuIOError("multiplexed connection closed"))
+
+    async def _read_frames(self):
+        src = io_utils_internal.create_buffered_readable_stream(
+            self._readable_stream)
+        while True:
+            if not await src.peek():
+                return
+            header = await io_utils_internal.read_bytes_fully(src,
+                tlv_utils.STREAM_FRAME_HEADER_LENGTH)
+            tag = tlv_utils.decode_tag(header, 0)
+            if tag != tlv_utils.TAG_FOR_QUASI_HTTP_BODY_CHUNK_EXT:
+                raise KabomuIOError(f"unexpected tag: {tag}")
+            payload_length = tlv_utils.decode_length(header, 4) - 8
+            stream_id = misc_utils_internal.deserialize_int32_be(header, 8)
+            frame_tag = misc_utils_internal.deserialize_int32_be(header, 12)
+            if payload_length < 0 or stream_id <= 0:
+                raise KabomuIOError("invalid stream frame")
+            if payload_length > self.receive_window_size:
+                raise KabomuIOError(
+                    f"stream frame too large: {payload_length}")
+            payload = await io_utils_internal.read_bytes_fully(src,
+                payload_length)
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                stream = self._on_new_stream(stream_id, frame_tag)
+                if stream is None:
+                    continue
+            if frame_tag == tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_DATA:
+                stream._on_data(payload)
+            elif frame_tag == tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_WINDOW_UPDATE:
+                stream._on_window_update(
+                    misc_utils_internal.deserialize_int32_be(payload, 0))
+            elif frame_tag == tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_END:
+                stream._on_remote_close(False)
+                self._remove_if_done(stream)
+            elif frame_tag == tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_RESET:
+                stream._on_remote_close(True)
+                self._remove_if_done(stream)
+            # ignore unknown frame kinds, to leave room for extensions.
+
+    def _on_new_stream(self, stream_id, frame_tag):
+        # returns None for frames of streams which have been closed
+        # already, or which are refused.
+        if stream_id % 2 == self._next_stream_id % 2 or \
+                stream_id <= self._last_remote_stream_id:
+            return None
+        self._last_remote_stream_id = stream_id
+        if frame_tag == tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_RESET:
+            return None
+        if len(self._streams) >= self.max_concurrent_streams:
+            self._refused_stream_ids.append(stream_id)
+            self._stream_accepted.set()
+            return None
+        stream = MultiplexedStream(self, stream_id)
+        self._streams[stream_id] = stream
+        self._accepted_streams.append(stream)
+        self._stream_accepted.set()
+        return stream
+
+    async def _grant_extra_window(self, stream):
+        increment = self.receive_window_size - INITIAL_WINDOW_SIZE
+        if increment:
+            stream._receive_window += increment
+            await self._send_frame(stream.stream_id,
+                tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_WINDOW_UPDATE,
+                misc_utils_internal.serialize_int32_be(increment))
+
+    async def _send_frame(self, stream_id, frame_tag, payload=b""):
+        if self._error is not None:
+            _raise_connection_error(self._error)
+        pending_buffers = self._pending_buffers
+        header = tlv_utils.encode_stream_frame_header(stream_id, frame_tag,
+                                                      len(payload))
+        pending_buffers.append(header)
+        if len(payload):
+            pending_buffers.append(payload)
+        try:
+            await self._write_lock.acquire()
+        except BaseException:
+            # payload may be reused by sender once it leaves, so frame
+            # mustn't be written afterwards.
+            if not _remove_pending_frame(pending_buffers, header,
+                                         len(payload) > 0):
+                # frame is being written by holder of lock.
+                with trio.CancelScope(shield=True):
+                    async with self._write_lock:
+                        pass
+            raise
+        try:
+            if self._error is not None:
+                _raise_connection_error(self._error)
+            if not pending_buffers:
+                # frame was written together with those of an earlier
+                # holder of lock.
+                return
+            buffers = list(pending_buffers)
+            pending_buffers.clear()
+            try:
+                await io_utils_internal.send_all_gathered(
+                    self._writable_stream, buffers)
+            except BaseException as ex:
+                # partially written frames leave connection unusable.
+                error = KabomuIOError("multiplexed connection failed")
+                error.__cause__ = ex
+                self._fail(error)
+                raise
+        finally:
+            self._write_lock.release()
+
+    def _remove_if_done(self, stream):
+        if stream.local_closed and stream.remote_closed and \
+                self._streams.get(stream.stream_id) is stream:
+            del self._streams[stream.stream_id]
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self.closed = True
+        streams = self._streams
+        self._streams = {}
+        for stream in streams.values():
+            stream._on_connection_error(error)
+        self._stream_accepted.set()
+
+class MultiplexedStreamConnection:
+    # connection for use with StandardQuasiHttpClient and
+    # StandardQuasiHttpServer, which sends and receives over a
+    # multiplexed stream.
+
+    def __init__(self, stream, processing_options=None, environment=None):
+        self.stream = stream
+        self.processing_options = processing_options
+        self.environment = environment
+
+    async def schedule_timeout(self, proc):
+        timeout_millis = _get_optional_attr(self.processing_options,
+            "timeout_millis")
+        if not timeout_millis or timeout_millis <= 0:
+            return None
+        with trio.move_on_after(timeout_millis / 1000.0):
+            return DefaultTimeoutResult(response=await proc())
+        return DefaultTimeoutResult(timeout=True)
+
+def create_multiplexed_connection(readable_stream, writable_stream,
+                                  initiator, receive_window_size=None,
+                                  max_frame_size=None,
+                                  max_concurrent_streams=None):
+    return MultiplexedConnection(readable_stream, writable_stream,
+                                 initiator, receive_window_size,
+                                 max_frame_size, max_concurrent_streams)
+
+def _remove_pending_frame(pending_buffers, header, has_payload):
+    # removes frame starting with header from pending_buffers, and
+    # returns False if it isn't pending anymore.
+    for i, buffer in enumerate(pending_buffers):
+        if buffer is header:
+            del pending_buffers[i:i + 2 if has_payload else i + 1]
+            return True
+    return False
+
+def _raise_connection_error(error):
+    # error is shared by many tasks, so raising it directly would
+    # keep growing its traceback.
+    raise KabomuIOError("multiplexed connection failed") from error
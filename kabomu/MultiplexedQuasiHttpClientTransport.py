@@ -0,0 +1,165 @@
+import trio
+
+from kabomu.abstractions import IQuasiHttpClientTransport
+from kabomu.quasi_http_utils import _get_optional_attr
+from kabomu import protocol_utils_internal
+from kabomu.MultiplexedConnection import MultiplexedStreamConnection,\
+    create_multiplexed_connection
+from kabomu.errors import MissingDependencyError,\
+    QuasiHttpError,\
+    QUASI_HTTP_ERROR_REASON_GENERAL
+
+class _Entry:
+    __slots__ = ("connection", "multiplexed_connection", "released")
+
+    def __init__(self, connection, multiplexed_connection):
+        self.connection = connection
+        self.multiplexed_connection = multiplexed_connection
+        self.released = False
+
+class MultiplexedQuasiHttpClientTransport(IQuasiHttpClientTransport):
+    # wraps a client transport, and carries concurrent requests to the
+    # same endpoint with send options of the same values over a single
+    # one of its connections, each on its own multiplexed stream.
+    # connections of wrapped transport are read by tasks started in
+    # nursery, and are kept open until they fail or
+    # close_connections() is called. requests whose endpoint or send
+    # options can't be compared get connections of their own, which
+    # are closed together with their streams.
+    # servers have to use MultiplexedQuasiHttpServerTransport.
+
+    def __init__(self, transport=None, nursery=None,
+                 receive_window_size=None,
+                 max_frame_size=None,
+                 max_concurrent_streams=None):
+        self.transport = transport
+        self.nursery = nursery
+        self.receive_window_size = receive_window_size
+        self.max_frame_size = max_frame_size
+        self.max_concurrent_streams = max_concurrent_streams
+        self._entries = {}
+        # locks of keys whose connections are being opened.
+        self._locks = {}
+        # entries of unshared connections by id of their streams.
+        self._unshared_entries = {}
+
+    async def allocate_connection(self, remote_endpoint, send_options):
+        transport = self.transport
+        if not transport:
+            raise MissingDependencyError("client transport")
+        if not self.nursery:
+            raise MissingDependencyError("nursery")
+        key = protocol_utils_internal.get_connection_key(
+            remote_endpoint, send_options)
+        if key is None:
+            return await self._allocate_unshared(remote_endpoint,
+                                                 send_options)
+        entry = self._entries.get(key)
+        if entry is None or entry.multiplexed_connection.closed:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = trio.Lock()
+                self._locks[key] = lock
+            try:
+                async with lock:
+                    entry = self._entries.get(key)
+                    if entry is None or \
+                            entry.multiplexed_connection.closed:
+                        entry = await self._open(key, remote_endpoint,
+                                                 send_options)
+            finally:
+                if not lock.statistics().tasks_waiting and \
+                        self._locks.get(key) is lock:
+                    del self._locks[key]
+        stream = await entry.multiplexed_connection.open_stream()
+        return self._create_stream_connection(entry, stream)
+
+    async def _allocate_unshared(self, remote_endpoint, send_options):
+        entry = await self._open(None, remote_endpoint, send_options)
+        try:
+            stream = await entry.multiplexed_connection.open_stream()
+        except:
+            with trio.CancelScope(shield=True):
+                await entry.multiplexed_connection.aclose()
+            raise
+        self._unshared_entries[id(stream)] = entry
+        return self._create_stream_connection(entry, stream)
+
+    def _create_stream_connection(self, entry, stream):
+        connection = entry.connection
+        return MultiplexedStreamConnection(stream,
+            _get_optional_attr(connection, "processing_options"),
+            _get_optional_attr(connection, "environment"))
+
+    async def establish_connection(self, connection):
+        # wrapped connection is established before streams are opened.
+        pass
+
+    async def release_connection(self, connection, response):
+        if response is not None and _get_optional_attr(response, "body"):
+            # wait for body to be released.
+            return
+        stream = connection.stream
+        await stream.aclose()
+        entry = self._unshared_entries.pop(id(stream), None)
+        if entry is not None:
+            await entry.multiplexed_connection.aclose()
+            await self._release(entry)
+
+    def get_readable_stream(self, connection):
+        return connection.stream
+
+    def get_writable_stream(self, connection):
+        return connection.stream
+
+    async def close_connections(self):
+        entries = list(self._entries.values()) + \
+            list(self._unshared_entries.values())
+        self._entries = {}
+        self._unshared_entries = {}
+        for entry in entries:
+            await entry.multiplexed_connection.aclose()
+            await self._release(entry)
+
+    async def _open(self, key, remote_endpoint, send_options):
+        transport = self.transport
+        connection = await transport.allocate_connection(remote_endpoint,
+            send_options)
+        if not connection:
+            raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_GENERAL,
+                                 "no connection")
+        try:
+            await transport.establish_connection(connection)
+            multiplexed_connection = create_multiplexed_connection(
+                transport.get_readable_stream(connection),
+                transport.get_writable_stream(connection),
+                True, self.receive_window_size, self.max_frame_size,
+                self.max_concurrent_streams)
+        except:
+            await transport.release_connection(connection, None)
+            raise
+        entry = _Entry(connection, multiplexed_connection)
+        if key is not None:
+            self._entries[key] = entry
+        self.nursery.start_soon(self._run, key, entry)
+        return entry
+
+    async def _run(self, key, entry):
+        try:
+            await entry.multiplexed_connection.run()
+        except Exception:
+            pass # streams get to know about failures.
+        finally:
+            if key is not None and self._entries.get(key) is entry:
+                del self._entries[key]
+            with trio.CancelScope(shield=True):
+                await self._release(entry)
+
+    async def _release(self, entry):
+        if entry.released:
+            return
+        entry.released = True
+        try:
+            await self.transport.release_connection(entry.connection, None)
+        except Exception:
+            pass # ignore
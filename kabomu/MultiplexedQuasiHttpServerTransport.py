@@ -0,0 +1,99 @@
+import logging
+
+import trio
+
+from kabomu.abstractions import IQuasiHttpServerTransport
+from kabomu.quasi_http_utils import _get_optional_attr
+from kabomu.MultiplexedConnection import MultiplexedStreamConnection,\
+    create_multiplexed_connection
+from kabomu.errors import MissingDependencyError
+
+_logger = logging.getLogger(__name__)
+
+class MultiplexedQuasiHttpServerTransport(IQuasiHttpServerTransport):
+    # wraps a server transport, and serves requests arriving
+    # concurrently on multiplexed streams of its connections, each
+    # with its own call to accept_connection() of quasi_http_server.
+    # quasi_http_server must have this transport as its transport.
+    # failure of a stream doesn't affect the others, and is logged
+    # unless it is due to a reset by peer or closure of connection.
+
+    def __init__(self, transport=None, quasi_http_server=None,
+                 receive_window_size=None,
+                 max_frame_size=None,
+                 max_concurrent_streams=None):
+        self.transport = transport
+        self.quasi_http_server = quasi_http_server
+        self.receive_window_size = receive_window_size
+        self.max_frame_size = max_frame_size
+        self.max_concurrent_streams = max_concurrent_streams
+
+    async def accept_connection(self, connection):
+        # serves streams of connection of wrapped transport
+        # until it is closed, and then releases it.
+        transport = self.transport
+        quasi_http_server = self.quasi_http_server
+        if not transport:
+            raise MissingDependencyError("server transport")
+        if not quasi_http_server:
+            raise MissingDependencyError("quasi http server")
+        try:
+            multiplexed_connection = create_multiplexed_connection(
+                transport.get_readable_stream(connection),
+                transport.get_writable_stream(connection),
+                False, self.receive_window_size, self.max_frame_size,
+                self.max_concurrent_streams)
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(_accept_streams, nursery,
+                    quasi_http_server, multiplexed_connection,
+                    _get_optional_attr(connection, "processing_options"),
+                    _get_optional_attr(connection, "environment"))
+                await multiplexed_connection.run()
+        finally:
+            with trio.CancelScope(shield=True):
+                await transport.release_connection(connection)
+
+    async def release_connection(self, connection):
+        await connection.stream.aclose()
+
+    def get_readable_stream(self, connection):
+        return connection.stream
+
+    def get_writable_stream(self, connection):
+        return connection.stream
+
+async def _accept_streams(nursery, quasi_http_server, multiplexed_connection,
+                          processing_options, environment):
+    while True:
+        stream = await multiplexed_connection.accept_stream()
+        if stream is None:
+            break
+        nursery.start_soon(_serve_stream, quasi_http_server,
+            multiplexed_connection,
+            MultiplexedStreamConnection(stream, processing_options,
+                                        environment))
+
+async def _serve_stream(quasi_http_server, multiplexed_connection,
+                        connection):
+    stream = connection.stream
+    try:
+        await quasi_http_server.accept_connection(connection)
+    except Exception as ex:
+        if not stream.reset_by_peer and not multiplexed_connection.closed \
+                and not _is_due_to_cancellation(ex):
+            _logger.warning("stream processing error", exc_info=True)
+    finally:
+        # let peer know about streams left unfinished.
+        with trio.CancelScope(shield=True):
+            try:
+                await stream.aclose()
+            except Exception:
+                pass # ignore
+
+def _is_due_to_cancellation(error):
+    # server wraps cancellations (e.g. on shutdown) in its own errors.
+    while error is not None:
+        if isinstance(error, trio.Cancelled):
+            return True
+        error = error.__cause__
+    return False
@@ -0,0 +1,395 @@
+from collections import deque
+from types import SimpleNamespace
+
+import trio
+
+from kabomu.quasi_http_utils import _get_optional_attr, _bind_method
+from kabomu import io_utils_internal, protocol_utils_internal
+from kabomu.errors import MissingDependencyError,\
+    QuasiHttpError,\
+    QUASI_HTTP_ERROR_REASON_GENERAL,\
+    QUASI_HTTP_ERROR_REASON_TIMEOUT
+
+DEFAULT_MAX_PIPELINE_DEPTH = 8
+
+class _Turn:
+    __slots__ = ("done", "failure", "closed")
+
+    def __init__(self):
+        # set once response has been read off connection, successfully
+        # or not.
+        self.done = trio.Event()
+        self.failure = None
+        # indicates that server won't answer subsequent requests.
+        self.closed = False
+
+class _Waiter:
+    __slots__ = ("event", "granted")
+
+    def __init__(self):
+        self.event = trio.Event()
+        # indicates that a place in pipeline was reserved for waiter.
+        self.granted = False
+
+class _Pipeline:
+    __slots__ = ("pool_key", "connection", "write_lock", "last_turn",
+                 "in_flight", "waiters", "confirmed", "accepting",
+                 "last_response_headers")
+
+    def __init__(self, pool_key):
+        self.pool_key = pool_key
+        self.connection = None
+        self.write_lock = trio.Lock()
+        self.last_turn = None
+        self.in_flight = 0
+        self.waiters = deque()
+        self.confirmed = False
+        self.accepting = True
+        self.last_response_headers = None
+
+class _RetryError(Exception):
+    # raised when a request can be sent again on another connection.
+    def __init__(self, request):
+        super().__init__()
+        self.request = request
+
+class PipelinedQuasiHttpClient:
+    # sends requests to the same endpoint with the same send options
+    # back to back on a single connection, without waiting for
+    # responses to earlier requests, and hands over responses to
+    # their senders in order.
+    # pipelining only begins after server agrees to keep the connection
+    # alive; until then requests are sent one at a time.
+    # responses with bodies must be released before responses
+    # to later requests can be read.
+    # connections are given back to transport once no request is
+    # pending on them, so wrapping transport with
+    # PooledQuasiHttpClientTransport enables reuse across bursts.
+    # each exchange is subject to timeout of its connection, and a
+    # timeout closes the connection and fails every other exchange
+    # on it, since later responses can no longer be told apart.
+    # the same applies to released bodies which can't be drained
+    # within max_drain_size bytes and drain_timeout_millis.
+
+    def __init__(self, transport=None, max_pipeline_depth=None,
+                 max_drain_size=None, drain_timeout_millis=None):
+        self.transport = transport
+        self.max_pipeline_depth = max_pipeline_depth
+        self.max_drain_size = max_drain_size
+        self.drain_timeout_millis = drain_timeout_millis
+        self._pipelines = {}
+
+    async def send(self, remote_endpoint, request, options=None):
+        if not request:
+            raise ValueError("request argument is null")
+        return await self._send_internal(
+            remote_endpoint, request, None, options)
+
+    async def send2(self, remote_endpoint, request_func, options=None):
+        if not request_func:
+            raise ValueError("request_func argument is null")
+        return await self._send_internal(
+            remote_endpoint, None, request_func, options)
+
+    async def _send_internal(self,
+            remote_endpoint, request, request_func,
+            send_options):
+        transport = self.transport
+
+        if not transport:
+            raise MissingDependencyError("client transport")
+
+        # None for unhashable endpoints or send options, whose
+        # connections can't be shared.
+        pool_key = protocol_utils_internal.get_connection_key(
+            remote_endpoint, send_options)
+        try:
+            while True:
+                pipeline = await self._join(transport, pool_key)
+                try:
+                    return await self._exchange(transport, pipeline,
+                        remote_endpoint, send_options,
+                        request, request_func)
+                except _RetryError as ex:
+                    request = ex.request
+        except QuasiHttpError:
+            raise
+        except Exception as ex:
+            abort_error = QuasiHttpError(
+                QUASI_HTTP_ERROR_REASON_GENERAL,
+                "encountered error during send request processing")
+            abort_error.__cause__ = ex
+            raise abort_error
+
+    async def _join(self, transport, pool_key):
+        while True:
+            pipeline = None
+            if pool_key is not None:
+                pipeline = self._pipelines.get(pool_key)
+            if pipeline is None:
+                pipeline = _Pipeline(pool_key)
+                if pool_key is not None:
+                    self._pipelines[pool_key] = pipeline
+            if not pipeline.waiters and \
+                    pipeline.in_flight < self._get_max_depth(pipeline):
+                pipeline.in_flight += 1
+                return pipeline
+
+            # wait in line, so that places are handed out one at a time
+            # instead of waking up every waiter.
+            waiter = _Waiter()
+            pipeline.waiters.append(waiter)
+            try:
+                await waiter.event.wait()
+            except BaseException:
+                if waiter.granted:
+                    with trio.CancelScope(shield=True):
+                        await self._finish(transport, pipeline, _Turn(),
+                                           True)
+                elif waiter in pipeline.waiters:
+                    pipeline.waiters.remove(waiter)
+                raise
+            if waiter.granted:
+                return pipeline
+
+    def _get_max_depth(self, pipeline):
+        if not pipeline.confirmed:
+            return 1
+        max_depth = self.max_pipeline_depth
+        if not max_depth:
+            max_depth = DEFAULT_MAX_PIPELINE_DEPTH
+        return max_depth
+
+    async def _exchange(self, transport, pipeline,
+            remote_endpoint, send_options, request, request_func):
+        turn = _Turn()
+        state = SimpleNamespace(registered=False, body_buffered=False)
+        response = None
+        try:
+            connection = pipeline.connection
+            if connection is None:
+                async with pipeline.write_lock:
+                    if not pipeline.accepting:
+                        # nothing written yet, so try another connection.
+                        raise _RetryError(request)
+                    connection = pipeline.connection
+                    if connection is None:
+                        connection = await self._allocate_connection(
+                            transport, pipeline, remote_endpoint,
+                            send_options)
+            async def proc():
+                return await self._send_and_receive(transport, pipeline,
+                    connection, turn, state, request, request_func)
+            try:
+                response = await protocol_utils_internal.run_timeout_scheduler(
+                    connection, True, proc)
+            except QuasiHttpError as ex:
+                if ex.reason_code == QUASI_HTTP_ERROR_REASON_TIMEOUT and \
+                        state.registered:
+                    turn.failure = ex
+                    await self._close(transport, pipeline)
+                raise
+            if not response:
+                response = await proc()
+        except BaseException as ex:
+            if state.registered:
+                # connection can't be trusted after a failed exchange.
+                if turn.failure is None and not turn.closed:
+                    turn.failure = ex
+                self._stop_accepting(pipeline)
+            await self._finish(transport, pipeline, turn, True)
+            raise
+
+        headers = _get_optional_attr(response, "headers")
+        pipeline.last_response_headers = headers
+        if protocol_utils_internal.has_keep_alive_header(headers):
+            if not pipeline.confirmed:
+                pipeline.confirmed = True
+                try:
+                    # remember for when connection gets reused.
+                    connection.keep_alive_confirmed = True
+                except AttributeError:
+                    pass
+                self._notify(pipeline)
+        else:
+            turn.closed = True
+            self._stop_accepting(pipeline)
+
+        if _get_optional_attr(response, "body") and not state.body_buffered:
+            pending_turns = [turn]
+            max_drain_size = self.max_drain_size
+            if not max_drain_size:
+                max_drain_size = io_utils_internal.DEFAULT_MAX_DRAIN_SIZE
+            drain_timeout_millis = self.drain_timeout_millis
+            if not drain_timeout_millis:
+                drain_timeout_millis = \
+                    io_utils_internal.DEFAULT_DRAIN_TIMEOUT_MILLIS
+            body = response.body
+            async def release_func(self_):
+                if not pending_turns:
+                    return
+                turn = pending_turns.pop()
+                # read away rest of body, to get to next response.
+                try:
+                    drained = turn.closed or \
+                        await io_utils_internal.drain(body, max_drain_size,
+                                                      drain_timeout_millis)
+                except BaseException as ex:
+                    turn.failure = ex
+                    drained = True
+                if not drained:
+                    turn.failure = QuasiHttpError(
+                        QUASI_HTTP_ERROR_REASON_GENERAL,
+                        "released response body could not be drained")
+                    # close right away, since rest of body may never
+                    # arrive.
+                    await self._close(transport, pipeline)
+                if turn.failure is not None:
+                    self._stop_accepting(pipeline)
+                await self._finish(transport, pipeline, turn,
+                                   turn.failure is not None)
+        else:
+            async def release_func(self_):
+                # turn was finished together with response.
+                pass
+            await self._finish(transport, pipeline, turn, False)
+        response.release = _bind_method(release_func, response)
+        return response
+
+    async def _send_and_receive(self, transport, pipeline, connection,
+            turn, state, request, request_func):
+        async with pipeline.write_lock:
+            if not pipeline.accepting:
+                # nothing written yet, so try another connection.
+                raise _RetryError(request)
+            if not request:
+                request = await request_func(
+                    _get_optional_attr(connection, "environment"))
+                if not request:
+                    raise QuasiHttpError(
+                        QUASI_HTTP_ERROR_REASON_GENERAL, "no request")
+            previous_turn, pipeline.last_turn = pipeline.last_turn, turn
+            state.registered = True
+            request_serialized = False
+            if hasattr(transport, "request_serializer"):
+                request_serialized = await transport.request_serializer(
+                    connection, request)
+            if not request_serialized:
+                await protocol_utils_internal.write_entity_to_transport(
+                    False, request, transport.get_writable_stream(connection),
+                    connection)
+
+        if previous_turn is not None:
+            await previous_turn.done.wait()
+            if previous_turn.failure is not None:
+                ex = QuasiHttpError(QUASI_HTTP_ERROR_REASON_GENERAL,
+                    "pipelined connection failed during earlier exchange")
+                ex.__cause__ = previous_turn.failure
+                raise ex
+            if previous_turn.closed:
+                turn.closed = True
+                if _get_optional_attr(request, "body"):
+                    raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_GENERAL,
+                        "connection closed by remote endpoint " +
+                        "before request could be processed")
+                # server closed connection without reading request,
+                # so it is safe to send it again.
+                raise _RetryError(request)
+
+        response = None
+        if hasattr(transport, "response_deserializer"):
+            response = await transport.response_deserializer(connection)
+        if not response:
+            response = await protocol_utils_internal.read_entity_from_transport(
+                True, transport.get_readable_stream(connection),
+                connection)
+            if response.body:
+                max_eager_response_body_size = _get_optional_attr(
+                    connection, "processing_options",
+                    "max_eager_response_body_size")
+                if max_eager_response_body_size and \
+                        max_eager_response_body_size > 0:
+                    state.body_buffered = \
+                        await protocol_utils_internal.buffer_response_body(
+                            response, max_eager_response_body_size)
+        return response
+
+    async def _allocate_connection(self, transport, pipeline,
+            remote_endpoint, send_options):
+        connection = await transport.allocate_connection(
+            remote_endpoint, send_options)
+        if not connection:
+            raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_GENERAL,
+                                 "no connection")
+        pipeline.connection = connection
+        try:
+            connection.keep_alive = True
+        except AttributeError:
+            # can't ask server to keep connection open.
+            pass
+        await transport.establish_connection(connection)
+        if _get_optional_attr(connection, "keep_alive_confirmed"):
+            pipeline.confirmed = True
+            self._notify(pipeline)
+        return connection
+
+    def _stop_accepting(self, pipeline):
+        if not pipeline.accepting:
+            return
+        pipeline.accepting = False
+        if self._pipelines.get(pipeline.pool_key) is pipeline:
+            del self._pipelines[pipeline.pool_key]
+        self._notify(pipeline)
+
+    def _notify(self, pipeline):
+        waiters = pipeline.waiters
+        if not pipeline.accepting:
+            # let waiters look for another pipeline.
+            while waiters:
+                waiters.popleft().event.set()
+            return
+        max_depth = self._get_max_depth(pipeline)
+        while waiters and pipeline.in_flight < max_depth:
+            waiter = waiters.popleft()
+            waiter.granted = True
+            pipeline.in_flight += 1
+            waiter.event.set()
+
+    async def _close(self, transport, pipeline):
+        # closes connection of pipeline right away, so that exchanges
+        # still waiting on it fail.
+        self._stop_accepting(pipeline)
+        connection = pipeline.connection
+        if connection is None:
+            return
+        pipeline.connection = None
+        with trio.CancelScope(shield=True):
+            try:
+                await transport.release_connection(connection, None)
+            except Exception:
+                pass # ignore
+
+    async def _finish(self, transport, pipeline, turn, error_occured):
+        turn.done.set()
+        pipeline.in_flight -= 1
+        self._notify(pipeline)
+        if pipeline.in_flight:
+            return
+        connection = pipeline.connection
+        if connection is None:
+            return
+        pipeline.connection = None
+        response = None
+        if pipeline.accepting:
+            self._stop_accepting(pipeline)
+            # let pooling transports know whether server agreed to keep
+            # connection alive.
+            response = SimpleNamespace(
+                headers=pipeline.last_response_headers)
+        if error_occured:
+            try:
+                await transport.release_connection(connection, None)
+            except Exception:
+                pass # ignore
+        else:
+            await transport.release_connection(connection, response)
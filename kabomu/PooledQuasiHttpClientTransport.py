@@ -0,0 +1,307 @@
+import inspect
+import select
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+
+import trio
+
+from kabomu.abstractions import IQuasiHttpClientTransport
+from kabomu.quasi_http_utils import _get_optional_attr
+from kabomu import io_utils_internal, protocol_utils_internal
+from kabomu.errors import MissingDependencyError
+
+DEFAULT_MAX_IDLE_CONNECTIONS_PER_ENDPOINT = 8
+
+# Maximum number of idle connections across all endpoints and
+# send options.
+DEFAULT_MAX_IDLE_CONNECTIONS = 64
+
+DEFAULT_IDLE_TIMEOUT_MILLIS = 30_000
+
+class _PoolEntry:
+    __slots__ = ("connection", "pool_key", "created_at",
+                 "idle_since", "established", "body", "keep_alive")
+
+    def __init__(self, connection, pool_key, created_at):
+        self.connection = connection
+        self.pool_key = pool_key
+        self.created_at = created_at
+        self.idle_since = None
+        self.established = False
+        self.body = None
+        self.keep_alive = False
+
+class PooledQuasiHttpClientTransport(IQuasiHttpClientTransport):
+    # wraps a client transport, and keeps connections open after
+    # exchanges for reuse by subsequent requests to the same endpoint
+    # with send options of the same values.
+    # connections are only reused if server agrees with keep-alive
+    # connection header, and response body has been fully read
+    # (or could be drained within drain_timeout_millis) by the time
+    # response is released.
+    # idle connections which have expired or exceed
+    # max_idle_connections are closed whenever connections are
+    # allocated or released.
+
+    def __init__(self, transport=None,
+                 max_idle_connections_per_endpoint=None,
+                 max_idle_connections=None,
+                 idle_timeout_millis=None,
+                 max_lifetime_millis=None,
+                 max_drain_size=None,
+                 health_check=None,
+                 drain_timeout_millis=None):
+        self.transport = transport
+        self.max_idle_connections_per_endpoint = \
+            max_idle_connections_per_endpoint
+        self.max_idle_connections = max_idle_connections
+        self.idle_timeout_millis = idle_timeout_millis
+        self.max_lifetime_millis = max_lifetime_millis
+        self.max_drain_size = max_drain_size
+        self.health_check = health_check
+        self.drain_timeout_millis = drain_timeout_millis
+        self.stats = SimpleNamespace(created=0, reused=0, pooled=0,
+                                     discarded=0)
+        self._entries = {}
+        # idle entries per pool key, in order of becoming idle.
+        self._idle_connections = {}
+        # all idle entries by id of their connections, in order of
+        # becoming idle.
+        self._idle_entries = OrderedDict()
+
+    def __getattr__(self, name):
+        # expose optional members of wrapped transport
+        # (e.g. request_serializer) as they are.
+        transport = self.__dict__.get("transport")
+        if transport is None:
+            raise AttributeError(name)
+        return getattr(transport, name)
+
+    @property
+    def idle_connection_count(self):
+        return len(self._idle_entries)
+
+    async def allocate_connection(self, remote_endpoint, send_options):
+        transport = self.transport
+        if not transport:
+            raise MissingDependencyError("client transport")
+        await self._prune_idle_connections()
+        # None for unhashable endpoints or send options, whose
+        # connections can't be pooled.
+        pool_key = protocol_utils_internal.get_connection_key(
+            remote_endpoint, send_options)
+        if pool_key is not None:
+            connection = await self._take_idle_connection(pool_key)
+            if connection is not None:
+                self.stats.reused += 1
+                return connection
+        connection = await transport.allocate_connection(remote_endpoint,
+            send_options)
+        if not connection:
+            return connection
+        self.stats.created += 1
+        if pool_key is None:
+            return connection
+        try:
+            connection.keep_alive = True
+        except AttributeError:
+            # can't ask server to keep connection open.
+            return connection
+        self._entries[id(connection)] = _PoolEntry(connection, pool_key,
+            trio.current_time())
+        return connection
+
+    async def establish_connection(self, connection):
+        entry = self._get_entry(connection)
+        if entry is not None:
+            if entry.established:
+                return
+            entry.established = True
+        await self.transport.establish_connection(connection)
+
+    async def release_connection(self, connection, response):
+        entry = self._get_entry(connection)
+        if entry is None:
+            await self.transport.release_connection(connection, response)
+            return
+        if entry.idle_since is not None:
+            # already back in pool.
+            return
+        if response is not None:
+            entry.keep_alive = protocol_utils_internal.has_keep_alive_header(
+                _get_optional_attr(response, "headers"))
+            body = _get_optional_attr(response, "body")
+            if body:
+                # wait for body to be released.
+                entry.body = body
+                return
+            reusable = entry.keep_alive
+        else:
+            # either response body has been released, or an error
+            # occured before response was received.
+            body, entry.body = entry.body, None
+            reusable = body is not None and entry.keep_alive and \
+                await self._drain(body)
+        if reusable:
+            await self._add_idle_connection(entry)
+        else:
+            await self._discard(entry)
+
+    def get_readable_stream(self, connection):
+        return self.transport.get_readable_stream(connection)
+
+    def get_writable_stream(self, connection):
+        return self.transport.get_writable_stream(connection)
+
+    async def close_idle_connections(self):
+        idle_entries = self._idle_entries
+        self._idle_connections = {}
+        self._idle_entries = OrderedDict()
+        for entry in idle_entries.values():
+            await self._discard(entry)
+
+    def _get_entry(self, connection):
+        entry = self._entries.get(id(connection))
+        if entry is None or entry.connection is not connection:
+            return None
+        return entry
+
+    def _is_expired(self, entry, now):
+        idle_timeout_millis = self.idle_timeout_millis
+        if not idle_timeout_millis:
+            idle_timeout_millis = DEFAULT_IDLE_TIMEOUT_MILLIS
+        if idle_timeout_millis > 0 and \
+                (now - entry.idle_since) * 1000 >= idle_timeout_millis:
+            return True
+        max_lifetime_millis = self.max_lifetime_millis
+        return bool(max_lifetime_millis) and max_lifetime_millis > 0 and \
+            (now - entry.created_at) * 1000 >= max_lifetime_millis
+
+    async def _take_idle_connection(self, pool_key):
+        q = self._idle_connections.get(pool_key)
+        now = trio.current_time()
+        while q:
+            # prefer most recently used connections.
+            entry = q.pop()
+            if not q:
+                del self._idle_connections[pool_key]
+            del self._idle_entries[id(entry.connection)]
+            if self._is_expired(entry, now) or \
+                    not await self._is_healthy(entry.connection):
+                await self._discard(entry)
+                continue
+            entry.idle_since = None
+            return entry.connection
+        return None
+
+    async def _add_idle_connection(self, entry):
+        entry.idle_since = trio.current_time()
+        if self._is_expired(entry, entry.idle_since):
+            await self._discard(entry)
+            return
+        q = self._idle_connections.get(entry.pool_key)
+        if q is None:
+            q = deque()
+            self._idle_connections[entry.pool_key] = q
+        q.append(entry)
+        self._idle_entries[id(entry.connection)] = entry
+        self.stats.pooled += 1
+        max_idle_count = self.max_idle_connections_per_endpoint
+        if not max_idle_count:
+            max_idle_count = DEFAULT_MAX_IDLE_CONNECTIONS_PER_ENDPOINT
+        surplus = []
+        while len(q) > max(max_idle_count, 0):
+            # close least recently used connections.
+            surplus.append(self._remove_idle_connection(q[0]))
+        for entry in surplus:
+            await self._discard(entry)
+        await self._prune_idle_connections()
+
+    async def _prune_idle_connections(self):
+        # closes expired idle connections, and least recently used
+        # ones in excess of max_idle_connections.
+        idle_entries = self._idle_entries
+        if not idle_entries:
+            return
+        now = trio.current_time()
+        # take entries out of pool before awaiting anything, so that
+        # they can't be taken concurrently.
+        pruned = [self._remove_idle_connection(e)
+                  for e in list(idle_entries.values())
+                  if self._is_expired(e, now)]
+        max_idle_count = self.max_idle_connections
+        if not max_idle_count:
+            max_idle_count = DEFAULT_MAX_IDLE_CONNECTIONS
+        while len(idle_entries) > max(max_idle_count, 0):
+            pruned.append(self._remove_idle_connection(
+                next(iter(idle_entries.values()))))
+        for entry in pruned:
+            await self._discard(entry)
+
+    def _remove_idle_connection(self, entry):
+        del self._idle_entries[id(entry.connection)]
+        q = self._idle_connections[entry.pool_key]
+        q.remove(entry)
+        if not q:
+            del self._idle_connections[entry.pool_key]
+        return entry
+
+    async def _is_healthy(self, connection):
+        health_check = self.health_check
+        if health_check is not None:
+            healthy = health_check(connection)
+            if inspect.isawaitable(healthy):
+                healthy = await healthy
+            return bool(healthy)
+        try:
+            # idle connections should have nothing to read, since any
+            # bytes or end of stream mean that server has misbehaved or
+            # closed connection.
+            buffered_stream = _get_optional_attr(connection,
+                "buffered_readable_stream")
+            if buffered_stream is not None and \
+                    buffered_stream.buffered_byte_count:
+                return False
+            return not _is_readable_now(
+                self.transport.get_readable_stream(connection))
+        except Exception:
+            return False
+
+    async def _drain(self, body):
+        max_drain_size = self.max_drain_size
+        if not max_drain_size:
+            max_drain_size = io_utils_internal.DEFAULT_MAX_DRAIN_SIZE
+        drain_timeout_millis = self.drain_timeout_millis
+        if not drain_timeout_millis:
+            drain_timeout_millis = \
+                io_utils_internal.DEFAULT_DRAIN_TIMEOUT_MILLIS
+        try:
+            return await io_utils_internal.drain(body, max_drain_size,
+                                                 drain_timeout_millis)
+        except Exception:
+            return False
+
+    async def _discard(self, entry):
+        self._entries.pop(id(entry.connection), None)
+        self.stats.discarded += 1
+        try:
+            await self.transport.release_connection(entry.connection, None)
+        except Exception:
+            pass # ignore
+
+def _is_readable_now(stream):
+    sock = getattr(stream, "socket", None)
+    if sock is None or not hasattr(sock, "fileno"):
+        # can't tell without blocking.
+        return False
+    fd = sock.fileno()
+    if fd < 0:
+        # closed.
+        return True
+    if hasattr(select, "poll"):
+        # unlike select, poll isn't limited to descriptors
+        # below FD_SETSIZE.
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        return bool(poller.poll(0))
+    return bool(select.select([fd], [], [], 0)[0])
@@ -1,27 +1,226 @@
 import sys
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
 
+import trio
+
+from kabomu.abstractions import DefaultSendManyResult
 from kabomu.quasi_http_utils import _get_optional_attr, _bind_method
 from kabomu import protocol_utils_internal
 from kabomu.errors import MissingDependencyError,\
     QuasiHttpError,\
     QUASI_HTTP_ERROR_REASON_GENERAL
 
+DEFAULT_SEND_MANY_CONCURRENCY = 16
+
+_END_OF_ITEMS = object()
+
 class StandardQuasiHttpClient:
-    def __init__(self, transport=None):
+    # if hedging_policy is set, requests marked idempotent through
+    # send options get a duplicate sent along if their response headers
+    # are late, and the first response wins. requests given to send()
+    # are only hedged if they have no body, since bodies can't be sent
+    # twice; request_func of send2() is called once per attempt.
+
+    def __init__(self, transport=None, hedging_policy=None):
         self.transport = transport
+        self.hedging_policy = hedging_policy
 
     async def send(self, remote_endpoint, request, options=None):
         if not request:
             raise ValueError("request argument is null")
+        hedging_policy = self.hedging_policy
+        if hedging_policy and \
+                _get_optional_attr(options, "idempotent") and \
+                not _get_optional_attr(request, "body"):
+            return await self._send_hedged(hedging_policy,
+                remote_endpoint, request, None, options)
         return await self._send_internal(
             remote_endpoint, request, None, options)
 
     async def send2(self, remote_endpoint, request_func, options=None):
         if not request_func:
             raise ValueError("request_func argument is null")
+        hedging_policy = self.hedging_policy
+        if hedging_policy and _get_optional_attr(options, "idempotent"):
+            return await self._send_hedged(hedging_policy,
+                remote_endpoint, None, request_func, options)
         return await self._send_internal(
             remote_endpoint, None, request_func, options)
 
+    async def _send_hedged(self, hedging_policy, remote_endpoint,
+                           request, request_func, send_options):
+        hedging_policy._on_request()
+        attempts = []
+        outcome = SimpleNamespace(response=None, winner=None, error=None)
+        first_attempt_done = trio.Event()
+        async def attempt(endpoint, hedged):
+            cancel_scope = trio.CancelScope()
+            attempts.append(cancel_scope)
+            start_time = trio.current_time()
+            with cancel_scope:
+                try:
+                    response = await self._send_internal(endpoint,
+                        request, request_func, send_options)
+                except Exception as ex:
+                    if not cancel_scope.cancel_called and \
+                            outcome.error is None:
+                        outcome.error = ex
+                    return
+                finally:
+                    if not hedged:
+                        first_attempt_done.set()
+            if outcome.winner is not None or cancel_scope.cancel_called:
+                # lost race, so release response and its connection.
+                await _release_untaken(SimpleNamespace(response=response))
+                return
+            outcome.response = response
+            outcome.winner = cancel_scope
+            hedging_policy._on_response(
+                (trio.current_time() - start_time) * 1000, hedged)
+            for other in attempts:
+                if other is not cancel_scope:
+                    other.cancel()
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(attempt, remote_endpoint, False)
+            with trio.move_on_after(
+                    hedging_policy.get_delay_millis() / 1000.0):
+                await first_attempt_done.wait()
+            if not first_attempt_done.is_set() and \
+                    hedging_policy._try_hedge():
+                nursery.start_soon(attempt,
+                    hedging_policy.get_hedge_endpoint(remote_endpoint),
+                    True)
+        if outcome.winner is None:
+            raise outcome.error
+        return outcome.response
+
+    @asynccontextmanager
+    async def send_many(self, items, concurrency=None,
+                        per_endpoint_limit=None):
+        # sends requests of items concurrently, with at most
+        # concurrency of them (and at most per_endpoint_limit
+        # per remote endpoint, if set) in progress at any time.
+        # items can be a sync or async iterable of objects with
+        # remote_endpoint, options, and either request or
+        # request_func (as with send2()) attributes, and is only
+        # consumed as fast as in-progress requests complete, apart from
+        # up to concurrency items taken ahead while they wait for
+        # their endpoints.
+        # yields an async iterator of results in order of completion.
+        # a result counts as in progress until it is taken from the
+        # iterator, so that slow consumers slow down sending.
+        # failure of a request is reported in its result and doesn't
+        # affect others.
+        # leaving early cancels requests still in progress, and
+        # releases responses which were never taken.
+        if items is None:
+            raise ValueError("items argument is null")
+        if not concurrency or concurrency <= 0:
+            concurrency = DEFAULT_SEND_MANY_CONCURRENCY
+        send_channel, receive_channel = trio.open_memory_channel(0)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self._feed_send_many, nursery, items,
+                concurrency, per_endpoint_limit, send_channel)
+            try:
+                yield receive_channel
+            finally:
+                await receive_channel.aclose()
+                nursery.cancel_scope.cancel()
+
+    async def _feed_send_many(self, nursery, items, concurrency,
+                              per_endpoint_limit, send_channel):
+        # only take next item when there is room for it, so that
+        # items can be produced lazily (e.g. open files).
+        if hasattr(items, "__aiter__"):
+            iterator = items.__aiter__()
+            async def next_item():
+                try:
+                    return await iterator.__anext__()
+                except StopAsyncIteration:
+                    return _END_OF_ITEMS
+        else:
+            iterator = iter(items)
+            async def next_item():
+                return next(iterator, _END_OF_ITEMS)
+        semaphore = trio.Semaphore(concurrency)
+        if per_endpoint_limit and per_endpoint_limit > 0:
+            # items waiting for their endpoints mustn't take up room
+            # needed by items of other endpoints, so let up to
+            # concurrency items wait, apart from those in progress.
+            pending_semaphore = trio.Semaphore(concurrency)
+        else:
+            per_endpoint_limit = None
+            pending_semaphore = semaphore
+        endpoint_semaphores = {}
+        async with send_channel:
+            while True:
+                await pending_semaphore.acquire()
+                item = await next_item()
+                if item is _END_OF_ITEMS:
+                    pending_semaphore.release()
+                    break
+                endpoint_semaphore = None
+                if per_endpoint_limit:
+                    remote_endpoint = _get_optional_attr(item,
+                        "remote_endpoint")
+                    endpoint_semaphore = endpoint_semaphores.get(
+                        remote_endpoint)
+                    if endpoint_semaphore is None:
+                        endpoint_semaphore = trio.Semaphore(
+                            per_endpoint_limit)
+                        endpoint_semaphores[remote_endpoint] = \
+                            endpoint_semaphore
+                nursery.start_soon(self._send_many_item, item, semaphore,
+                    pending_semaphore, endpoint_semaphore,
+                    send_channel.clone())
+
+    async def _send_many_item(self, item, semaphore, pending_semaphore,
+                              endpoint_semaphore, send_channel):
+        if endpoint_semaphore:
+            # wait for endpoint before taking up room of others.
+            async with endpoint_semaphore:
+                try:
+                    await semaphore.acquire()
+                finally:
+                    pending_semaphore.release()
+                await self._send_many_item_in_slot(item, semaphore,
+                                                   send_channel)
+        else:
+            await self._send_many_item_in_slot(item, semaphore,
+                                               send_channel)
+
+    async def _send_many_item_in_slot(self, item, semaphore, send_channel):
+        try:
+            async with send_channel:
+                await self._deliver_send_many_result(item, send_channel)
+        finally:
+            semaphore.release()
+
+    async def _deliver_send_many_result(self, item, send_channel):
+        result = DefaultSendManyResult(item=item)
+        remote_endpoint = _get_optional_attr(item, "remote_endpoint")
+        options = _get_optional_attr(item, "options")
+        try:
+            request = _get_optional_attr(item, "request")
+            if request:
+                result.response = await self.send(remote_endpoint,
+                                                  request, options)
+            else:
+                result.response = await self.send2(remote_endpoint,
+                    _get_optional_attr(item, "request_func"), options)
+        except Exception as ex:
+            result.error = ex
+        try:
+            await send_channel.send(result)
+        except trio.BrokenResourceError:
+            # consumer has left.
+            await _release_untaken(result)
+        except:
+            await _release_untaken(result)
+            raise
+
     async def _send_internal(self,
             remote_endpoint, request, request_func,
             send_options):
@@ -40,16 +239,25 @@ class StandardQuasiHttpClient:
             if not connection:
                 raise QuasiHttpError("no connection")
 
+            exchange = SimpleNamespace(body_buffered=False)
             async def proc():
                 return await _process_send(
                     request, request_func,
-                    transport, connection)
+                    transport, connection, exchange)
             response = await protocol_utils_internal.run_timeout_scheduler(
                 connection, True, proc)
             if not response:
                 response = await _process_send(
-                    request, request_func, transport, connection)
-            await _abort(transport, connection, False, response)
+                    request, request_func, transport, connection,
+                    exchange)
+            if exchange.body_buffered:
+                # let transport release connection right away, as
+                # it would for a response without body.
+                await _abort(transport, connection, False,
+                    SimpleNamespace(status_code=response.status_code,
+                                    headers=response.headers))
+            else:
+                await _abort(transport, connection, False, response)
             return response
         except:
             #raise
@@ -64,7 +272,8 @@ class StandardQuasiHttpClient:
             abort_error.__cause__ = ex
             raise abort_error
 
-async def _process_send(request, request_func, transport, connection):
+async def _process_send(request, request_func, transport, connection,
+                        exchange):
     # wait for connection to be completely established.
     await transport.establish_connection(connection)
 
@@ -92,20 +301,50 @@ async def _process_send(request, request_func, transport, connection):
         response = await protocol_utils_internal.read_entity_from_transport(
             True, transport.get_readable_stream(connection),
             connection)
-        async def release_func(self):
-            await transport.release_connection(connection, None)
+        if response.body:
+            max_eager_response_body_size = _get_optional_attr(connection,
+                "processing_options", "max_eager_response_body_size")
+            if max_eager_response_body_size and \
+                    max_eager_response_body_size > 0:
+                exchange.body_buffered = \
+                    await protocol_utils_internal.buffer_response_body(
+                        response, max_eager_response_body_size)
+        if response.body and not exchange.body_buffered:
+            pending_connections = [connection]
+            async def release_func(self):
+                # release at most once, since transports may reuse
+                # released connections (e.g. connection pools).
+                if pending_connections:
+                    await transport.release_connection(
+                        pending_connections.pop(), None)
+        else:
+            async def release_func(self):
+                # connection gets released together with response.
+                pass
         response.release = _bind_method(
             release_func, response)
     return response
 
+async def _release_untaken(result):
+    response = result.response
+    if response:
+        with trio.CancelScope(shield=True):
+            try:
+                await response.release()
+            except:
+                pass # ignore
+
 async def _abort(transport, connection, error_occured, response=None):
     if error_occured:
-        try:
-            # don't wait
-            await transport.release_connection(
-                connection, None) # swallow errors
-        except:
-            pass # ignore
+        # shield, so that connections of cancelled sends
+        # (e.g. losers of hedged requests) still get released.
+        with trio.CancelScope(shield=True):
+            try:
+                # don't wait
+                await transport.release_connection(
+                    connection, None) # swallow errors
+            except:
+                pass # ignore
     else:
         await transport.release_connection(
                 connection, response)
@@ -1,7 +1,10 @@
 import sys
 
+import trio
+
 from kabomu.quasi_http_utils import _get_optional_attr
-from kabomu import protocol_utils_internal
+from kabomu import io_utils_internal, protocol_utils_internal,\
+    quasi_http_utils
 from kabomu.errors import MissingDependencyError,\
     QuasiHttpError,\
     QUASI_HTTP_ERROR_REASON_GENERAL
@@ -26,14 +29,21 @@ class StandardQuasiHttpServer:
             raise MissingDependencyError("server application")
 
         try:
-            async def proc():
-                await _process_accept(
-                    application, transport, connection)
-            processed = await protocol_utils_internal.run_timeout_scheduler(
-                connection, False, proc)
-            if not processed:
-                await _process_accept(application, transport,
-                                      connection)
+            request_count = 0
+            while True:
+                request_count += 1
+                keep_alive = False
+                async def proc():
+                    nonlocal keep_alive
+                    keep_alive = await _process_accept(
+                        application, transport, connection, request_count)
+                processed = await protocol_utils_internal.run_timeout_scheduler(
+                    connection, False, proc)
+                if not processed:
+                    await proc()
+                if not keep_alive or \
+                        not await _wait_for_next_request(transport, connection):
+                    break
             await transport.release_connection(connection)
         except:
             #raise
@@ -47,15 +57,40 @@ class StandardQuasiHttpServer:
             abort_error.__cause__ = ex
             raise abort_error
 
-async def _process_accept(application, transport, connection):
+async def _process_accept(application, transport, connection,
+                          request_count):
+    # returns whether connection can be used for another request.
     request = None
+    request_deserialized = False
     if hasattr(transport, "request_deserializer"):
         request = await transport.request_deserializer(connection)
+        request_deserialized = bool(request)
     if not request:
         request = await protocol_utils_internal.read_entity_from_transport(
             False, transport.get_readable_stream(connection),
             connection)
 
+    # keep connection alive for clients which ask for it, if
+    # processing options allow. check options first, so that
+    # headers are only decoded here if keep-alive is possible.
+    keep_alive = None
+    processing_options = _get_optional_attr(connection,
+        "processing_options")
+    if not request_deserialized and _get_optional_attr(processing_options,
+            "keep_alive_enabled"):
+        max_requests = _get_optional_attr(processing_options,
+            "max_requests_per_connection")
+        if max_requests and max_requests > 0 and \
+                request_count >= max_requests:
+            keep_alive = False
+        elif protocol_utils_internal.has_keep_alive_header(
+                _get_optional_attr(request, "headers")):
+            keep_alive = True
+    try:
+        connection.keep_alive = keep_alive
+    except AttributeError:
+        keep_alive = False
+
     response = await application.process_request(request)
     if not response:
         raise QuasiHttpError("no response")
@@ -73,6 +108,34 @@ async def _process_accept(application, transport, connection):
         if hasattr(response, "release"):
             await response.release()
 
+    if not keep_alive:
+        return False
+    # read away any request body left by application, so that
+    # next request can be read.
+    request_body = _get_optional_attr(request, "body")
+    if request_body:
+        return await io_utils_internal.drain(request_body,
+            io_utils_internal.DEFAULT_MAX_DRAIN_SIZE)
+    return True
+
+async def _wait_for_next_request(transport, connection):
+    # returns False if connection is closed or stays idle beyond
+    # timeout.
+    processing_options = _get_optional_attr(connection,
+        "processing_options")
+    idle_timeout_millis = _get_optional_attr(processing_options,
+        "keep_alive_idle_timeout_millis")
+    if not idle_timeout_millis:
+        idle_timeout_millis = \
+            quasi_http_utils.DEFAULT_KEEP_ALIVE_IDLE_TIMEOUT_MILLIS
+    readable_stream = protocol_utils_internal.get_buffered_readable_stream(
+        connection, transport.get_readable_stream(connection))
+    if idle_timeout_millis < 0:
+        return bool(await readable_stream.peek())
+    with trio.move_on_after(idle_timeout_millis / 1000.0):
+        return bool(await readable_stream.peek())
+    return False
+
 async def _abort(transport, connection, error_occured):
     if error_occured:
         try:
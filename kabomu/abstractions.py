@@ -1,4 +1,5 @@
 import abc
+from collections.abc import MutableMapping
 
 
 class IQuasiHttpAltTransport(metaclass=abc.ABCMeta):
@@ -62,11 +63,99 @@ class QuasiHttpProcessingOptions():
                  extra_connectivity_params=None,
                  timeout_millis=None,
                  max_headers_size=None,
-                 max_response_body_size=None):
+                 max_response_body_size=None,
+                 binary_headers_enabled=None,
+                 max_header_table_size=None,
+                 write_coalescing_threshold=None,
+                 body_copy_buffer_size=None,
+                 body_copy_pipeline_depth=None,
+                 keep_alive_enabled=None,
+                 keep_alive_idle_timeout_millis=None,
+                 max_requests_per_connection=None,
+                 idempotent=None,
+                 max_eager_response_body_size=None):
         self.extra_connectivity_params = extra_connectivity_params
         self.timeout_millis = timeout_millis
         self.max_headers_size = max_headers_size
         self.max_response_body_size = max_response_body_size
+        self.binary_headers_enabled = binary_headers_enabled
+        self.max_header_table_size = max_header_table_size
+        self.write_coalescing_threshold = write_coalescing_threshold
+        self.body_copy_buffer_size = body_copy_buffer_size
+        self.body_copy_pipeline_depth = body_copy_pipeline_depth
+        self.keep_alive_enabled = keep_alive_enabled
+        self.keep_alive_idle_timeout_millis = keep_alive_idle_timeout_millis
+        self.max_requests_per_connection = max_requests_per_connection
+        self.idempotent = idempotent
+        self.max_eager_response_body_size = max_eager_response_body_size
+
+
+class Headers(MutableMapping):
+    # maps lower-cased header names to lists of header values, and
+    # can defer the decoding of received headers until first access.
+
+    def __init__(self, entries=None, raw_rows=None, decoder=None):
+        self._entries = None
+        self._decoded_entries = None
+        self._raw_rows = None
+        self._decoder = None
+        if raw_rows is not None and decoder is not None:
+            self._raw_rows = raw_rows
+            self._decoder = decoder
+        else:
+            self._entries = {}
+        if entries:
+            self.update(entries)
+
+    def _get_entries(self):
+        entries = self._entries
+        if entries is None:
+            entries = self._decoder()
+            # keep a copy for detecting modifications made through
+            # header value lists.
+            self._decoded_entries = {
+                k: list(v) for k, v in entries.items()}
+            self._entries = entries
+        return entries
+
+    def get_raw_rows(self):
+        # returns the encoded header rows as received, provided the
+        # headers have not been modified since then.
+        raw_rows = self._raw_rows
+        if raw_rows is None:
+            return None
+        if self._entries is not None and \
+                self._entries != self._decoded_entries:
+            return None
+        return raw_rows
+
+    def _discard_raw_rows(self):
+        self._get_entries()
+        self._raw_rows = None
+        self._decoded_entries = None
+
+    def __getitem__(self, key):
+        return self._get_entries()[key]
+
+    def __setitem__(self, key, value):
+        self._discard_raw_rows()
+        self._entries[key] = value
+
+    def __delitem__(self, key):
+        self._discard_raw_rows()
+        del self._entries[key]
+
+    def __contains__(self, key):
+        return key in self._get_entries()
+
+    def __iter__(self):
+        return iter(self._get_entries())
+
+    def __len__(self):
+        return len(self._get_entries())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self._get_entries()!r})"
 
 
 class DefaultQuasiHttpRequest():
@@ -143,3 +232,23 @@ class DefaultTimeoutResult:
         self.response = response
         self.timeout = timeout
         self.error = error
+
+class DefaultSendManyItem:
+    def __init__(self,
+                 remote_endpoint=None,
+                 request=None,
+                 request_func=None,
+                 options=None):
+        self.remote_endpoint = remote_endpoint
+        self.request = request
+        self.request_func = request_func
+        self.options = options
+
+class DefaultSendManyResult:
+    def __init__(self,
+                 item=None,
+                 response=None,
+                 error=None):
+        self.item = item
+        self.response = response
+        self.error = error
@@ -0,0 +1,285 @@
+from collections import deque
+
+from kabomu import misc_utils_internal
+from kabomu.errors import ExpectationViolationError
+
+# Upper limit on dynamic table sizes which encoders can announce,
+# to bound memory which decoders commit to a connection.
+MAX_HEADER_TABLE_SIZE = 65_536
+
+# Overhead added to the byte count of the name and value of a table
+# entry, to arrive at the entry's size (same as in HPACK).
+TABLE_ENTRY_OVERHEAD = 32
+
+# Names of pseudo header fields which carry request line.
+REQUEST_LINE_FIELD_NAMES = (":method", ":target", ":version",
+                            ":content-length")
+
+# Names of pseudo header fields which carry status line.
+STATUS_LINE_FIELD_NAMES = (":version", ":status", ":message",
+                           ":content-length")
+
+STATIC_TABLE = (
+    (":method", "GET"),
+    (":method", "POST"),
+    (":method", "PUT"),
+    (":method", "DELETE"),
+    (":method", "HEAD"),
+    (":method", "OPTIONS"),
+    (":method", "PATCH"),
+    (":method", ""),
+    (":target", "/"),
+    (":target", ""),
+    (":version", "HTTP/1.1"),
+    (":version", "HTTP/1.0"),
+    (":version", ""),
+    (":status", "200"),
+    (":status", "204"),
+    (":status", "400"),
+    (":status", "401"),
+    (":status", "403"),
+    (":status", "404"),
+    (":status", "500"),
+    (":message", "OK"),
+    (":message", ""),
+    (":content-length", "0"),
+    (":content-length", "-1"),
+    ("accept", ""),
+    ("accept", "*/*"),
+    ("accept", "application/json"),
+    ("accept-charset", ""),
+    ("accept-encoding", ""),
+    ("accept-language", ""),
+    ("authorization", ""),
+    ("cache-control", ""),
+    ("cache-control", "no-cache"),
+    ("connection", ""),
+    ("connection", "keep-alive"),
+    ("content-encoding", ""),
+    ("content-type", ""),
+    ("content-type", "application/json"),
+    ("content-type", "application/octet-stream"),
+    ("content-type", "text/plain"),
+    ("cookie", ""),
+    ("date", ""),
+    ("etag", ""),
+    ("if-modified-since", ""),
+    ("if-none-match", ""),
+    ("last-modified", ""),
+    ("location", ""),
+    ("set-cookie", ""),
+    ("user-agent", ""),
+)
+
+_STATIC_TABLE_LEN = len(STATIC_TABLE)
+
+def _create_static_indices():
+    field_indices = {}
+    name_indices = {}
+    for i, field in enumerate(STATIC_TABLE):
+        field_indices.setdefault(field, i + 1)
+        name_indices.setdefault(field[0], i + 1)
+    return field_indices, name_indices
+
+_STATIC_FIELD_INDICES, _STATIC_NAME_INDICES = _create_static_indices()
+
+# pseudo header fields whose values are hardly ever repeated.
+_UNINDEXED_FIELD_NAMES = frozenset([":content-length"])
+
+class HeaderTable:
+    def __init__(self):
+        # newest entries come first.
+        self._entries = deque()
+        self._size = 0
+        self._max_size = 0
+        self._insert_count = 0
+        # for use by encoders: map fields and names to
+        # insertion numbers of their latest entries.
+        self._field_insertions = {}
+        self._name_insertions = {}
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_max_size(self, max_size):
+        self._max_size = max_size
+        self._evict(0)
+
+    def clear(self):
+        self._evict(self._max_size + 1)
+
+    def add(self, name, value):
+        entry_size = len(name) + len(value) + TABLE_ENTRY_OVERHEAD
+        if entry_size > self._max_size:
+            # entry can't fit, so table ends up empty.
+            self.clear()
+            return
+        self._evict(entry_size)
+        self._entries.appendleft((name, value))
+        self._size += entry_size
+        self._insert_count += 1
+        self._field_insertions[(name, value)] = self._insert_count
+        self._name_insertions[name] = self._insert_count
+
+    def _evict(self, space_needed):
+        while self._entries and self._size + space_needed > self._max_size:
+            insertion = self._insert_count - len(self._entries) + 1
+            name, value = self._entries.pop()
+            self._size -= len(name) + len(value) + TABLE_ENTRY_OVERHEAD
+            if self._field_insertions.get((name, value)) == insertion:
+                del self._field_insertions[(name, value)]
+            if self._name_insertions.get(name) == insertion:
+                del self._name_insertions[name]
+
+    def get(self, index):
+        # index is absolute, ie includes static table.
+        if index < 1:
+            raise ExpectationViolationError(f"invalid header index: {index}")
+        if index <= _STATIC_TABLE_LEN:
+            return STATIC_TABLE[index - 1]
+        index -= _STATIC_TABLE_LEN + 1
+        if index >= len(self._entries):
+            raise ExpectationViolationError(
+                f"invalid header index: {index + _STATIC_TABLE_LEN + 1}")
+        return self._entries[index]
+
+    def _to_index(self, insertion):
+        # convert insertion number to absolute index, if entry
+        # has not been evicted.
+        if insertion is None:
+            return 0
+        position = self._insert_count - insertion
+        if position >= len(self._entries):
+            return 0
+        return _STATIC_TABLE_LEN + position + 1
+
+    def find(self, name, value):
+        # returns absolute index of field, or negated absolute index of
+        # name only, or zero if neither is found.
+        index = _STATIC_FIELD_INDICES.get((name, value))
+        if index:
+            return index
+        index = self._to_index(self._field_insertions.get((name, value)))
+        if index:
+            return index
+        index = _STATIC_NAME_INDICES.get(name)
+        if not index:
+            index = self._to_index(self._name_insertions.get(name))
+        return -index
+
+class HeaderCompressionContext:
+    def __init__(self):
+        self.encoder_table = HeaderTable()
+        self.decoder_table = HeaderTable()
+
+def encode_integer(dest: bytearray, flags, prefix_bits, n):
+    max_prefix = (1 << prefix_bits) - 1
+    if n < max_prefix:
+        dest.append(flags | n)
+        return
+    dest.append(flags | max_prefix)
+    n -= max_prefix
+    while n >= 0x80:
+        dest.append((n & 0x7f) | 0x80)
+        n >>= 7
+    dest.append(n)
+
+def decode_integer(data, offset, prefix_bits):
+    max_prefix = (1 << prefix_bits) - 1
+    n = data[offset] & max_prefix
+    offset += 1
+    if n < max_prefix:
+        return n, offset
+    shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        n += (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, offset
+        shift += 7
+        if shift > 28:
+            raise ExpectationViolationError("integer overflow")
+
+def _encode_string(dest: bytearray, s):
+    encoded = misc_utils_internal.string_to_bytes(s)
+    encode_integer(dest, 0, 7, len(encoded))
+    dest.extend(encoded)
+
+def _decode_string(data, offset):
+    n, offset = decode_integer(data, offset, 7)
+    end_offset = offset + n
+    if end_offset > len(data):
+        raise ExpectationViolationError("string exceeds data")
+    return misc_utils_internal.bytes_to_string(
+        data[offset:end_offset]), end_offset
+
+def encode_header_fields(table: HeaderTable, fields):
+    # fields are (name, value) pairs of strings.
+    # representations follow HPACK, without Huffman coding:
+    #  1xxxxxxx - indexed field
+    #  01xxxxxx - literal field, to be added to dynamic table
+    #  001xxxxx - dynamic table size update
+    #  0000xxxx - literal field, not to be added to dynamic table
+    encoded = bytearray()
+    # always start with table size, so that a decoder can keep in sync
+    # regardless of where it missed earlier blocks.
+    encode_integer(encoded, 0x20, 5, table.max_size)
+    for name, value in fields:
+        index = table.find(name, value)
+        if index > 0:
+            encode_integer(encoded, 0x80, 7, index)
+            continue
+        if name in _UNINDEXED_FIELD_NAMES:
+            encode_integer(encoded, 0, 4, -index)
+        else:
+            encode_integer(encoded, 0x40, 6, -index)
+            table.add(name, value)
+        if not index:
+            _encode_string(encoded, name)
+        _encode_string(encoded, value)
+    return encoded
+
+def decode_header_fields(table: HeaderTable, data, max_decoded_size):
+    fields = []
+    decoded_size = 0
+    offset = 0
+    data_len = len(data)
+    while offset < data_len:
+        b = data[offset]
+        if b & 0x80:
+            index, offset = decode_integer(data, offset, 7)
+            name, value = table.get(index)
+        elif b & 0x40 or not b & 0x20:
+            indexing = b & 0x40
+            index, offset = decode_integer(data, offset,
+                                           6 if indexing else 4)
+            if index:
+                name = table.get(index)[0]
+            else:
+                name, offset = _decode_string(data, offset)
+            value, offset = _decode_string(data, offset)
+            if indexing:
+                table.add(name, value)
+        else:
+            max_size, offset = decode_integer(data, offset, 5)
+            if max_size > MAX_HEADER_TABLE_SIZE:
+                raise ExpectationViolationError(
+                    f"header table size exceeds limit: {max_size}")
+            table.set_max_size(max_size)
+            continue
+        decoded_size += len(name) + len(value)
+        if decoded_size > max_decoded_size:
+            raise ExpectationViolationError(
+                "decoded header fields exceed max size " +
+                f"of {max_decoded_size}")
+        fields.append((name, value))
+    return fields
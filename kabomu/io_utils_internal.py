@@ -1,51 +1,576 @@
+import errno
+import functools
+import mmap
+import os
+import stat
+
+import trio
+from trio.abc import ReceiveStream
+
 from kabomu.errors import KabomuIOError
 
 DEFAULT_READ_BUFFER_SIZE = 8192
 
+# Size of buffer reused by copy for streams which can be read
+# into buffers.
+DEFAULT_COPY_BUFFER_SIZE = 65_536
+
+# Number of buffers in flight between reader and writer of
+# copy_pipelined.
+DEFAULT_COPY_PIPELINE_DEPTH = 2
+
+# Total size up to which buffers are joined into one, rather than sent
+# out with scatter/gather writes.
+GATHER_WRITE_JOIN_THRESHOLD = 16_384
+
+# Maximum number of bytes which copy_file hands to each send_file call.
+DEFAULT_SEND_FILE_CHUNK_SIZE = 1_048_576
+
+# Maximum number of unread body bytes which will be read away for
+# connections to be reused.
+DEFAULT_MAX_DRAIN_SIZE = 65_536
+
+# Time within which unread body bytes have to be read away for
+# connections to be reused.
+DEFAULT_DRAIN_TIMEOUT_MILLIS = 5_000
+
+_CLOSED_SOCKET_ERRNOS = tuple(getattr(errno, n)
+                              for n in ("EBADF", "ENOTSOCK")
+                              if hasattr(errno, n))
+
+async def _read_from_file(stream, max_bytes=None):
+    if not max_bytes or max_bytes < 1:
+        max_bytes = DEFAULT_READ_BUFFER_SIZE
+    next_chunk = await stream.read(max_bytes)
+    assert next_chunk is not None
+    return next_chunk
+
+async def _write_to_file(stream, data):
+    # cause error if write returns None
+    bytes_written = int(await stream.write(data))
+    if bytes_written >= len(data):
+        return
+    # slice remainder with memoryview, to avoid copying it on each
+    # short write.
+    with memoryview(data).cast("B") as view:
+        while bytes_written < len(view):
+            bytes_written += int(await stream.write(view[bytes_written:]))
+
+async def _receive_some_into_by_copying(stream, buffer):
+    next_chunk = await receive_some(stream, len(buffer))
+    next_chunk_len = len(next_chunk)
+    buffer[:next_chunk_len] = next_chunk
+    return next_chunk_len
+
 async def receive_some(stream, max_bytes=None):
-    src_is_file = hasattr(stream, "read")
-    if src_is_file:
-        if not max_bytes or max_bytes < 1:
-            max_bytes = DEFAULT_READ_BUFFER_SIZE
-        next_chunk = await stream.read(max_bytes)
-    else:
-        next_chunk = await stream.receive_some(max_bytes)
+    if hasattr(stream, "read"):
+        return await _read_from_file(stream, max_bytes)
+    next_chunk = await stream.receive_some(max_bytes)
     assert next_chunk is not None
     return next_chunk
 
+def _get_receive_some_into(stream):
+    # returns function for reading into buffers natively, or None if
+    # stream can only be read into buffers by copying.
+    if hasattr(stream, "receive_some_into"):
+        return stream.receive_some_into
+    if hasattr(stream, "readinto"):
+        return stream.readinto
+    if isinstance(stream, trio.SocketStream):
+        # only for this type, since other streams with sockets
+        # (e.g. wrappers) may do more in receive_some.
+        return functools.partial(_receive_some_into_socket_stream, stream)
+    return None
+
+async def _receive_some_into_socket_stream(stream, buffer):
+    # reads from socket of stream directly, reporting failures
+    # the way receive_some of trio.SocketStream does.
+    try:
+        return await stream.socket.recv_into(buffer)
+    except OSError as ex:
+        raise _translate_socket_error(ex)
+
+def _translate_socket_error(ex):
+    # returns error which trio.SocketStream would raise in place of ex.
+    if ex.errno in _CLOSED_SOCKET_ERRNOS:
+        error = trio.ClosedResourceError("this socket was already closed")
+        error.__suppress_context__ = True
+        return error
+    error = trio.BrokenResourceError(f"socket connection broken: {ex}")
+    error.__cause__ = ex
+    return error
+
+def _supports_receive_some_into(stream):
+    return _get_receive_some_into(stream) is not None
+
+async def receive_some_into(stream, buffer):
+    # reads into buffer, and returns number of bytes read,
+    # with zero meaning end of stream.
+    buffer = memoryview(buffer)
+    if not len(buffer):
+        return 0
+    native_receive_some_into = _get_receive_some_into(stream)
+    if native_receive_some_into is not None:
+        return int(await native_receive_some_into(buffer))
+    # fall back to copying.
+    return await _receive_some_into_by_copying(stream, buffer)
+
 async def send_all(stream, data):
-    dest_is_file = hasattr(stream, "write")
-    if dest_is_file:
-        next_chunk_len = len(data)
-        bytes_written = 0
-        while bytes_written < next_chunk_len:
-            # cause error if write returns None
-            if bytes_written == 0:
-                bytes_written += int(await stream.write(
-                    data))
-            else:
-                bytes_written += int(await stream.write(
-                    data[bytes_written:]))
+    if hasattr(stream, "write"):
+        await _write_to_file(stream, data)
     else:
         await stream.send_all(data)
 
+class StreamAdapter:
+    # resolves once how a stream is to be read from and written to,
+    # so that loops over many chunks skip repeated attribute checks.
+    # receive_some_into expects non-empty buffers.
+    __slots__ = ("stream", "receive_some", "receive_some_into",
+                 "send_all", "supports_receive_some_into")
+
+    def __init__(self, stream):
+        self.stream = stream
+        if hasattr(stream, "read"):
+            self.receive_some = functools.partial(_read_from_file, stream)
+        else:
+            self.receive_some = getattr(stream, "receive_some", None)
+        native_receive_some_into = _get_receive_some_into(stream)
+        self.supports_receive_some_into = native_receive_some_into is not None
+        if native_receive_some_into is not None:
+            self.receive_some_into = native_receive_some_into
+        else:
+            self.receive_some_into = functools.partial(
+                _receive_some_into_by_copying, stream)
+        if hasattr(stream, "write"):
+            self.send_all = functools.partial(_write_to_file, stream)
+        else:
+            self.send_all = getattr(stream, "send_all", None)
+
+def create_stream_adapter(stream):
+    if isinstance(stream, StreamAdapter):
+        return stream
+    return StreamAdapter(stream)
+
+async def send_all_gathered(stream, buffers):
+    # sends out buffers with as few writes as possible.
+    total_len = sum(len(b) for b in buffers)
+    if total_len <= GATHER_WRITE_JOIN_THRESHOLD:
+        await send_all(stream, b"".join(buffers))
+        return
+    # only for trio.SocketStream, since other streams with sockets
+    # (e.g. wrappers) may do more in send_all.
+    if not isinstance(stream, trio.SocketStream) or \
+            not hasattr(stream.socket, "sendmsg"):
+        for b in buffers:
+            await send_all(stream, b)
+        return
+    # avoid copying large buffers by passing them all to sendmsg,
+    # and resume from where partial sends end.
+    sock = stream.socket
+    views = [memoryview(b).cast("B") for b in buffers if len(b)]
+    while views:
+        try:
+            bytes_sent = await sock.sendmsg(views)
+        except OSError as ex:
+            raise _translate_socket_error(ex)
+        while views and bytes_sent >= len(views[0]):
+            bytes_sent -= len(views[0])
+            views.pop(0)
+        if bytes_sent:
+            views[0] = views[0][bytes_sent:]
+
+def get_send_file_source(stream):
+    # returns the regular file object wrapped by stream (e.g. by
+    # trio's async files), if its data can be sent with os.sendfile.
+    # returns None otherwise.
+    if not hasattr(os, "sendfile"):
+        return None
+    file = getattr(stream, "wrapped", None)
+    if file is None or hasattr(file, "encoding"):
+        # skip text files.
+        return None
+    if not (hasattr(file, "fileno") and hasattr(file, "tell") and
+            hasattr(file, "seek") and hasattr(file, "readable")):
+        return None
+    try:
+        if not file.readable():
+            return None
+        if not stat.S_ISREG(os.fstat(file.fileno()).st_mode):
+            return None
+    except (OSError, ValueError):
+        return None
+    return file
+
+def _get_send_file_socket(stream):
+    # only for trio.SocketStream, since other streams with sockets
+    # (e.g. wrappers) may do more in send_all.
+    if not isinstance(stream, trio.SocketStream):
+        return None
+    sock = stream.socket
+    if not hasattr(sock, "fileno"):
+        return None
+    return sock
+
+def supports_send_file(stream):
+    # streams which frame data (e.g. tlv encoding streams) can opt in
+    # by implementing supports_send_file() and send_file().
+    if hasattr(stream, "supports_send_file"):
+        return bool(stream.supports_send_file())
+    return hasattr(os, "sendfile") and \
+        _get_send_file_socket(stream) is not None
+
+async def send_file(stream, file, count):
+    # sends up to count bytes of file, starting from its current
+    # position, and moves the position past the bytes sent.
+    # returns number of bytes sent, which is less than count only
+    # at end of file.
+    if hasattr(stream, "send_file"):
+        return int(await stream.send_file(file, count))
+    sock = _get_send_file_socket(stream)
+    in_fd = file.fileno()
+    out_fd = sock.fileno()
+    offset = file.tell()
+    bytes_sent = 0
+    try:
+        while bytes_sent < count:
+            await trio.lowlevel.checkpoint()
+            try:
+                next_sent = os.sendfile(out_fd, in_fd, offset + bytes_sent,
+                    count - bytes_sent)
+            except BlockingIOError:
+                await trio.lowlevel.wait_writable(out_fd)
+                continue
+            except OSError as ex:
+                raise _translate_socket_error(ex)
+            if not next_sent:
+                break
+            bytes_sent += next_sent
+    finally:
+        # keep file object (and any read buffer of it) in sync.
+        file.seek(offset + bytes_sent)
+    return bytes_sent
+
+async def copy_file(file, dest, chunk_size=None):
+    # copies file from its current position to its end, with the data
+    # going from page cache to dest socket without passing through
+    # user space.
+    if not chunk_size or chunk_size < 1:
+        chunk_size = DEFAULT_SEND_FILE_CHUNK_SIZE
+    while True:
+        count = min(chunk_size, os.fstat(file.fileno()).st_size - file.tell())
+        if count <= 0:
+            break
+        if await send_file(dest, file, count) < count:
+            # file got truncated.
+            break
+
 async def read_bytes_fully(stream, count: int):
-    raw_data = bytearray()
-    bytes_left = int(count)
-    while bytes_left:
-        next_chunk = await receive_some(stream, bytes_left)
-        next_chunk_len = len(next_chunk)
-        if not next_chunk_len:
-            raise KabomuIOError.create_end_of_read_error()
-        raw_data.extend(next_chunk)
-        bytes_left -= next_chunk_len
+    raw_data = bytearray(int(count))
+    src_receive_some_into = create_stream_adapter(stream).receive_some_into
+    with memoryview(raw_data) as view:
+        bytes_read = 0
+        while bytes_read < len(raw_data):
+            next_chunk_len = await src_receive_some_into(view[bytes_read:])
+            if not next_chunk_len:
+                raise KabomuIOError.create_end_of_read_error()
+            bytes_read += next_chunk_len
     return raw_data
 
-
-async def copy(src, dest):
+async def read_all_bytes(stream):
+    # for use when total size is unknown: collect chunks and join them
+    # once at the end, rather than growing a buffer chunk by chunk.
+    chunks = []
+    src_receive_some = create_stream_adapter(stream).receive_some
     while True:
-        next_chunk = await receive_some(src)
-        next_chunk_len = len(next_chunk)
-        if not next_chunk_len:
+        next_chunk = await src_receive_some()
+        if not next_chunk:
             break
-        await send_all(dest, next_chunk)
+        chunks.append(next_chunk)
+    return bytearray().join(chunks)
+
+async def read_up_to(stream, max_size):
+    # reads until end of stream or until max_size bytes have been read,
+    # whichever comes first.
+    chunks = []
+    total = 0
+    while total < max_size:
+        chunk = await receive_some(stream, max_size - total)
+        if not chunk:
+            break
+        chunks.append(bytes(chunk))
+        total += len(chunk)
+    return b"".join(chunks)
+
+async def drain(stream, max_size, timeout_millis=None):
+    # reads away remainder of stream, and returns True if its end is
+    # reached within max_size bytes (and within timeout_millis, if
+    # positive).
+    if timeout_millis and timeout_millis > 0:
+        with trio.move_on_after(timeout_millis / 1000.0):
+            return await drain(stream, max_size)
+        return False
+    src_receive_some = create_stream_adapter(stream).receive_some
+    bytes_drained = 0
+    while bytes_drained <= max_size:
+        next_chunk = await src_receive_some(max_size + 1 - bytes_drained)
+        if not next_chunk:
+            return True
+        bytes_drained += len(next_chunk)
+    return False
+
+async def copy(src, dest, buffer_size=None):
+    if not buffer_size or buffer_size < 1:
+        buffer_size = DEFAULT_COPY_BUFFER_SIZE
+    src = create_stream_adapter(src)
+    dest_send_all = create_stream_adapter(dest).send_all
+    if not src.supports_receive_some_into:
+        src_receive_some = src.receive_some
+        while True:
+            next_chunk = await src_receive_some()
+            if not next_chunk:
+                break
+            await dest_send_all(next_chunk)
+        return
+    src_receive_some_into = src.receive_some_into
+    # reuse one buffer for all chunks, which is safe since
+    # writes are done with data once send_all returns.
+    read_buffer = bytearray(buffer_size)
+    with memoryview(read_buffer) as view:
+        while True:
+            next_chunk_len = await src_receive_some_into(view)
+            if not next_chunk_len:
+                break
+            await dest_send_all(view[:next_chunk_len])
+
+async def copy_pipelined(src, dest, buffer_size=None, depth=None):
+    # overlaps reads from src with writes to dest, by running them in
+    # separate tasks connected by a bounded channel, so that the next
+    # chunk is read while the previous one is being written.
+    if not buffer_size or buffer_size < 1:
+        buffer_size = DEFAULT_COPY_BUFFER_SIZE
+    if not depth or depth < 1:
+        depth = DEFAULT_COPY_PIPELINE_DEPTH
+    src = create_stream_adapter(src)
+    dest = create_stream_adapter(dest)
+    reuse_buffers = src.supports_receive_some_into
+    filled_send, filled_receive = trio.open_memory_channel(depth)
+    # written buffers are sent back to reader for reuse.
+    free_send, free_receive = trio.open_memory_channel(depth)
+    if reuse_buffers:
+        for _ in range(depth):
+            free_send.send_nowait(bytearray(buffer_size))
+
+    async def read_chunks():
+        async with filled_send:
+            while True:
+                if reuse_buffers:
+                    read_buffer = await free_receive.receive()
+                    next_chunk_len = await src.receive_some_into(
+                        read_buffer)
+                else:
+                    read_buffer = await src.receive_some(buffer_size)
+                    next_chunk_len = len(read_buffer)
+                if not next_chunk_len:
+                    break
+                await filled_send.send((read_buffer, next_chunk_len))
+
+    async def write_chunks():
+        async with filled_receive:
+            async for read_buffer, next_chunk_len in filled_receive:
+                if next_chunk_len == len(read_buffer):
+                    await dest.send_all(read_buffer)
+                else:
+                    with memoryview(read_buffer) as view:
+                        await dest.send_all(view[:next_chunk_len])
+                if reuse_buffers:
+                    free_send.send_nowait(read_buffer)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(read_chunks)
+        nursery.start_soon(write_chunks)
+
+class BufferedReadableStream(ReceiveStream):
+    __slots__ = ("_backing_stream", "_backing_adapter", "_buffer_size",
+                 "_buffer", "_buffer_offset")
+
+    def __init__(self, backing_stream,
+                 buffer_size=DEFAULT_READ_BUFFER_SIZE):
+        super().__init__()
+        self._backing_stream = backing_stream
+        self._backing_adapter = create_stream_adapter(backing_stream)
+        self._buffer_size = buffer_size
+        self._buffer = b""
+        self._buffer_offset = 0
+
+    @property
+    def backing_stream(self):
+        return self._backing_stream
+
+    @property
+    def buffered_byte_count(self):
+        return len(self._buffer) - self._buffer_offset
+
+    async def peek(self):
+        # returns buffered bytes without consuming them,
+        # and fills buffer first if it is empty.
+        # empty result means end of backing stream.
+        if not self.buffered_byte_count:
+            await self._fill()
+        return self._buffer[self._buffer_offset:]
+
+    async def receive_some(self, max_bytes=None):
+        if max_bytes is not None:
+            max_bytes = int(max_bytes)
+        if not self.buffered_byte_count:
+            # let large reads bypass buffer, to avoid copying.
+            if max_bytes and max_bytes >= self._buffer_size:
+                return await self._backing_adapter.receive_some(max_bytes)
+            await self._fill()
+        start = self._buffer_offset
+        end = len(self._buffer)
+        if max_bytes and start + max_bytes < end:
+            end = start + max_bytes
+        self._buffer_offset = end
+        if not start and end == len(self._buffer):
+            return self._buffer
+        return self._buffer[start:end]
+
+    async def receive_some_into(self, buffer):
+        buffer = memoryview(buffer)
+        if not self.buffered_byte_count:
+            # let large reads bypass buffer, to avoid copying.
+            if len(buffer) >= self._buffer_size:
+                return await self._backing_adapter.receive_some_into(buffer)
+            await self._fill()
+        start = self._buffer_offset
+        end = min(len(self._buffer), start + len(buffer))
+        buffer[:end - start] = self._buffer[start:end]
+        self._buffer_offset = end
+        return end - start
+
+    async def _fill(self):
+        self._buffer = bytes(await self._backing_adapter.receive_some(
+            self._buffer_size))
+        self._buffer_offset = 0
+
+    async def aclose(self):
+        pass
+
+def create_buffered_readable_stream(backing_stream,
+                                    buffer_size=DEFAULT_READ_BUFFER_SIZE):
+    return BufferedReadableStream(backing_stream, buffer_size)
+
+class BytesReadableStream(ReceiveStream):
+    # serves bytes held in memory, followed by contents of rest
+    # if given.
+    __slots__ = ("_view", "_offset", "_rest")
+
+    def __init__(self, data, rest=None):
+        super().__init__()
+        self._view = memoryview(data)
+        self._offset = 0
+        self._rest = rest
+
+    @property
+    def content_length(self):
+        # number of bytes left to be read, if known.
+        if self._rest is not None:
+            return None
+        return len(self._view) - self._offset
+
+    async def receive_some(self, max_bytes=None):
+        start = self._offset
+        if start == len(self._view) and self._rest is not None:
+            return await receive_some(self._rest, max_bytes)
+        end = len(self._view)
+        if max_bytes and start + int(max_bytes) < end:
+            end = start + int(max_bytes)
+        self._offset = end
+        return bytes(self._view[start:end])
+
+    async def receive_some_into(self, buffer):
+        start = self._offset
+        if start == len(self._view) and self._rest is not None:
+            return await receive_some_into(self._rest, buffer)
+        buffer = memoryview(buffer)
+        end = min(len(self._view), start + len(buffer))
+        buffer[:end - start] = self._view[start:end]
+        self._offset = end
+        return end - start
+
+    async def aclose(self):
+        self._offset = len(self._view)
+        if self._rest is not None:
+            await self._rest.aclose()
+
+def create_bytes_readable_stream(data, rest=None):
+    return BytesReadableStream(data, rest)
+
+class MemoryMappedReadableStream(ReceiveStream):
+    __slots__ = ("_mapping", "_view", "_offset")
+
+    def __init__(self, file, offset=0, length=None):
+        super().__init__()
+        fd = file if isinstance(file, int) else file.fileno()
+        offset = int(offset)
+        if offset < 0:
+            raise ValueError(f"invalid offset: {offset}")
+        if length is None:
+            length = max(os.fstat(fd).st_size - offset, 0)
+        length = int(length)
+        if length < 0:
+            raise ValueError(f"invalid length: {length}")
+        self._mapping = None
+        self._offset = 0
+        if not length:
+            self._view = memoryview(b"")
+            return
+        # mappings must start at multiples of allocation granularity.
+        map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._mapping = mmap.mmap(fd, offset - map_offset + length,
+            access=mmap.ACCESS_READ, offset=map_offset)
+        self._view = memoryview(self._mapping)[offset - map_offset:]
+
+    @property
+    def content_length(self):
+        # number of bytes left to be read.
+        return len(self._view) - self._offset
+
+    async def receive_some(self, max_bytes=None):
+        # return slices of the mapping, rather than copies.
+        # receive_some_into is deliberately not provided, so that copy
+        # does not copy mapped data into buffers.
+        if not max_bytes or max_bytes < 1:
+            max_bytes = DEFAULT_SEND_FILE_CHUNK_SIZE
+        start = self._offset
+        end = min(start + int(max_bytes), len(self._view))
+        self._offset = end
+        return self._view[start:end]
+
+    async def aclose(self):
+        if self._mapping is None:
+            self._offset = len(self._view)
+            return
+        self._view.release()
+        self._view = memoryview(b"")
+        self._offset = 0
+        try:
+            self._mapping.close()
+        except BufferError:
+            # slices given out are still in use, so leave mapping to be
+            # unmapped when they are garbage collected.
+            pass
+        self._mapping = None
+
+def is_in_memory_stream(stream):
+    # tells whether rest of stream is held in memory, and hence can
+    # be read without waiting on anything.
+    if isinstance(stream, MemoryMappedReadableStream):
+        return True
+    return isinstance(stream, BytesReadableStream) and \
+        stream.content_length is not None
+
+def create_memory_mapped_readable_stream(file, offset=0, length=None):
+    # file can be a file descriptor or an object with a fileno() method,
+    # such as a trio async file.
+    return MemoryMappedReadableStream(file, offset, length)
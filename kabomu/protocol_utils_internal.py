@@ -1,13 +1,17 @@
 import csv
 import io
+import itertools
+import re
+import struct
 
 from trio.abc import ReceiveStream, SendStream
 
 from kabomu.abstractions import DefaultQuasiHttpResponse,\
-    DefaultQuasiHttpRequest
+    DefaultQuasiHttpRequest, Headers
 from kabomu.quasi_http_utils import _get_optional_attr
 from kabomu.tlv import tlv_utils
 from kabomu import misc_utils_internal, io_utils_internal, quasi_http_utils
+from kabomu import header_compression_utils_internal
 from kabomu.errors import IllegalArgumentError, ExpectationViolationError,\
     MissingDependencyError,\
     QuasiHttpError,\
@@ -80,79 +84,565 @@ def validate_http_header_section(is_response, csv_data):
                         "non-printable ASCII characters: " +
                         header_value)
 
+_HEADER_NAME_PATTERN = re.compile("[0-9A-Za-z-]*")
+
+# content length.
+_BINARY_REQUEST_LINE_STRUCT = struct.Struct(">q")
+
+# status code and content length.
+_BINARY_STATUS_LINE_STRUCT = struct.Struct(">iq")
+
+_BINARY_COUNT_STRUCT = struct.Struct(">H")
+
+_MAX_BINARY_COUNT = 0xffff
+
+# matches header rows which encode_quasi_http_headers could have written.
+_RAW_HEADER_ROWS_PATTERN = re.compile(
+    b'(?:"[0-9A-Za-z-]+"(?:,"(?:[ !#-~]|"")+")+\n)*')
+
 def contains_only_header_name_chars(v):
-    for c in v:
-        c = ord(c)
-        if c >= 48 and c < 58:
-            # digits.
-            pass
-        elif c >= 65 and c < 91:
-            # upper case
-            pass
-        elif c >= 97 and c < 123:
-            # lower case
-            pass
-        elif c == 45:
-            # hyphen
-            pass
-        else:
-            return False
-    return True
+    # digits, English alphabets and hyphen.
+    return _HEADER_NAME_PATTERN.fullmatch(v) is not None
 
 def contains_only_printable_ascii_chars(v, allow_space):
-    for c in v:
-        c = ord(c)
-        if c < 32 or c > 126:
-            return False
-        if not allow_space and c == 32:
-            return False
+    # within the ASCII range, only characters from 32 to 126
+    # are printable.
+    if not v.isascii() or not v.isprintable():
+        return False
+    if not allow_space and " " in v:
+        return False
     return True
 
-def encode_quasi_http_headers(is_response, req_or_status_line,
-                              remaining_headers):
+def _quote_csv_field(v):
+    if '"' in v:
+        v = v.replace('"', '""')
+    return '"' + v + '"'
+
+def _ensure_headers_within_size(headers_size, max_headers_size):
+    if max_headers_size and headers_size > max_headers_size:
+        msg_suffix = f"{headers_size} > {max_headers_size}"
+        raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_MESSAGE_LENGTH_LIMIT_EXCEEDED,
+            f"quasi http headers exceed max size ({msg_suffix})")
+
+def _validate_req_or_status_line(is_response, req_or_status_line):
+    # returns fields of request or status line as strings, after
+    # validating them.
     if not req_or_status_line:
         raise IllegalArgumentError("req_or_status_line argument is null")
-    csv_data = []
-    special_header = []
-    for v in req_or_status_line:
-        special_header.append('' if v is None else str(v))
-    csv_data.append(special_header)
-    if remaining_headers:
-        for header_name, header_value in remaining_headers.items():
-            header_name = '' if header_name is None else str(header_name)
-            if not header_name:
-                raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
-                    "quasi http header name cannot be empty")
-            # allow string values not inside an array.
-            if type(header_value) == str:
-                header_value = [header_value]
-            if header_value is None or not len(header_value):
-                continue
-            header_row = [header_name]
-            for v in header_value:
+    if len(req_or_status_line) != 4:
+        raise ExpectationViolationError(
+            "expected special header to have 4 values " +
+            f"instead of {len(req_or_status_line)}")
+    error_tag = "status" if is_response else "request"
+    fields = []
+    for i, v in enumerate(req_or_status_line):
+        v = '' if v is None else str(v)
+        if not contains_only_printable_ascii_chars(
+                v, is_response and i == 2):
+            raise QuasiHttpError(
+                QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+                    f"quasi http {error_tag} line " +
+                    "field contains spaces, newlines or " +
+                    "non-printable ASCII characters: " +
+                    v)
+        fields.append(v)
+    return fields
+
+def _iter_validated_header_rows(remaining_headers):
+    # yields names of headers with lists of their values as strings,
+    # after validating them, and skips headers without values.
+    # shared by all header encoders, so that they accept the
+    # same headers.
+    if not remaining_headers:
+        return
+    for header_name, header_value in remaining_headers.items():
+        header_name = '' if header_name is None else str(header_name)
+        if not header_name:
+            raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+                "quasi http header name cannot be empty")
+        # allow string values not inside an array.
+        if type(header_value) == str:
+            header_value = [header_value]
+        if header_value is None or not len(header_value):
+            continue
+        if not contains_only_header_name_chars(header_name):
+            raise QuasiHttpError(
+                QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+                    "quasi http header name contains characters " +
+                    "other than hyphen and English alphabets: " +
+                    header_name)
+        values = []
+        for v in header_value:
+            if type(v) != str:
                 v = "" if v is None else str(v)
-                if not v:
-                    raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
-                        "quasi http header value cannot be empty")
-                header_row.append(v)
-            csv_data.append(header_row)
-
-    validate_http_header_section(is_response, csv_data)
-
-    with io.StringIO(newline='') as serialized:
-        for row in csv_data:
-            add_comma = False
-            for col in row:
-                if add_comma:
-                    serialized.write(',')
-                serialized.write('"' + col.replace('"', '""') + '"')
-                add_comma = True
-            serialized.write('\n')
+            if not v:
+                raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+                    "quasi http header value cannot be empty")
+            # inline equivalent of
+            # contains_only_printable_ascii_chars(v, True)
+            if not v.isascii() or not v.isprintable():
+                raise QuasiHttpError(
+                    QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+                        "quasi http header value contains newlines or " +
+                        "non-printable ASCII characters: " +
+                        v)
+            values.append(v)
+        yield header_name, values
+
+def encode_quasi_http_headers(is_response, req_or_status_line,
+                              remaining_headers, max_headers_size=None):
+    # validated fields consist of ASCII characters only, so that
+    # character counts equal byte counts.
+    row = [_quote_csv_field(v) for v in _validate_req_or_status_line(
+        is_response, req_or_status_line)]
+    serialized_rows = [",".join(row)]
+    headers_size = len(serialized_rows[0]) + 1
+    _ensure_headers_within_size(headers_size, max_headers_size)
+
+    raw_rows = None
+    if isinstance(remaining_headers, Headers):
+        raw_rows = remaining_headers.get_raw_rows()
+    if raw_rows is not None and \
+            _RAW_HEADER_ROWS_PATTERN.fullmatch(raw_rows):
+        # forward received headers without re-encoding them.
+        headers_size += len(raw_rows)
+        _ensure_headers_within_size(headers_size, max_headers_size)
+        serialized_rows.append("")
         return misc_utils_internal.string_to_bytes(
-            serialized.getvalue())
+            "\n".join(serialized_rows)) + raw_rows
+    for header_name, header_value in _iter_validated_header_rows(
+            remaining_headers):
+        row = ['"' + header_name + '"']
+        for v in header_value:
+            if '"' in v:
+                v = v.replace('"', '""')
+            row.append('"' + v + '"')
+        serialized_row = ",".join(row)
+        serialized_rows.append(serialized_row)
+        headers_size += len(serialized_row) + 1
+        _ensure_headers_within_size(headers_size, max_headers_size)
+
+    serialized_rows.append("")
+    return misc_utils_internal.string_to_bytes(
+        "\n".join(serialized_rows))
     
 def decode_quasi_http_headers(is_response, buffer,
                               headers_receiver):
+    headers = {}
+    special_header = _decode_quoted_csv_rows(buffer, headers)
+    if special_header is None:
+        # discard any headers collected by fast path before giving up.
+        headers = {}
+        csv_data = _decode_csv_rows(buffer)
+        special_header = csv_data[0]
+        for header_row in csv_data[1:]:
+            _add_header_row(headers, header_row)
+
+    error_tag = "status" if is_response else "request"
+    if len(special_header) < 4:
+        raise QuasiHttpError(
+            QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+            f"invalid quasi http {error_tag} line")
+    _merge_headers(headers_receiver, headers)
+    return special_header
+
+def _merge_headers(headers_receiver, headers):
+    if not headers_receiver:
+        headers_receiver.update(headers)
+    else:
+        for header_name, header_value in headers.items():
+            if header_name not in headers_receiver:
+                headers_receiver[header_name] = []
+            headers_receiver[header_name].extend(header_value)
+
+def encode_binary_quasi_http_headers(is_response, req_or_status_line,
+                                     remaining_headers, max_headers_size=None):
+    line_fields = _validate_req_or_status_line(is_response,
+                                               req_or_status_line)
+
+    # layout consists of
+    #  - numeric fields of request or status line
+    #  - 16-bit count of header rows, followed by 16-bit count of
+    #    values in each row
+    #  - 16-bit length of each string field, in the order of string
+    #    fields of request or status line, and then each header name
+    #    followed by its values.
+    #  - concatenation of all string fields.
+    # lengths are gathered into one table, so that encoding and
+    # decoding need a single struct call and a single str/bytes
+    # conversion, rather than calls per field.
+    error_tag = "status" if is_response else "request"
+    try:
+        if is_response:
+            encoded_numbers = _BINARY_STATUS_LINE_STRUCT.pack(
+                misc_utils_internal.parse_int_32(
+                    req_or_status_line[1] or 0),
+                misc_utils_internal.parse_int_48(
+                    req_or_status_line[3] or 0))
+            strings = [line_fields[0], line_fields[2]]
+        else:
+            encoded_numbers = _BINARY_REQUEST_LINE_STRUCT.pack(
+                misc_utils_internal.parse_int_48(
+                    req_or_status_line[3] or 0))
+            strings = line_fields[:3]
+    except Exception as ex:
+        quasi_ex = QuasiHttpError(
+            QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+            f"invalid quasi http {error_tag} line field")
+        quasi_ex.__cause__ = ex
+        raise quasi_ex
+    headers_size = len(encoded_numbers) + _BINARY_COUNT_STRUCT.size
+    for v in strings:
+        headers_size += _BINARY_COUNT_STRUCT.size + len(v)
+    _ensure_headers_within_size(headers_size, max_headers_size)
+
+    value_counts = []
+    for header_name, header_value in _iter_validated_header_rows(
+            remaining_headers):
+        strings.append(header_name)
+        strings.extend(header_value)
+        value_counts.append(len(header_value))
+        # count of values, and lengths of name and values.
+        headers_size += len(header_name) + sum(map(len, header_value)) + \
+            _BINARY_COUNT_STRUCT.size * (len(header_value) + 2)
+        _ensure_headers_within_size(headers_size, max_headers_size)
+
+    # since strings are ASCII, character counts equal byte counts.
+    lengths = [len(v) for v in strings]
+    if len(value_counts) > _MAX_BINARY_COUNT or \
+            max(lengths) > _MAX_BINARY_COUNT or \
+            max(value_counts, default=0) > _MAX_BINARY_COUNT:
+        raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_MESSAGE_LENGTH_LIMIT_EXCEEDED,
+            "quasi http header field exceeds max binary length " +
+            f"of {_MAX_BINARY_COUNT}")
+    return b"".join([
+        encoded_numbers,
+        _BINARY_COUNT_STRUCT.pack(len(value_counts)),
+        struct.pack(f">{len(value_counts)}H", *value_counts),
+        struct.pack(f">{len(lengths)}H", *lengths),
+        misc_utils_internal.string_to_bytes("".join(strings))
+    ])
+
+def decode_binary_quasi_http_headers(is_response, buffer,
+                                     headers_receiver):
+    headers = {}
+    try:
+        if is_response:
+            status_code, content_length = \
+                _BINARY_STATUS_LINE_STRUCT.unpack_from(buffer, 0)
+            offset = _BINARY_STATUS_LINE_STRUCT.size
+            string_count = 2
+        else:
+            content_length, = _BINARY_REQUEST_LINE_STRUCT.unpack_from(
+                buffer, 0)
+            offset = _BINARY_REQUEST_LINE_STRUCT.size
+            string_count = 3
+        row_count, = _BINARY_COUNT_STRUCT.unpack_from(buffer, offset)
+        offset += _BINARY_COUNT_STRUCT.size
+        value_counts = struct.unpack_from(f">{row_count}H", buffer, offset)
+        offset += _BINARY_COUNT_STRUCT.size * row_count
+        string_count += row_count + sum(value_counts)
+        lengths = struct.unpack_from(f">{string_count}H", buffer, offset)
+        offset += _BINARY_COUNT_STRUCT.size * string_count
+        encoded_strings = buffer[offset:]
+        if sum(lengths) != len(encoded_strings):
+            raise ExpectationViolationError(
+                "string lengths do not match remaining byte count")
+        concatenated = misc_utils_internal.bytes_to_string(
+            encoded_strings)
+        # byte offsets can only be used with the decoded string if all
+        # characters are ASCII.
+        ascii_only = len(concatenated) == len(encoded_strings)
+        if not ascii_only:
+            concatenated = encoded_strings
+        offsets = list(itertools.accumulate(lengths, initial=0))
+        strings = [concatenated[offsets[i]:offsets[i + 1]]
+            for i in range(string_count)]
+        if not ascii_only:
+            strings = [misc_utils_internal.bytes_to_string(v)
+                for v in strings]
+    except Exception as ex:
+        quasi_ex = QuasiHttpError(
+            QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+            "invalid quasi http headers")
+        quasi_ex.__cause__ = ex
+        raise quasi_ex
+
+    if is_response:
+        special_header = [strings[0], status_code, strings[1],
+            content_length]
+        i = 2
+    else:
+        special_header = [strings[0], strings[1], strings[2],
+            content_length]
+        i = 3
+    for value_count in value_counts:
+        header_name = strings[i]
+        header_value = strings[i + 1:i + 1 + value_count]
+        i += 1 + value_count
+        if not value_count:
+            continue
+        # merge headers with the same normalized name in different rows.
+        header_name = header_name.lower()
+        existing_value = headers.get(header_name)
+        if existing_value is None:
+            headers[header_name] = header_value
+        else:
+            existing_value.extend(header_value)
+    _merge_headers(headers_receiver, headers)
+    return special_header
+
+def encode_compressed_quasi_http_headers(is_response, req_or_status_line,
+                                         remaining_headers, header_table,
+                                         max_headers_size=None):
+    # validate all fields before encoding, since encoding updates
+    # dynamic table of connection.
+    # byte count of names and values is checked against limit, since
+    # that is what decoders check.
+    line_fields = _validate_req_or_status_line(is_response,
+                                               req_or_status_line)
+    if is_response:
+        field_names = header_compression_utils_internal.STATUS_LINE_FIELD_NAMES
+    else:
+        field_names = header_compression_utils_internal.REQUEST_LINE_FIELD_NAMES
+    fields = []
+    headers_size = 0
+    for field_name, v in zip(field_names, line_fields):
+        fields.append((field_name, v))
+        headers_size += len(field_name) + len(v)
+    _ensure_headers_within_size(headers_size, max_headers_size)
+    for header_name, header_value in _iter_validated_header_rows(
+            remaining_headers):
+        # lower-case names, since receivers do so anyway, and
+        # so that more of them are found in tables.
+        header_name = header_name.lower()
+        for v in header_value:
+            fields.append((header_name, v))
+            headers_size += len(header_name) + len(v)
+        _ensure_headers_within_size(headers_size, max_headers_size)
+
+    encoded_headers = header_compression_utils_internal.encode_header_fields(
+        header_table, fields)
+    if max_headers_size and len(encoded_headers) > max_headers_size:
+        # encoded headers won't be sent, so drop entries which were
+        # just added, to keep in sync with decoder at the other end.
+        header_table.clear()
+        _ensure_headers_within_size(len(encoded_headers), max_headers_size)
+    return encoded_headers
+
+def decode_compressed_quasi_http_headers(is_response, buffer, header_table,
+                                         headers_receiver,
+                                         max_headers_size=None):
+    if not max_headers_size or max_headers_size < 0:
+        max_headers_size = quasi_http_utils.DEFAULT_MAX_HEADERS_SIZE
+    if is_response:
+        field_names = header_compression_utils_internal.STATUS_LINE_FIELD_NAMES
+    else:
+        field_names = header_compression_utils_internal.REQUEST_LINE_FIELD_NAMES
+    try:
+        fields = header_compression_utils_internal.decode_header_fields(
+            header_table, buffer, max_headers_size)
+        if len(fields) < 4 or any(fields[i][0] != field_names[i]
+                for i in range(4)):
+            raise ExpectationViolationError(
+                "pseudo header fields missing or out of order")
+    except Exception as ex:
+        quasi_ex = QuasiHttpError(
+            QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+            "invalid quasi http headers")
+        quasi_ex.__cause__ = ex
+        raise quasi_ex
+    special_header = [fields[i][1] for i in range(4)]
+    headers = {}
+    for header_name, v in itertools.islice(fields, 4, None):
+        if header_name.startswith(":"):
+            raise QuasiHttpError(
+                QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+                "invalid quasi http headers")
+        header_name = header_name.lower()
+        existing_value = headers.get(header_name)
+        if existing_value is None:
+            headers[header_name] = [v]
+        else:
+            existing_value.append(v)
+    _merge_headers(headers_receiver, headers)
+    return special_header
+
+def get_header_compression_context(connection):
+    # create context on first use, and keep it with connection
+    # so that it lasts for as long as connection.
+    context = _get_optional_attr(connection, "header_compression_context")
+    if context is None:
+        context = header_compression_utils_internal.HeaderCompressionContext()
+        try:
+            connection.header_compression_context = context
+        except AttributeError:
+            # connection can't keep context, so just use context for
+            # current message, which works since encoders always start
+            # header blocks with their table size.
+            pass
+    return context
+
+def get_buffered_readable_stream(connection, readable_stream):
+    if hasattr(readable_stream, "peek"):
+        # already buffered.
+        return readable_stream
+    # keep buffered stream with connection, so that bytes read ahead
+    # of one message are not lost to the next message.
+    buffered_stream = _get_optional_attr(connection,
+        "buffered_readable_stream")
+    if buffered_stream is not None and \
+            buffered_stream.backing_stream is readable_stream:
+        return buffered_stream
+    buffered_stream = io_utils_internal.create_buffered_readable_stream(
+        readable_stream)
+    try:
+        connection.buffered_readable_stream = buffered_stream
+    except AttributeError:
+        pass
+    return buffered_stream
+
+def has_keep_alive_header(headers):
+    if not headers:
+        return False
+    header_value = headers.get(quasi_http_utils.HEADER_NAME_CONNECTION)
+    if header_value is None:
+        return False
+    if type(header_value) == str:
+        header_value = [header_value]
+    for v in header_value:
+        if str(v).lower() == quasi_http_utils.CONNECTION_KEEP_ALIVE:
+            return True
+    return False
+
+def _add_connection_header(headers, header_value):
+    # leave any connection header set by application as it is.
+    if headers:
+        for header_name in headers:
+            if str(header_name).lower() == \
+                    quasi_http_utils.HEADER_NAME_CONNECTION:
+                return headers
+        headers = dict(headers)
+    else:
+        headers = {}
+    headers[quasi_http_utils.HEADER_NAME_CONNECTION] = [header_value]
+    return headers
+
+# Send options which are only acted upon by clients, and so don't
+# keep connections from being shared.
+_CONNECTION_NEUTRAL_OPTION_NAMES = ("idempotent",)
+
+def get_connection_key(remote_endpoint, send_options):
+    # returns key on which connections allocated for remote endpoint
+    # and send options can be shared with later requests whose send
+    # options have the same values, or None if no such key can be made.
+    if send_options is None:
+        option_items = ()
+    else:
+        try:
+            option_values = vars(send_options)
+        except TypeError:
+            return None
+        try:
+            option_items = tuple(sorted(
+                (k, _freeze_option_value(v))
+                for k, v in option_values.items()
+                if v is not None and
+                    k not in _CONNECTION_NEUTRAL_OPTION_NAMES))
+        except TypeError:
+            return None
+    key = (remote_endpoint, option_items)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _freeze_option_value(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze_option_value(v))
+                            for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze_option_value(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+def decode_quasi_http_headers_lazily(is_response, buffer):
+    # decode only the request or status line upfront, provided it is in
+    # the quoted form written by encode_quasi_http_headers, so that it
+    # ends at a row boundary. leave remaining rows for first access.
+    line_end = buffer.find(b"\n") + 1
+    special_header = None
+    if line_end:
+        special_header = _decode_quoted_csv_rows(buffer[:line_end], {})
+    if special_header is None or len(special_header) < 4:
+        headers = {}
+        special_header = decode_quasi_http_headers(is_response, buffer,
+            headers)
+        return special_header, Headers(headers)
+    if line_end == len(buffer):
+        return special_header, Headers()
+    def decoder():
+        headers = {}
+        decode_quasi_http_headers(is_response, buffer, headers)
+        return headers
+    raw_rows = memoryview(buffer)[line_end:]
+    return special_header, Headers(raw_rows=raw_rows, decoder=decoder)
+
+def _add_header_row(headers, header_row):
+    if len(header_row) < 2:
+        return
+    # merge headers with the same normalized name in different rows.
+    header_name = header_row[0].lower()
+    header_value = headers.get(header_name)
+    if header_value is None:
+        headers[header_name] = header_row[1:]
+    else:
+        header_value.extend(header_row[1:])
+
+def _decode_quoted_csv_rows(buffer, headers):
+    # fast path for decoding the csv produced by encode_quasi_http_headers,
+    # in which every field is quoted, no field contains quotes or newlines,
+    # and every row is terminated by a newline.
+    # returns None for anything else, so that csv module can decide
+    # on the outcome.
+    buffer_len = len(buffer)
+    if buffer_len < 3 or buffer_len > csv.field_size_limit():
+        return None
+    if buffer[0] != 34 or buffer[-2] != 34 or buffer[-1] != 10:
+        return None
+    try:
+        s = misc_utils_internal.bytes_to_string(buffer)
+    except UnicodeDecodeError:
+        return None
+    # require every row boundary to be surrounded by quotes.
+    rows = s[1:-2].split('"\n"')
+    if s.count("\n") != len(rows):
+        return None
+    special_header = rows[0].split('","')
+    field_count = len(special_header)
+    for i in range(1, len(rows)):
+        header_name, sep, header_value = rows[i].partition('","')
+        if not sep:
+            field_count += 1
+            continue
+        header_value = header_value.split('","')
+        field_count += len(header_value) + 1
+        # merge headers with the same normalized name in different rows.
+        header_name = header_name.lower()
+        existing_value = headers.get(header_name)
+        if existing_value is None:
+            headers[header_name] = header_value
+        else:
+            existing_value.extend(header_value)
+    # each field contributes exactly 2 quotes, so any excess means
+    # some field contains escaped quotes.
+    if s.count('"') != 2 * field_count:
+        return None
+    return special_header
+
+def _decode_csv_rows(buffer):
     csv_data = []
     try:
         with io.StringIO(misc_utils_internal.bytes_to_string(
@@ -170,50 +660,69 @@ def decode_quasi_http_headers(is_response, buffer,
         raise QuasiHttpError(
             QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
             "invalid quasi http headers")
-    
-    error_tag = "status" if is_response else "request"
-    special_header = csv_data[0]
-    if len(special_header) < 4:
-        raise QuasiHttpError(
-            QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
-            f"invalid quasi http {error_tag} line")
-    for header_row in csv_data[1:]:
-        if len(header_row) < 2:
-            continue
-        # merge headers with the same normalized name in different rows.
-        header_name = header_row[0].lower()
-        if header_name not in headers_receiver:
-            headers_receiver[header_name] = []
-        header_value = header_row[1:]
-        headers_receiver[header_name].extend(header_value)
-    return special_header
+    return csv_data
 
 async def write_quasi_http_headers(
         is_response, dest: SendStream, req_or_status_line,
-        remaining_headers, max_headers_size):
-    encoded_headers = encode_quasi_http_headers(
-        is_response, req_or_status_line, remaining_headers)
+        remaining_headers, max_headers_size,
+        binary_headers_enabled=False, header_table=None):
+    await io_utils_internal.send_all_gathered(dest,
+        encode_quasi_http_header_section(is_response,
+            req_or_status_line, remaining_headers, max_headers_size,
+            binary_headers_enabled, header_table))
+
+def encode_quasi_http_header_section(
+        is_response, req_or_status_line,
+        remaining_headers, max_headers_size,
+        binary_headers_enabled=False, header_table=None):
+    # returns tag and length, followed by encoded headers.
     if not max_headers_size or max_headers_size < 0:
         max_headers_size = quasi_http_utils.DEFAULT_MAX_HEADERS_SIZE
-
-    # finally check that byte count of csv doesn't exceed limit.
-    if len(encoded_headers) > max_headers_size:
-        msg_suffix = f"{len(encoded_headers)} > {max_headers_size}"
-        raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_MESSAGE_LENGTH_LIMIT_EXCEEDED,
-            f"quasi http headers exceed max size ({msg_suffix})")
+    # byte count of headers is checked against limit during encoding.
+    if header_table is not None:
+        tag = tlv_utils.TAG_FOR_QUASI_HTTP_COMPRESSED_HEADERS
+        encoded_headers = encode_compressed_quasi_http_headers(
+            is_response, req_or_status_line, remaining_headers,
+            header_table, max_headers_size)
+    elif binary_headers_enabled:
+        tag = tlv_utils.TAG_FOR_QUASI_HTTP_BINARY_HEADERS
+        encoded_headers = encode_binary_quasi_http_headers(
+            is_response, req_or_status_line, remaining_headers,
+            max_headers_size)
+    else:
+        tag = tlv_utils.TAG_FOR_QUASI_HTTP_HEADERS
+        encoded_headers = encode_quasi_http_headers(
+            is_response, req_or_status_line, remaining_headers,
+            max_headers_size)
 
     tag_and_len = tlv_utils.encode_tag_and_length(
-        tlv_utils.TAG_FOR_QUASI_HTTP_HEADERS,
-        len(encoded_headers))
-    await dest.send_all(tag_and_len)
-    await dest.send_all(encoded_headers)
+        tag, len(encoded_headers))
+    return [tag_and_len, encoded_headers]
 
 async def read_quasi_http_headers(
         is_response, src: ReceiveStream,
-        headers_receiver, max_headers_size):
+        headers_receiver, max_headers_size, header_table=None):
+    tag, encoded_headers = await _read_encoded_quasi_http_headers(
+        src, max_headers_size)
+    if tag == tlv_utils.TAG_FOR_QUASI_HTTP_COMPRESSED_HEADERS:
+        if header_table is None:
+            header_table = header_compression_utils_internal.HeaderTable()
+        return decode_compressed_quasi_http_headers(is_response,
+            encoded_headers, header_table, headers_receiver,
+            max_headers_size)
+    if tag == tlv_utils.TAG_FOR_QUASI_HTTP_BINARY_HEADERS:
+        return decode_binary_quasi_http_headers(is_response,
+            encoded_headers, headers_receiver)
+    return decode_quasi_http_headers(is_response, encoded_headers,
+        headers_receiver)
+
+async def _read_encoded_quasi_http_headers(
+        src: ReceiveStream, max_headers_size):
     encoded_tag = await io_utils_internal.read_bytes_fully(src, 4)
     tag = tlv_utils.decode_tag(encoded_tag, 0)
-    if tag != tlv_utils.TAG_FOR_QUASI_HTTP_HEADERS:
+    if tag != tlv_utils.TAG_FOR_QUASI_HTTP_HEADERS and \
+            tag != tlv_utils.TAG_FOR_QUASI_HTTP_BINARY_HEADERS and \
+            tag != tlv_utils.TAG_FOR_QUASI_HTTP_COMPRESSED_HEADERS:
         raise QuasiHttpError(
             QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
             f"unexpected quasi http headers tag: ${tag}")
@@ -228,8 +737,7 @@ async def read_quasi_http_headers(
             f"quasi http headers exceed max size ({msg_suffix})")
     encoded_headers = await io_utils_internal.read_bytes_fully(
         src, headers_size)
-    return decode_quasi_http_headers(is_response, encoded_headers,
-        headers_receiver)
+    return tag, encoded_headers
 
 async def write_entity_to_transport(
         is_response, entity, writable_stream: SendStream,
@@ -242,7 +750,7 @@ async def write_entity_to_transport(
         body = _get_optional_attr(response, "body")
         content_length = _get_optional_attr(response, "content_length")
         if not content_length:
-            content_length = 0
+            content_length = _get_body_content_length(body)
         status_code = _get_optional_attr(response, "status_code")
         if not status_code:
             status_code = 0
@@ -259,7 +767,7 @@ async def write_entity_to_transport(
         body = _get_optional_attr(request, "body")
         content_length = _get_optional_attr(request, "content_length")
         if not content_length:
-            content_length = 0
+            content_length = _get_body_content_length(body)
         req_or_status_line = []
         req_or_status_line.append(
             _get_optional_attr(request, "http_method"))
@@ -270,37 +778,134 @@ async def write_entity_to_transport(
         req_or_status_line.append(content_length)
     # treat content lengths totally separate from body
     # due to how HEAD method works.
+    processing_options = _get_optional_attr(
+        connection, "processing_options")
     max_headers_size = _get_optional_attr(
-        connection, "processing_options", "max_headers_size")
-    await write_quasi_http_headers(is_response,
-        writable_stream, req_or_status_line, headers,
-        max_headers_size)
+        processing_options, "max_headers_size")
+    binary_headers_enabled = _get_optional_attr(
+        processing_options, "binary_headers_enabled")
+    max_header_table_size = _get_optional_attr(
+        processing_options, "max_header_table_size")
+    header_table = None
+    if max_header_table_size and max_header_table_size > 0:
+        header_table = get_header_compression_context(
+            connection).encoder_table
+        header_table.set_max_size(min(max_header_table_size,
+            header_compression_utils_internal.MAX_HEADER_TABLE_SIZE))
+    # announce connections kept open for further requests
+    # (e.g. by connection pools).
+    keep_alive = _get_optional_attr(connection, "keep_alive")
+    if keep_alive is not None:
+        headers = _add_connection_header(headers,
+            quasi_http_utils.CONNECTION_KEEP_ALIVE if keep_alive
+            else quasi_http_utils.CONNECTION_CLOSE)
+    header_section = encode_quasi_http_header_section(is_response,
+        req_or_status_line, headers, max_headers_size,
+        binary_headers_enabled, header_table)
     if not body:
         # don't proceed, even if content length is not zero.
+        await io_utils_internal.send_all_gathered(writable_stream,
+            header_section)
         return
     if content_length > 0:
-        # don't enforce positive content lengths when writing out
-        # quasi http bodies
-        await io_utils_internal.copy(body, writable_stream)
+        write_coalescing_threshold = _get_optional_attr(
+            processing_options, "write_coalescing_threshold")
+        if not write_coalescing_threshold:
+            write_coalescing_threshold = \
+                quasi_http_utils.DEFAULT_WRITE_COALESCING_THRESHOLD
+        body_ended = False
+        if content_length <= write_coalescing_threshold and \
+                io_utils_internal.is_in_memory_stream(body):
+            # send small bodies together with headers in one write,
+            # provided they are at hand, so that slow producers of
+            # bodies don't hold back headers.
+            body_prefix, body_ended = await _read_body_prefix(body,
+                content_length)
+            header_section.extend(body_prefix)
+            await io_utils_internal.send_all(writable_stream,
+                b"".join(header_section))
+        else:
+            await io_utils_internal.send_all_gathered(writable_stream,
+                header_section)
+        if not body_ended:
+            # don't enforce positive content lengths when writing out
+            # quasi http bodies
+            await copy_body(body, writable_stream, processing_options)
     else:
+        await io_utils_internal.send_all_gathered(writable_stream,
+            header_section)
         # proceed, even if content length is 0.
         body_writer = tlv_utils.create_tlv_encoding_writable_stream(
             writable_stream, tlv_utils.TAG_FOR_QUASI_HTTP_BODY_CHUNK)
-        await io_utils_internal.copy(body, body_writer)
+        await copy_body(body, body_writer, processing_options)
         await body_writer.send_eof()
 
+def _get_body_content_length(body):
+    # use length advertised by body (e.g. memory mapped bodies),
+    # when entity leaves content length unset.
+    content_length = _get_optional_attr(body, "content_length")
+    if not content_length or content_length < 0:
+        return 0
+    return content_length
+
+async def copy_body(body, dest, processing_options):
+    buffer_size = _get_optional_attr(processing_options,
+        "body_copy_buffer_size")
+    # let kernel move file bodies straight to sockets where possible.
+    body_file = io_utils_internal.get_send_file_source(body)
+    if body_file is not None and io_utils_internal.supports_send_file(dest):
+        await io_utils_internal.copy_file(body_file, dest, buffer_size)
+        return
+    pipeline_depth = _get_optional_attr(processing_options,
+        "body_copy_pipeline_depth")
+    # pipelining needs at least two buffers to overlap reads
+    # with writes.
+    if pipeline_depth and pipeline_depth > 1:
+        await io_utils_internal.copy_pipelined(body, dest,
+            buffer_size, pipeline_depth)
+    else:
+        await io_utils_internal.copy(body, dest, buffer_size)
+
+async def _read_body_prefix(body, max_len):
+    # reads body until its end, or until max_len bytes have been read.
+    chunks = []
+    total_len = 0
+    while total_len < max_len:
+        next_chunk = await io_utils_internal.receive_some(body,
+            max_len - total_len)
+        if not next_chunk:
+            return chunks, True
+        chunks.append(next_chunk)
+        total_len += len(next_chunk)
+    return chunks, False
+
 async def read_entity_from_transport(
         is_response, readable_stream: ReceiveStream, connection):
     if not readable_stream:
         raise MissingDependencyError("no readable stream found for transport")
-    headers_receiver = {}
+    # serve small reads of tags, lengths and headers from a buffer,
+    # rather than from transport.
+    readable_stream = get_buffered_readable_stream(connection,
+        readable_stream)
     processing_options = _get_optional_attr(
         connection, "processing_options")
     max_headers_size = _get_optional_attr(
         processing_options, "max_headers_size")
-    req_or_status_line = await read_quasi_http_headers(
-        is_response, readable_stream, headers_receiver,
-        max_headers_size)
+    tag, encoded_headers = await _read_encoded_quasi_http_headers(
+        readable_stream, max_headers_size)
+    if tag == tlv_utils.TAG_FOR_QUASI_HTTP_COMPRESSED_HEADERS:
+        headers = Headers()
+        req_or_status_line = decode_compressed_quasi_http_headers(
+            is_response, encoded_headers,
+            get_header_compression_context(connection).decoder_table,
+            headers, max_headers_size)
+    elif tag == tlv_utils.TAG_FOR_QUASI_HTTP_BINARY_HEADERS:
+        headers = Headers()
+        req_or_status_line = decode_binary_quasi_http_headers(
+            is_response, encoded_headers, headers)
+    else:
+        req_or_status_line, headers = decode_quasi_http_headers_lazily(
+            is_response, encoded_headers)
     error_tag = 'response' if is_response else 'request'
     try:
         content_length = misc_utils_internal.parse_int_48(
@@ -333,7 +938,7 @@ async def read_entity_from_transport(
             raise quasi_ex
         response.http_status_message = req_or_status_line[2]
         response.content_length = content_length
-        response.headers = headers_receiver
+        response.headers = headers
         if body:
             body_size_limit = None
             if processing_options:
@@ -352,6 +957,61 @@ async def read_entity_from_transport(
         request.target = req_or_status_line[1]
         request.http_version = req_or_status_line[2]
         request.content_length = content_length
-        request.headers = headers_receiver
+        request.headers = headers
         request.body = body
         return request
+
+async def buffer_response_body(response, max_size):
+    # reads response body into memory if it is no larger than
+    # max_size, and returns whether it did.
+    body = response.body
+    content_length = response.content_length
+    if content_length > 0:
+        if content_length > max_size:
+            return False
+        data = await io_utils_internal.read_bytes_fully(body,
+                                                        content_length)
+    else:
+        data = await io_utils_internal.read_up_to(body, max_size + 1)
+        if len(data) > max_size:
+            # keep streaming, starting with what has been read.
+            response.body = io_utils_internal.create_bytes_readable_stream(
+                data, body)
+            return False
+    response.body = io_utils_internal.create_bytes_readable_stream(data)
+    return True
+
+class ResponseSnapshot:
+    # keeps a response with its body read into memory, to create
+    # any number of copies of it, each with its own body stream.
+    __slots__ = ("status_code", "http_status_message", "http_version",
+                 "headers", "content_length", "body")
+
+    def __init__(self, response, body):
+        self.status_code = _get_optional_attr(response, "status_code")
+        self.http_status_message = _get_optional_attr(response,
+            "http_status_message")
+        self.http_version = _get_optional_attr(response, "http_version")
+        self.headers = dict(_get_optional_attr(response, "headers") or {})
+        # keep content length of bodyless responses (e.g. to HEAD
+        # requests), which describes a body never sent.
+        content_length = _get_optional_attr(response, "content_length")
+        if content_length is None or content_length < 0:
+            content_length = len(body)
+        self.content_length = content_length
+        self.body = body
+
+    def create_response(self):
+        body = None
+        if self.body:
+            body = io_utils_internal.create_bytes_readable_stream(self.body)
+        return DefaultQuasiHttpResponse(status_code=self.status_code,
+            headers=Headers(dict((k, list(v))
+                                 for k, v in self.headers.items())),
+            content_length=self.content_length,
+            body=body,
+            http_status_message=self.http_status_message,
+            http_version=self.http_version)
+
+def create_response_snapshot(response, body):
+    return ResponseSnapshot(response, body)
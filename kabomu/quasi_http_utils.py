@@ -1,6 +1,9 @@
 from types import SimpleNamespace
 
+from kabomu import io_utils_internal
+from kabomu.errors import KabomuIOError
 from kabomu.misc_utils_internal import parse_int_32
+from kabomu.tlv import tlv_utils
 
 # Request environment variable for local server endpoint.
 ENV_KEY_LOCAL_PEER_ENDPOINT = "kabomu.local_peer_endpoint"
@@ -29,6 +32,9 @@ METHOD_TRACE = "TRACE"
 # 200 OK
 STATUS_CODE_OK = 200
 
+# 304 Not Modified
+STATUS_CODE_NOT_MODIFIED = 304
+
 # 400 Bad Request
 STATUS_CODE_CLIENT_ERROR_BAD_REQUEST = 400
 
@@ -62,9 +68,35 @@ STATUS_CODE_CLIENT_ERROR_TOO_MANY_REQUESTS = 429
 # 500 Internal Server Error
 STATUS_CODE_SERVER_ERROR = 500
 
+# Name of header with which peers signal whether a connection is to be
+# kept open for further requests after the current exchange.
+HEADER_NAME_CONNECTION = "connection"
+
+# Connection header value which asks for a connection to be kept open.
+CONNECTION_KEEP_ALIVE = "keep-alive"
+
+# Connection header value which signals that a connection will be
+# closed after the current exchange.
+CONNECTION_CLOSE = "close"
+
+# Names of headers with which responses can be cached and revalidated.
+HEADER_NAME_CACHE_CONTROL = "cache-control"
+HEADER_NAME_ETAG = "etag"
+HEADER_NAME_LAST_MODIFIED = "last-modified"
+HEADER_NAME_IF_NONE_MATCH = "if-none-match"
+HEADER_NAME_IF_MODIFIED_SINCE = "if-modified-since"
+
 # The default value of maximum size of headers in a request or response.
 DEFAULT_MAX_HEADERS_SIZE = 8_192
 
+# The default value of how long servers wait for the next request on a
+# kept-alive connection.
+DEFAULT_KEEP_ALIVE_IDLE_TIMEOUT_MILLIS = 5_000
+
+# The default value of maximum size of bodies with known content length,
+# which are written out together with headers in a single write.
+DEFAULT_WRITE_COALESCING_THRESHOLD = 16_384
+
 def _get_optional_attr(instance, *args):
     for n in args:
         if instance == None or not hasattr(instance, n):
@@ -75,6 +107,30 @@ def _get_optional_attr(instance, *args):
 def _bind_method(proc, instance):
     return proc.__get__(instance, instance.__class__)
 
+async def read_body_fully(entity, limit=None):
+    # reads body of a request or response into memory.
+    # limit is interpreted like max_response_body_size: zero or None
+    # means default limit of 128 MB, and negative means no limit.
+    body = _get_optional_attr(entity, "body")
+    if not body:
+        return bytearray()
+    if not limit:
+        limit = tlv_utils.DEFAULT_MAX_LENGTH
+    content_length = _get_optional_attr(entity, "content_length")
+    if not content_length or content_length < 0:
+        # fall back to length advertised by body itself.
+        content_length = _get_optional_attr(body, "content_length")
+    if content_length and content_length > 0:
+        if limit > 0 and content_length > limit:
+            raise KabomuIOError(
+                f"stream size exceeds limit of {limit} bytes")
+        # allocate once and fill in place.
+        return await io_utils_internal.read_bytes_fully(body,
+            content_length)
+    if limit > 0:
+        body = tlv_utils.create_max_length_enforcing_stream(body, limit)
+    return await io_utils_internal.read_all_bytes(body)
+
 def merge_processing_options(preferred, fallback):
     if preferred is None or fallback is None:
         return preferred if preferred is not None else fallback
@@ -98,6 +154,56 @@ def merge_processing_options(preferred, fallback):
             _get_optional_attr(preferred, "max_response_body_size"),
             _get_optional_attr(fallback, "max_response_body_size"),
         0)
+    merged_options.binary_headers_enabled =\
+        _determine_effective_boolean_option(
+            _get_optional_attr(preferred, "binary_headers_enabled"),
+            _get_optional_attr(fallback, "binary_headers_enabled"),
+        False)
+    merged_options.max_header_table_size =\
+        _determine_effective_positive_integer_option(
+            _get_optional_attr(preferred, "max_header_table_size"),
+            _get_optional_attr(fallback, "max_header_table_size"),
+        0)
+    merged_options.write_coalescing_threshold =\
+        _determine_effective_non_zero_integer_option(
+            _get_optional_attr(preferred, "write_coalescing_threshold"),
+            _get_optional_attr(fallback, "write_coalescing_threshold"),
+        0)
+    merged_options.body_copy_buffer_size =\
+        _determine_effective_positive_integer_option(
+            _get_optional_attr(preferred, "body_copy_buffer_size"),
+            _get_optional_attr(fallback, "body_copy_buffer_size"),
+        0)
+    merged_options.body_copy_pipeline_depth =\
+        _determine_effective_positive_integer_option(
+            _get_optional_attr(preferred, "body_copy_pipeline_depth"),
+            _get_optional_attr(fallback, "body_copy_pipeline_depth"),
+        0)
+    merged_options.keep_alive_enabled =\
+        _determine_effective_boolean_option(
+            _get_optional_attr(preferred, "keep_alive_enabled"),
+            _get_optional_attr(fallback, "keep_alive_enabled"),
+        False)
+    merged_options.keep_alive_idle_timeout_millis =\
+        _determine_effective_non_zero_integer_option(
+            _get_optional_attr(preferred, "keep_alive_idle_timeout_millis"),
+            _get_optional_attr(fallback, "keep_alive_idle_timeout_millis"),
+        0)
+    merged_options.max_requests_per_connection =\
+        _determine_effective_positive_integer_option(
+            _get_optional_attr(preferred, "max_requests_per_connection"),
+            _get_optional_attr(fallback, "max_requests_per_connection"),
+        0)
+    merged_options.idempotent =\
+        _determine_effective_boolean_option(
+            _get_optional_attr(preferred, "idempotent"),
+            _get_optional_attr(fallback, "idempotent"),
+        False)
+    merged_options.max_eager_response_body_size =\
+        _determine_effective_positive_integer_option(
+            _get_optional_attr(preferred, "max_eager_response_body_size"),
+            _get_optional_attr(fallback, "max_eager_response_body_size"),
+        0)
     return merged_options
 
 def _determine_effective_non_zero_integer_option(
@@ -120,6 +226,14 @@ def _determine_effective_positive_integer_option(
             return effective_value
     return parse_int_32(default_value)
 
+def _determine_effective_boolean_option(
+        preferred, fallback1, default_value):
+    if preferred is not None:
+        return bool(preferred)
+    if fallback1 is not None:
+        return bool(fallback1)
+    return bool(default_value)
+
 def _determine_effective_options(
         preferred, fallback):
     dest = {}
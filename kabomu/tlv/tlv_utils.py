@@ -5,10 +5,27 @@ from kabomu.errors import KabomuIOError, IllegalArgumentError
 
 TAG_FOR_QUASI_HTTP_HEADERS = 0x68647273
 
+TAG_FOR_QUASI_HTTP_BINARY_HEADERS = 0x68647262
+
+TAG_FOR_QUASI_HTTP_COMPRESSED_HEADERS = 0x68647263
+
 TAG_FOR_QUASI_HTTP_BODY_CHUNK = 0x62647461
 
 TAG_FOR_QUASI_HTTP_BODY_CHUNK_EXT = 0x62657874
 
+# tags of frame kinds of multiplexed streams, which are carried inside
+# values of extension chunks.
+
+TAG_FOR_QUASI_HTTP_STREAM_DATA = 0x73646174
+
+TAG_FOR_QUASI_HTTP_STREAM_END = 0x73656e64
+
+TAG_FOR_QUASI_HTTP_STREAM_WINDOW_UPDATE = 0x7377696e
+
+TAG_FOR_QUASI_HTTP_STREAM_RESET = 0x73727374
+
+STREAM_FRAME_HEADER_LENGTH = 16
+
 DEFAULT_MAX_LENGTH  = 134_217_728 # 128 MB
 
 def encode_tag_and_length(tag: int, length: int):
@@ -19,6 +36,17 @@ def encode_tag_and_length(tag: int, length: int):
     encoded_tag = misc_utils_internal.serialize_int32_be(tag)
     return encoded_tag + misc_utils_internal.serialize_int32_be(length)
 
+def encode_stream_frame_header(stream_id: int, frame_tag: int,
+                               payload_length: int):
+    # encodes extension chunk tag and length, followed by
+    # stream id and frame kind tag, which precede frame payload.
+    if stream_id <= 0:
+        raise KabomuIOError(f"invalid stream id: {stream_id}")
+    return encode_tag_and_length(TAG_FOR_QUASI_HTTP_BODY_CHUNK_EXT,
+                                 8 + payload_length) + \
+        misc_utils_internal.serialize_int32_be(stream_id) + \
+        misc_utils_internal.serialize_int32_be(frame_tag)
+
 def decode_tag(data, offset):
     tag = misc_utils_internal.deserialize_int32_be(data, offset)
     if tag <= 0:
@@ -31,157 +59,236 @@ def decode_length(data, offset):
         raise IllegalArgumentError(f"invalid length: {decode_length}")
     return decoded_length
 
-def create_content_length_enforcing_stream(backing_stream: ReceiveStream,
-                                           content_length: int):
-    class ContentLengthEnforcingStream(ReceiveStream):
-        def __init__(self):
-            super().__init__()
-            self._bytes_left_to_read = int(content_length)
-
-        async def receive_some(self, max_bytes=None):
-            if not max_bytes:
-                max_bytes = 8_192
-            bytes_to_read = min(self._bytes_left_to_read, int(max_bytes))
-            next_chunk = b""
-            if bytes_to_read:
-                next_chunk = await io_utils_internal.receive_some(
-                    backing_stream, bytes_to_read)
-            next_chunk_len = len(next_chunk)
-            self._bytes_left_to_read -= next_chunk_len
-            end_of_read = not next_chunk_len
-            if end_of_read and self._bytes_left_to_read > 0:
-                raise KabomuIOError.create_end_of_read_error()
-            return next_chunk
-
-        async def aclose(self):
-            pass
-        
-    return ContentLengthEnforcingStream()
+class ContentLengthEnforcingStream(ReceiveStream):
+    __slots__ = ("_backing_stream", "_backing_adapter",
+                 "_bytes_left_to_read")
 
-def create_max_length_enforcing_stream(backing_stream: ReceiveStream,
-                                       max_length=None):
-    class MaxLengthEnforcingStream(ReceiveStream):
-        def __init__(self):
-            super().__init__()
-            nonlocal max_length
-            if not max_length:
-                max_length = DEFAULT_MAX_LENGTH
-            self._bytes_left_to_read = int(max_length) + 1 # check for excess read.
-
-        async def receive_some(self, max_bytes=None):
-            if not max_bytes:
-                max_bytes = 8_192
-            bytes_to_read = min(self._bytes_left_to_read, int(max_bytes))
-            next_chunk = b""
-            if bytes_to_read:
-                next_chunk = await io_utils_internal.receive_some(
-                    backing_stream, bytes_to_read)
-            self._bytes_left_to_read -= len(next_chunk)
-            if not self._bytes_left_to_read:
-                raise KabomuIOError(f"stream size exceeds limit of {max_length} bytes")
-            return next_chunk
-
-        async def aclose(self):
-            pass
+    def __init__(self, backing_stream: ReceiveStream, content_length: int):
+        super().__init__()
+        self._backing_stream = backing_stream
+        self._backing_adapter = io_utils_internal.create_stream_adapter(
+            backing_stream)
+        self._bytes_left_to_read = int(content_length)
 
-    return MaxLengthEnforcingStream()
+    async def receive_some(self, max_bytes=None):
+        if not max_bytes:
+            max_bytes = 8_192
+        bytes_to_read = min(self._bytes_left_to_read, int(max_bytes))
+        next_chunk = b""
+        if bytes_to_read:
+            next_chunk = await self._backing_adapter.receive_some(
+                bytes_to_read)
+        next_chunk_len = len(next_chunk)
+        self._bytes_left_to_read -= next_chunk_len
+        end_of_read = not next_chunk_len
+        if end_of_read and self._bytes_left_to_read > 0:
+            raise KabomuIOError.create_end_of_read_error()
+        return next_chunk
 
-def create_tlv_encoding_writable_stream(backing_stream: SendStream,
-                                        tag_to_use: int):
-    #class BodyChunkEncodingStream(SendStream, HalfCloseableStream):
-    class BodyChunkEncodingStream:
-        def __init__(self):
-            pass
-        
-        async def send_eof(self):
-            await io_utils_internal.send_all(
-                backing_stream, encode_tag_and_length(tag_to_use, 0)
-            )
-        
-        async def send_all(self, data):
-            data_len = len(data)
-            if data_len:
-                await io_utils_internal.send_all(
-                    backing_stream,
-                    encode_tag_and_length(tag_to_use, data_len))
-                await io_utils_internal.send_all(
-                    backing_stream, data)
-
-        def wait_send_all_might_not_block(self):
-            return backing_stream.wait_send_all_might_not_block()
-
-        async def aclose(self):
-            pass
+    async def receive_some_into(self, buffer):
+        bytes_to_read = min(self._bytes_left_to_read, len(buffer))
+        next_chunk_len = 0
+        if bytes_to_read:
+            next_chunk_len = await self._backing_adapter.receive_some_into(
+                memoryview(buffer)[:bytes_to_read])
+        self._bytes_left_to_read -= next_chunk_len
+        end_of_read = not next_chunk_len
+        if end_of_read and self._bytes_left_to_read > 0:
+            raise KabomuIOError.create_end_of_read_error()
+        return next_chunk_len
 
-    return BodyChunkEncodingStream()
+    async def aclose(self):
+        pass
 
-def create_tlv_decoding_readable_stream(
-        backing_stream: ReceiveStream,
-        expected_tag: int, tag_to_ignore: int):
-    class BodyChunkDecodingStream(ReceiveStream):
-        def __init__(self) -> None:
-            super().__init__()
-            self._last_chunk_seen = False
-            self._chunk_data_len_rem = 0
-
-        async def receive_some(self, max_bytes=None):
-            if not max_bytes:
-                max_bytes = 8_192
-            # once empty data chunk is seen,
-            # return empty for all subsequent reads.
-            if self._last_chunk_seen:
+class MaxLengthEnforcingStream(ReceiveStream):
+    __slots__ = ("_backing_stream", "_backing_adapter", "_max_length",
+                 "_bytes_left_to_read")
+
+    def __init__(self, backing_stream: ReceiveStream, max_length=None):
+        super().__init__()
+        self._backing_stream = backing_stream
+        self._backing_adapter = io_utils_internal.create_stream_adapter(
+            backing_stream)
+        if not max_length:
+            max_length = DEFAULT_MAX_LENGTH
+        self._max_length = max_length
+        self._bytes_left_to_read = int(max_length) + 1 # check for excess read.
+
+    async def receive_some(self, max_bytes=None):
+        if not max_bytes:
+            max_bytes = 8_192
+        bytes_to_read = min(self._bytes_left_to_read, int(max_bytes))
+        next_chunk = b""
+        if bytes_to_read:
+            next_chunk = await self._backing_adapter.receive_some(
+                bytes_to_read)
+        self._bytes_left_to_read -= len(next_chunk)
+        if not self._bytes_left_to_read:
+            raise KabomuIOError(f"stream size exceeds limit of {self._max_length} bytes")
+        return next_chunk
+
+    async def receive_some_into(self, buffer):
+        bytes_to_read = min(self._bytes_left_to_read, len(buffer))
+        next_chunk_len = 0
+        if bytes_to_read:
+            next_chunk_len = await self._backing_adapter.receive_some_into(
+                memoryview(buffer)[:bytes_to_read])
+        self._bytes_left_to_read -= next_chunk_len
+        if not self._bytes_left_to_read:
+            raise KabomuIOError(f"stream size exceeds limit of {self._max_length} bytes")
+        return next_chunk_len
+
+    async def aclose(self):
+        pass
+
+#class BodyChunkEncodingStream(SendStream, HalfCloseableStream):
+class BodyChunkEncodingStream:
+    __slots__ = ("_backing_stream", "_tag_to_use")
+
+    def __init__(self, backing_stream: SendStream, tag_to_use: int):
+        self._backing_stream = backing_stream
+        self._tag_to_use = tag_to_use
+    
+    async def send_eof(self):
+        await io_utils_internal.send_all(
+            self._backing_stream, encode_tag_and_length(self._tag_to_use, 0)
+        )
+    
+    async def send_all(self, data):
+        data_len = len(data)
+        if data_len:
+            await io_utils_internal.send_all_gathered(
+                self._backing_stream,
+                [encode_tag_and_length(self._tag_to_use, data_len), data])
+
+    def supports_send_file(self):
+        return io_utils_internal.supports_send_file(self._backing_stream)
+
+    async def send_file(self, file, count):
+        # sends count bytes of file as one chunk.
+        if not count:
+            return 0
+        await io_utils_internal.send_all(self._backing_stream,
+            encode_tag_and_length(self._tag_to_use, count))
+        bytes_sent = await io_utils_internal.send_file(
+            self._backing_stream, file, count)
+        if bytes_sent < count:
+            # chunk length has already been sent.
+            raise KabomuIOError.create_end_of_read_error()
+        return bytes_sent
+
+    def wait_send_all_might_not_block(self):
+        return self._backing_stream.wait_send_all_might_not_block()
+
+    async def aclose(self):
+        pass
+
+class BodyChunkDecodingStream(ReceiveStream):
+    __slots__ = ("_backing_stream", "_backing_adapter", "_expected_tag",
+                 "_tag_to_ignore", "_last_chunk_seen", "_chunk_data_len_rem")
+
+    def __init__(self, backing_stream: ReceiveStream,
+                 expected_tag: int, tag_to_ignore: int) -> None:
+        super().__init__()
+        self._backing_stream = backing_stream
+        self._backing_adapter = io_utils_internal.create_stream_adapter(
+            backing_stream)
+        self._expected_tag = expected_tag
+        self._tag_to_ignore = tag_to_ignore
+        self._last_chunk_seen = False
+        self._chunk_data_len_rem = 0
+
+    async def receive_some(self, max_bytes=None):
+        if not max_bytes:
+            max_bytes = 8_192
+        # once empty data chunk is seen,
+        # return empty for all subsequent reads.
+        if self._last_chunk_seen:
+            return b""
+        
+        if not self._chunk_data_len_rem:
+            self._chunk_data_len_rem = await self._fetch_next_tag_and_length()
+            if not self._chunk_data_len_rem:
+                self._last_chunk_seen = True
                 return b""
             
+        max_bytes = min(self._chunk_data_len_rem, int(max_bytes))
+        next_chunk = await self._backing_adapter.receive_some(max_bytes)
+        next_chunk_len = len(next_chunk)
+        if not next_chunk_len:
+            raise KabomuIOError.create_end_of_read_error()
+        self._chunk_data_len_rem -= next_chunk_len
+        return next_chunk
+
+    async def receive_some_into(self, buffer):
+        if self._last_chunk_seen or not len(buffer):
+            return 0
+
+        if not self._chunk_data_len_rem:
+            self._chunk_data_len_rem = await self._fetch_next_tag_and_length()
             if not self._chunk_data_len_rem:
-                self._chunk_data_len_rem = await self._fetch_next_tag_and_length()
-                if not self._chunk_data_len_rem:
-                    self._last_chunk_seen = True
-                    return b""
-                
-            max_bytes = min(self._chunk_data_len_rem, int(max_bytes))
-            next_chunk = await io_utils_internal.receive_some(
-                backing_stream, max_bytes)
-            next_chunk_len = len(next_chunk)
-            if not next_chunk_len:
-                raise KabomuIOError.create_end_of_read_error()
-            self._chunk_data_len_rem -= next_chunk_len
-            return next_chunk
-        
-        async def _fetch_next_tag_and_length(self):
+                self._last_chunk_seen = True
+                return 0
+
+        bytes_to_read = min(self._chunk_data_len_rem, len(buffer))
+        next_chunk_len = await self._backing_adapter.receive_some_into(
+            memoryview(buffer)[:bytes_to_read])
+        if not next_chunk_len:
+            raise KabomuIOError.create_end_of_read_error()
+        self._chunk_data_len_rem -= next_chunk_len
+        return next_chunk_len
+    
+    async def _fetch_next_tag_and_length(self):
+        tag = await self._read_tag_only()
+        if tag == self._tag_to_ignore:
+            await self._read_away_tag_value()
             tag = await self._read_tag_only()
-            if tag == tag_to_ignore:
-                await self._read_away_tag_value()
-                tag = await self._read_tag_only()
-            
-            if tag != expected_tag:
-                raise KabomuIOError(
-                    f"unexpected tag: expected {expected_tag} but found {tag}")
-            return await self._read_length_only()
         
-        async def _read_away_tag_value(self):
-            length = await self._read_length_only()
-            src = create_content_length_enforcing_stream(
-                backing_stream, length)
-            async for _ in src:
-                pass
-
-        async def _read_tag_only(self):
-            encoded_tag = await io_utils_internal.read_bytes_fully(
-                backing_stream, 4)
-            tag = int.from_bytes(encoded_tag, signed=True)
-            if tag <= 0:
-                raise KabomuIOError(f"invalid tag: {tag}")
-            return tag
-
-        async def _read_length_only(self):
-            encoded_length = await io_utils_internal.read_bytes_fully(
-                backing_stream, 4)
-            length = int.from_bytes(encoded_length, signed=True)
-            if length < 0:
-                raise KabomuIOError(f"invalid tag value length: {length}")
-            return length
-
-        async def aclose(self):
+        if tag != self._expected_tag:
+            raise KabomuIOError(
+                f"unexpected tag: expected {self._expected_tag} but found {tag}")
+        return await self._read_length_only()
+    
+    async def _read_away_tag_value(self):
+        length = await self._read_length_only()
+        src = create_content_length_enforcing_stream(
+            self._backing_stream, length)
+        async for _ in src:
             pass
 
-    return BodyChunkDecodingStream()
+    async def _read_tag_only(self):
+        encoded_tag = await io_utils_internal.read_bytes_fully(
+            self._backing_adapter, 4)
+        tag = int.from_bytes(encoded_tag, signed=True)
+        if tag <= 0:
+            raise KabomuIOError(f"invalid tag: {tag}")
+        return tag
+
+    async def _read_length_only(self):
+        encoded_length = await io_utils_internal.read_bytes_fully(
+            self._backing_adapter, 4)
+        length = int.from_bytes(encoded_length, signed=True)
+        if length < 0:
+            raise KabomuIOError(f"invalid tag value length: {length}")
+        return length
+
+    async def aclose(self):
+        pass
+
+def create_content_length_enforcing_stream(backing_stream: ReceiveStream,
+                                           content_length: int):
+    return ContentLengthEnforcingStream(backing_stream, content_length)
+
+def create_max_length_enforcing_stream(backing_stream: ReceiveStream,
+                                       max_length=None):
+    return MaxLengthEnforcingStream(backing_stream, max_length)
+
+def create_tlv_encoding_writable_stream(backing_stream: SendStream,
+                                        tag_to_use: int):
+    return BodyChunkEncodingStream(backing_stream, tag_to_use)
+
+def create_tlv_decoding_readable_stream(
+        backing_stream: ReceiveStream,
+        expected_tag: int, tag_to_ignore: int):
+    return BodyChunkDecodingStream(backing_stream, expected_tag,
+                                   tag_to_ignore)
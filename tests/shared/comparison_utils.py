@@ -79,6 +79,19 @@ async def read_all_bytes(stream: ReceiveStream):
         raw_data.extend(next_chunk)
     return raw_data
 
+async def read_all_bytes_into(stream, buffer_size=3):
+    # reads with receive_some_into, using a small buffer to
+    # cause many reads.
+    raw_data = bytearray()
+    read_buffer = bytearray(buffer_size)
+    while True:
+        next_chunk_len = await io_utils_internal.receive_some_into(
+            stream, read_buffer)
+        if not next_chunk_len:
+            break
+        raw_data.extend(read_buffer[:next_chunk_len])
+    return raw_data
+
 def concat_buffers(*args):
     raw_data = bytearray()
     for next_chunk in args:
@@ -0,0 +1,186 @@
+import pytest
+import trio
+import trio.testing
+
+from types import SimpleNamespace
+
+from kabomu.BalancingQuasiHttpClient import BalancingQuasiHttpClient,\
+    STRATEGY_LEAST_OUTSTANDING,\
+    STRATEGY_POWER_OF_TWO_CHOICES,\
+    MIN_SLOW_START_WEIGHT
+from kabomu.errors import QuasiHttpError,\
+    MissingDependencyError,\
+    QUASI_HTTP_ERROR_REASON_GENERAL,\
+    QUASI_HTTP_ERROR_REASON_TIMEOUT,\
+    QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION
+
+from tests.shared.comparison_utils import create_byte_array_input_stream
+
+class _ClientImpl:
+    # answers requests to an endpoint after as many seconds as set in
+    # delays, or fails them with reason code set in failures.
+    def __init__(self):
+        self.delays = {}
+        self.failures = {}
+        self.endpoints = []
+        self.res_body = None
+
+    async def send(self, remote_endpoint, request, options=None):
+        self.endpoints.append(remote_endpoint)
+        await trio.sleep(self.delays.get(remote_endpoint, 0))
+        reason_code = self.failures.get(remote_endpoint)
+        if reason_code:
+            raise QuasiHttpError(reason_code, "failed")
+        response = SimpleNamespace(status_code=200, body=None)
+        if self.res_body:
+            response.body = create_byte_array_input_stream(self.res_body)
+        async def release():
+            pass
+        response.release = release
+        return response
+
+    async def send2(self, remote_endpoint, request_func, options=None):
+        return await self.send(remote_endpoint, await request_func(None),
+                               options)
+
+async def _send(instance, remote_endpoint=None):
+    try:
+        return await instance.send(remote_endpoint, SimpleNamespace())
+    except QuasiHttpError:
+        return None
+
+async def test_least_outstanding(autojump_clock):
+    inner = _ClientImpl()
+    inner.delays = {"a": 10, "b": 10, "c": 1}
+    instance = BalancingQuasiHttpClient(inner, ["a", "b", "c"],
+        strategy=STRATEGY_LEAST_OUTSTANDING)
+    async with trio.open_nursery() as nursery:
+        for _ in range(3):
+            nursery.start_soon(_send, instance)
+        await trio.testing.wait_all_tasks_blocked()
+        assert sorted(inner.endpoints) == ["a", "b", "c"]
+        assert instance.get_endpoint_stats("a").outstanding == 1
+
+        # assert that endpoint which finishes early gets the next one.
+        await trio.sleep(2)
+        nursery.start_soon(_send, instance)
+        await trio.testing.wait_all_tasks_blocked()
+        assert inner.endpoints[3:] == ["c"]
+    assert instance.get_endpoint_stats("a").outstanding == 0
+
+    # assert that explicit endpoints are used as they are.
+    await _send(instance, "d")
+    assert inner.endpoints[-1] == "d"
+
+async def test_outstanding_until_release():
+    inner = _ClientImpl()
+    inner.res_body = b"data"
+    instance = BalancingQuasiHttpClient(inner, ["a", "b"])
+    res = await _send(instance)
+    assert instance.get_endpoint_stats(inner.endpoints[0]).outstanding == 1
+    await res.release()
+    await res.release()
+    assert instance.get_endpoint_stats(inner.endpoints[0]).outstanding == 0
+
+async def test_power_of_two_choices(autojump_clock):
+    inner = _ClientImpl()
+    inner.delays = {"a": 0.5, "b": 0.1}
+    instance = BalancingQuasiHttpClient(inner, ["a", "b"],
+        strategy=STRATEGY_POWER_OF_TWO_CHOICES, ewma_alpha=1)
+    await _send(instance, "a")
+    await _send(instance, "b")
+    assert instance.get_endpoint_stats("a").ewma_latency_millis == \
+        pytest.approx(500)
+
+    # assert that faster endpoint is preferred until it has about
+    # five times as many outstanding requests.
+    async with trio.open_nursery() as nursery:
+        for _ in range(6):
+            nursery.start_soon(_send, instance)
+            await trio.testing.wait_all_tasks_blocked()
+    assert inner.endpoints[2:] == ["b", "b", "b", "b", "a", "b"]
+
+@pytest.mark.parametrize("reason_code, expected_ejected",
+    [
+        (QUASI_HTTP_ERROR_REASON_GENERAL, True),
+        (QUASI_HTTP_ERROR_REASON_TIMEOUT, True),
+        (QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION, False),
+    ])
+async def test_ejection(autojump_clock, reason_code, expected_ejected):
+    inner = _ClientImpl()
+    inner.failures = {"a": reason_code}
+    instance = BalancingQuasiHttpClient(inner, ["a", "b"],
+        ejection_failure_threshold=2, base_ejection_time_millis=1000,
+        slow_start_millis=10_000)
+    for _ in range(2):
+        await _send(instance, "a")
+    stats = instance.get_endpoint_stats("a")
+    assert stats.ejected == expected_ejected
+    if not expected_ejected:
+        return
+    assert stats.failures == 2
+    for _ in range(3):
+        await _send(instance)
+    assert inner.endpoints[2:] == ["b"] * 3
+
+    # assert that endpoint is reintroduced with slow start.
+    await trio.sleep(1)
+    stats = instance.get_endpoint_stats("a")
+    assert not stats.ejected
+    assert stats.weight == MIN_SLOW_START_WEIGHT
+    await trio.sleep(5)
+    assert instance.get_endpoint_stats("a").weight == pytest.approx(0.5)
+    await trio.sleep(5)
+    assert instance.get_endpoint_stats("a").weight == 1
+
+    # assert that repeated ejections last longer.
+    for _ in range(2):
+        await _send(instance, "a")
+    assert instance.get_endpoint_stats("a").ejected
+    await trio.sleep(1)
+    assert instance.get_endpoint_stats("a").ejected
+    await trio.sleep(1)
+    assert not instance.get_endpoint_stats("a").ejected
+
+async def test_max_ejected_ratio(autojump_clock):
+    inner = _ClientImpl()
+    inner.failures = {"a": QUASI_HTTP_ERROR_REASON_GENERAL,
+                      "b": QUASI_HTTP_ERROR_REASON_GENERAL}
+    instance = BalancingQuasiHttpClient(inner, ["a", "b"],
+        ejection_failure_threshold=1)
+    await _send(instance, "a")
+    await _send(instance, "b")
+    assert instance.get_endpoint_stats("a").ejected
+    assert not instance.get_endpoint_stats("b").ejected
+
+async def test_slow_start_weight_in_least_outstanding(autojump_clock):
+    inner = _ClientImpl()
+    instance = BalancingQuasiHttpClient(inner, ["a", "b"],
+        ejection_failure_threshold=1, slow_start_millis=10_000)
+    inner.failures = {"a": QUASI_HTTP_ERROR_REASON_GENERAL}
+    await _send(instance, "a")
+    inner.failures = {}
+    inner.delays = {"a": 100, "b": 100}
+    await trio.sleep(10)
+
+    # a has weight of 0.1 right after reintroduction, so b should
+    # take requests until it has 10 times as many outstanding.
+    async with trio.open_nursery() as nursery:
+        for _ in range(12):
+            nursery.start_soon(_send, instance)
+            await trio.testing.wait_all_tasks_blocked()
+        assert inner.endpoints[1:].count("a") == 1
+        nursery.cancel_scope.cancel()
+
+async def test_send2_and_errors():
+    inner = _ClientImpl()
+    instance = BalancingQuasiHttpClient(inner, ["a"])
+    async def request_func(env):
+        return SimpleNamespace()
+    res = await instance.send2(None, request_func)
+    assert res.status_code == 200
+    assert inner.endpoints == ["a"]
+    with pytest.raises(MissingDependencyError):
+        await BalancingQuasiHttpClient(inner).send(None, SimpleNamespace())
+    with pytest.raises(ValueError):
+        await instance.send(None, None)
@@ -0,0 +1,206 @@
+import pytest
+import trio
+
+from types import SimpleNamespace
+
+from kabomu.CachingQuasiHttpClient import CachingQuasiHttpClient,\
+    ENTRY_OVERHEAD_SIZE
+from kabomu.abstractions import DefaultQuasiHttpRequest,\
+    DefaultQuasiHttpResponse
+from kabomu.errors import KabomuIOError
+
+from tests.shared.comparison_utils import create_byte_array_input_stream,\
+    read_all_bytes
+
+class _ClientImpl:
+    # answers with responses created by respond, and records requests.
+    def __init__(self, respond, bodyless_content_length=0):
+        self.respond = respond
+        self.bodyless_content_length = bodyless_content_length
+        self.requests = []
+        self.released = 0
+
+    async def send(self, remote_endpoint, request, options=None):
+        self.requests.append(request)
+        status_code, headers, body = self.respond(request)
+        response = DefaultQuasiHttpResponse(status_code=status_code,
+            headers=headers,
+            content_length=-1 if body else self.bodyless_content_length,
+            body=create_byte_array_input_stream(body) if body else None)
+        async def release():
+            self.released += 1
+        response.release = release
+        return response
+
+    async def send2(self, remote_endpoint, request_func, options=None):
+        return await self.send(remote_endpoint, await request_func(None),
+                               options)
+
+def _create_request(target="/config", http_method="GET", headers=None):
+    return DefaultQuasiHttpRequest(target=target, http_method=http_method,
+                                   headers=headers)
+
+async def _get_body(instance, request, remote_endpoint="a"):
+    response = await instance.send(remote_endpoint, request)
+    body = response.body and await read_all_bytes(response.body)
+    await response.release()
+    return response.status_code, body
+
+async def test_fresh_responses(autojump_clock):
+    inner = _ClientImpl(lambda r: (200,
+        {"cache-control": ["max-age=10"]}, r.target.encode()))
+    instance = CachingQuasiHttpClient(inner)
+    assert await _get_body(instance, _create_request()) == (200, b"/config")
+    await trio.sleep(5)
+    assert await _get_body(instance, _create_request()) == (200, b"/config")
+    assert len(inner.requests) == 1
+    assert inner.released == 1
+
+    # assert that key includes endpoint, method and target.
+    await _get_body(instance, _create_request(), "b")
+    await _get_body(instance, _create_request(http_method="HEAD"))
+    await _get_body(instance, _create_request("/other"))
+    assert len(inner.requests) == 4
+
+    # assert that stale entries are fetched again.
+    await trio.sleep(6)
+    assert await _get_body(instance, _create_request()) == (200, b"/config")
+    assert len(inner.requests) == 5
+    assert instance.stats == SimpleNamespace(hits=1, misses=5,
+                                             revalidated=0, evictions=0)
+
+@pytest.mark.parametrize("request_kwargs, res_headers, res_status_code",
+    [
+        ({"http_method": "POST"}, {"cache-control": ["max-age=10"]}, 200),
+        ({"http_method": None}, {"cache-control": ["max-age=10"]}, 200),
+        ({"headers": {"Cache-Control": ["no-store"]}},
+            {"cache-control": ["max-age=10"]}, 200),
+        ({}, {"cache-control": ["no-store, max-age=10"]}, 200),
+        ({}, {}, 200),
+        ({}, {"cache-control": ["max-age=10"]}, 500),
+    ])
+async def test_uncacheable_responses(request_kwargs, res_headers,
+                                     res_status_code):
+    inner = _ClientImpl(lambda r: (res_status_code, res_headers, b"data"))
+    instance = CachingQuasiHttpClient(inner)
+    for _ in range(2):
+        assert await _get_body(instance, _create_request(**request_kwargs)) \
+            == (res_status_code, b"data")
+    assert len(inner.requests) == 2
+    assert instance.entry_count == 0
+
+async def test_revalidation(autojump_clock):
+    version = [1]
+    def respond(request):
+        etag = f'"v{version[0]}"'
+        if (request.headers or {}).get("if-none-match") == [etag]:
+            return 304, {"cache-control": ["max-age=5"]}, None
+        return 200, {"etag": [etag]}, f"v{version[0]}".encode()
+    inner = _ClientImpl(respond)
+    instance = CachingQuasiHttpClient(inner)
+    request = _create_request(headers={"x": ["1"]})
+    assert await _get_body(instance, request) == (200, b"v1")
+    assert await _get_body(instance, request) == (200, b"v1")
+    assert inner.requests[1].headers == {"x": ["1"],
+                                         "if-none-match": ['"v1"']}
+    # assert that request of caller was left untouched.
+    assert request.headers == {"x": ["1"]}
+
+    # assert that revalidated entry is fresh for max-age of 304 response.
+    assert await _get_body(instance, request) == (200, b"v1")
+    assert len(inner.requests) == 2
+    await trio.sleep(6)
+    version[0] = 2
+    assert await _get_body(instance, request) == (200, b"v2")
+    assert len(inner.requests) == 3
+    assert instance.stats == SimpleNamespace(hits=1, misses=3,
+                                             revalidated=1, evictions=0)
+
+async def test_vary_header_names():
+    inner = _ClientImpl(lambda r: (200, {"cache-control": ["max-age=10"]},
+                                   r.headers["Accept"][0].encode()))
+    instance = CachingQuasiHttpClient(inner, vary_header_names=["accept"])
+    for accept in ["a", "b", "a", "b"]:
+        assert await _get_body(instance, _create_request(
+            headers={"Accept": [accept]})) == (200, accept.encode())
+    assert len(inner.requests) == 2
+
+async def test_lru_eviction():
+    inner = _ClientImpl(lambda r: (200, {"cache-control": ["max-age=10"]},
+                                   b"x" * 100))
+    entry_size = 100 + ENTRY_OVERHEAD_SIZE
+    instance = CachingQuasiHttpClient(inner, max_cache_size=2 * entry_size)
+    await _get_body(instance, _create_request("/1"))
+    await _get_body(instance, _create_request("/2"))
+    await _get_body(instance, _create_request("/1"))
+    await _get_body(instance, _create_request("/3"))
+    assert instance.entry_count == 2
+    assert instance.size == 2 * entry_size
+
+    # assert that /2 got evicted as least recently used.
+    await _get_body(instance, _create_request("/1"))
+    await _get_body(instance, _create_request("/2"))
+    assert [r.target for r in inner.requests] == ["/1", "/2", "/3", "/2"]
+    assert instance.stats == SimpleNamespace(hits=2, misses=4,
+                                             revalidated=0, evictions=2)
+
+async def test_large_bodies():
+    inner = _ClientImpl(lambda r: (200, {"cache-control": ["max-age=10"]},
+                                   b"0123456789"))
+    instance = CachingQuasiHttpClient(inner, max_cached_body_size=9)
+    for _ in range(2):
+        # assert that part read in attempt to cache is handed over.
+        assert await _get_body(instance, _create_request()) == \
+            (200, b"0123456789")
+    assert len(inner.requests) == 2
+    assert instance.entry_count == 0
+
+async def test_failing_bodies():
+    inner = _ClientImpl(lambda r: (200, {"cache-control": ["max-age=10"]},
+                                   b"data"))
+    class FailingStream:
+        async def receive_some(self, max_bytes=None):
+            raise KabomuIOError("read failed")
+    async def send(remote_endpoint, request, options=None):
+        response = await _ClientImpl.send(inner, remote_endpoint, request,
+                                          options)
+        response.body = FailingStream()
+        return response
+    inner.send = send
+    instance = CachingQuasiHttpClient(inner)
+    # assert that responses whose bodies fail to be read are released.
+    with pytest.raises(KabomuIOError, match="read failed"):
+        await instance.send("a", _create_request())
+    assert inner.released == 1
+    assert instance.entry_count == 0
+
+async def test_head_requests(autojump_clock):
+    inner = _ClientImpl(lambda r: (200, {"cache-control": ["max-age=10"]},
+                                   None), bodyless_content_length=1234)
+    instance = CachingQuasiHttpClient(inner)
+    for _ in range(2):
+        # assert that content length of body not sent is kept.
+        res = await instance.send("a", _create_request(http_method="HEAD"))
+        assert res.body is None
+        assert res.content_length == 1234
+    assert len(inner.requests) == 1
+
+    # assert that content length of received body is known.
+    inner = _ClientImpl(lambda r: (200, {"cache-control": ["max-age=10"]},
+                                   b"data"))
+    instance = CachingQuasiHttpClient(inner)
+    for _ in range(2):
+        res = await instance.send("a", _create_request())
+        assert res.content_length == 4
+    assert len(inner.requests) == 1
+
+async def test_send2():
+    inner = _ClientImpl(lambda r: (200, {"cache-control": ["max-age=10"]},
+                                   b"data"))
+    instance = CachingQuasiHttpClient(inner)
+    async def request_func(env):
+        return _create_request()
+    for _ in range(2):
+        res = await instance.send2("a", request_func)
+        assert await read_all_bytes(res.body) == b"data"
+    assert len(inner.requests) == 2
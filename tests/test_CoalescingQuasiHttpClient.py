@@ -0,0 +1,173 @@
+import pytest
+import trio
+import trio.testing
+
+from types import SimpleNamespace
+
+from kabomu.CoalescingQuasiHttpClient import CoalescingQuasiHttpClient
+from kabomu.abstractions import DefaultQuasiHttpRequest,\
+    DefaultQuasiHttpResponse,\
+    QuasiHttpProcessingOptions
+from kabomu.errors import QuasiHttpError,\
+    QUASI_HTTP_ERROR_REASON_GENERAL
+
+from tests.shared.comparison_utils import create_byte_array_input_stream,\
+    read_all_bytes
+
+class _ClientImpl:
+    # answers requests once gate is set, with bodies of res_body.
+    def __init__(self, res_body=b"data", fail_count=0,
+                 bodyless_content_length=0):
+        self.res_body = res_body
+        self.bodyless_content_length = bodyless_content_length
+        self.fail_count = fail_count
+        self.gate = trio.Event()
+        self.requests = []
+        self.released = 0
+
+    async def send(self, remote_endpoint, request, options=None):
+        self.requests.append(request)
+        await self.gate.wait()
+        if self.fail_count:
+            self.fail_count -= 1
+            raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_GENERAL,
+                                 "send failed")
+        response = DefaultQuasiHttpResponse(status_code=200,
+            headers={"n": [str(len(self.requests))]},
+            content_length=-1 if self.res_body else \
+                self.bodyless_content_length,
+            body=create_byte_array_input_stream(self.res_body)
+                if self.res_body else None)
+        async def release():
+            self.released += 1
+        response.release = release
+        return response
+
+async def _send_all(instance, requests):
+    results = [None] * len(requests)
+    async def send(i, request):
+        try:
+            res = await instance.send("a", request)
+            results[i] = (res.headers["n"][0],
+                          await read_all_bytes(res.body))
+            await res.release()
+        except QuasiHttpError as ex:
+            results[i] = ex
+    async with trio.open_nursery() as nursery:
+        for i, request in enumerate(requests):
+            nursery.start_soon(send, i, request)
+            # keep order of sending predictable.
+            await trio.testing.wait_all_tasks_blocked()
+        instance.client.gate.set()
+    return results
+
+def _create_request(target="/", http_method="GET", **kwargs):
+    return DefaultQuasiHttpRequest(target=target, http_method=http_method,
+                                   **kwargs)
+
+async def test_coalescing():
+    inner = _ClientImpl()
+    instance = CoalescingQuasiHttpClient(inner)
+    results = await _send_all(instance, [_create_request()
+                                         for _ in range(5)])
+    assert results == [("1", b"data")] * 5
+    assert len(inner.requests) == 1
+    assert inner.released == 1
+    assert instance.stats == SimpleNamespace(exchanges=1, coalesced=4,
+                                             fallbacks=0)
+
+    # assert that requests after completion aren't coalesced with
+    # earlier ones.
+    results = await _send_all(instance, [_create_request()])
+    assert results == [("2", b"data")]
+
+async def test_non_identical_requests():
+    inner = _ClientImpl()
+    instance = CoalescingQuasiHttpClient(inner)
+    requests = [
+        _create_request("/1"),
+        _create_request("/2"),
+        _create_request("/1", headers={"X": ["1"]}),
+        _create_request("/1", headers={"x": "1"}),
+        _create_request("/1", http_method="HEAD"),
+        _create_request("/1", http_method="POST"),
+        _create_request("/1", http_method=None),
+        _create_request("/1", body=create_byte_array_input_stream(b"d")),
+    ]
+    results = await _send_all(instance, requests)
+    assert len(inner.requests) == 7
+    assert results[3] == results[2]
+
+async def test_send_options():
+    inner = _ClientImpl()
+    instance = CoalescingQuasiHttpClient(inner)
+    results = []
+    async def send(options):
+        res = await instance.send("a", _create_request(), options)
+        results.append(await read_all_bytes(res.body))
+        await res.release()
+    async with trio.open_nursery() as nursery:
+        # assert that equal but distinct send options are coalesced,
+        # while those of other values aren't.
+        for timeout_millis in [1000, 1000, 2000]:
+            nursery.start_soon(send, QuasiHttpProcessingOptions(
+                timeout_millis=timeout_millis))
+            await trio.testing.wait_all_tasks_blocked()
+        inner.gate.set()
+    assert results == [b"data"] * 3
+    assert len(inner.requests) == 2
+
+async def test_key_func():
+    inner = _ClientImpl()
+    instance = CoalescingQuasiHttpClient(inner,
+        key_func=lambda e, r, o: r.target[:2])
+    results = await _send_all(instance, [
+        _create_request("/a1", http_method="POST"),
+        _create_request("/a2"),
+        _create_request("/b1")])
+    assert [r.target for r in inner.requests] == ["/a1", "/b1"]
+    assert results[0] == results[1]
+
+async def test_large_bodies():
+    inner = _ClientImpl(res_body=b"0123456789")
+    instance = CoalescingQuasiHttpClient(inner, max_buffered_body_size=9)
+    results = await _send_all(instance, [_create_request()
+                                         for _ in range(3)])
+    assert [r[1] for r in results] == [b"0123456789"] * 3
+    assert len(inner.requests) == 3
+    assert instance.stats == SimpleNamespace(exchanges=1, coalesced=2,
+                                             fallbacks=2)
+
+async def test_head_requests():
+    inner = _ClientImpl(res_body=None, bodyless_content_length=1234)
+    instance = CoalescingQuasiHttpClient(inner)
+    responses = []
+    async def send():
+        responses.append(await instance.send("a",
+            _create_request(http_method="HEAD")))
+    async with trio.open_nursery() as nursery:
+        for _ in range(3):
+            nursery.start_soon(send)
+        await trio.testing.wait_all_tasks_blocked()
+        inner.gate.set()
+    assert len(inner.requests) == 1
+    # assert that content length of body not sent is kept.
+    assert [(r.body, r.content_length) for r in responses] == \
+        [(None, 1234)] * 3
+
+@pytest.mark.parametrize("share_errors", [False, True])
+async def test_errors(share_errors):
+    inner = _ClientImpl(fail_count=1)
+    instance = CoalescingQuasiHttpClient(inner, share_errors=share_errors)
+    results = await _send_all(instance, [_create_request()
+                                         for _ in range(3)])
+    assert isinstance(results[0], QuasiHttpError)
+    if share_errors:
+        for ex in results[1:]:
+            assert isinstance(ex, QuasiHttpError)
+            assert "coalesced request failed" in str(ex)
+            assert ex.__cause__ is results[0]
+        assert len(inner.requests) == 1
+    else:
+        assert [r[1] for r in results[1:]] == [b"data", b"data"]
+        assert len(inner.requests) == 3
@@ -0,0 +1,62 @@
+import pytest
+
+from kabomu.HedgingPolicy import HedgingPolicy,\
+    DEFAULT_INITIAL_DELAY_MILLIS,\
+    MIN_SAMPLE_COUNT,\
+    REFRESH_INTERVAL
+
+def test_delay_before_enough_samples():
+    instance = HedgingPolicy()
+    assert instance.get_delay_millis() == DEFAULT_INITIAL_DELAY_MILLIS
+    instance = HedgingPolicy(initial_delay_millis=7)
+    for _ in range(MIN_SAMPLE_COUNT - 1):
+        instance._on_response(1000, False)
+    assert instance.get_delay_millis() == 7
+
+@pytest.mark.parametrize("percentile, expected",
+    [
+        (None, 95),
+        (50, 50),
+        (99, 99),
+        (100, 100),
+        (200, 95),
+    ])
+def test_delay_percentile(percentile, expected):
+    instance = HedgingPolicy(percentile=percentile)
+    for latency in range(100, 0, -1):
+        instance._on_response(latency, False)
+    assert instance.get_delay_millis() == expected
+
+def test_delay_bounds_and_refresh():
+    instance = HedgingPolicy(percentile=50, min_delay_millis=5,
+                             max_delay_millis=20, sample_size=MIN_SAMPLE_COUNT)
+    for _ in range(MIN_SAMPLE_COUNT):
+        instance._on_response(1, False)
+    assert instance.get_delay_millis() == 5
+
+    # assert that percentile is only recomputed every now and then.
+    for _ in range(REFRESH_INTERVAL - 1):
+        instance._on_response(100, False)
+    assert instance.get_delay_millis() == 5
+    instance._on_response(100, False)
+    assert instance.get_delay_millis() == 20
+
+def test_hedge_budget():
+    instance = HedgingPolicy(max_hedge_ratio=0.5)
+    instance._on_request()
+    assert not instance._try_hedge()
+    instance._on_request()
+    assert instance._try_hedge()
+    instance._on_request()
+    assert not instance._try_hedge()
+    instance._on_request()
+    assert instance._try_hedge()
+    instance._on_response(10, True)
+    assert instance.stats.hedged == 2
+    assert instance.hedge_rate == 0.5
+    assert instance.hedge_win_rate == 0.5
+
+def test_hedge_endpoint():
+    assert HedgingPolicy().get_hedge_endpoint("a") == "a"
+    instance = HedgingPolicy(hedge_endpoint_func=lambda e: e * 2)
+    assert instance.get_hedge_endpoint("a") == "aa"
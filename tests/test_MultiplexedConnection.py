@@ -0,0 +1,213 @@
+import pytest
+import trio
+import trio.testing
+
+from kabomu.MultiplexedConnection import MultiplexedConnection,\
+    INITIAL_WINDOW_SIZE
+from kabomu.errors import KabomuIOError
+from kabomu.tlv import tlv_utils
+
+from tests.shared.comparison_utils import read_all_bytes
+
+def _create_pair(**kwargs):
+    a, b = trio.testing.memory_stream_pair()
+    return (MultiplexedConnection(a, a, True, **kwargs),
+            MultiplexedConnection(b, b, False, **kwargs), a, b)
+
+async def _run(connection):
+    try:
+        await connection.run()
+    except KabomuIOError:
+        pass
+
+async def test_concurrent_streams():
+    client, server, _, _ = _create_pair(max_frame_size=10)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(_run, client)
+        nursery.start_soon(_run, server)
+        s1 = await client.open_stream()
+        s2 = await client.open_stream()
+        assert (s1.stream_id, s2.stream_id) == (1, 3)
+
+        # interleave writes to both streams.
+        await s1.send_all(b"first part of s1 ")
+        await s2.send_all(b"s2")
+        await s1.send_all(b"and the rest")
+        await s2.send_eof()
+        await s1.send_eof()
+
+        r1 = await server.accept_stream()
+        r2 = await server.accept_stream()
+        assert (r1.stream_id, r2.stream_id) == (1, 3)
+        assert await read_all_bytes(r2) == b"s2"
+        assert await read_all_bytes(r1) == b"first part of s1 and the rest"
+
+        # reply on stream opened by client.
+        await r1.send_all(b"reply")
+        await r1.aclose()
+        assert await read_all_bytes(s1) == b"reply"
+        await s1.aclose()
+        await r2.aclose()
+        await s2.aclose()
+        await trio.testing.wait_all_tasks_blocked()
+        assert client.stream_count == 0
+        assert server.stream_count == 0
+
+        # assert that server can open streams too.
+        r3 = await server.open_stream()
+        assert r3.stream_id == 2
+        await r3.send_all(b"pushed")
+        s3 = await client.accept_stream()
+        assert await s3.receive_some(3) == b"pus"
+        assert await s3.receive_some() == b"hed"
+        nursery.cancel_scope.cancel()
+
+async def test_flow_control():
+    client, server, _, _ = _create_pair(
+        receive_window_size=INITIAL_WINDOW_SIZE)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(_run, client)
+        nursery.start_soon(_run, server)
+        large = await client.open_stream()
+        small = await client.open_stream()
+        sent = []
+        async def send_large():
+            await large.send_all(b"x" * (INITIAL_WINDOW_SIZE + 10))
+            sent.append(True)
+        nursery.start_soon(send_large)
+        await trio.testing.wait_all_tasks_blocked()
+        assert not sent
+
+        # assert that unread stream doesn't hold up others.
+        await small.send_all(b"small")
+        await small.send_eof()
+        r_large = await server.accept_stream()
+        r_small = await server.accept_stream()
+        assert await read_all_bytes(r_small) == b"small"
+
+        # reading large stream should open window.
+        received = 0
+        while received < INITIAL_WINDOW_SIZE + 10:
+            received += len(await r_large.receive_some(20_000))
+        await trio.testing.wait_all_tasks_blocked()
+        assert sent
+        nursery.cancel_scope.cancel()
+
+async def test_flow_control_violation():
+    a, b = trio.testing.memory_stream_pair()
+    server = MultiplexedConnection(b, b, False,
+        receive_window_size=INITIAL_WINDOW_SIZE)
+    async with trio.open_nursery() as nursery:
+        async def run():
+            with pytest.raises(KabomuIOError) as ex_info:
+                await server.run()
+            assert "window" in str(ex_info.value.__cause__)
+        nursery.start_soon(run)
+        payload = b"x" * 20_000
+        for _ in range(INITIAL_WINDOW_SIZE // len(payload) + 1):
+            await a.send_all(tlv_utils.encode_stream_frame_header(1,
+                tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_DATA, len(payload)) +
+                payload)
+        stream = await server.accept_stream()
+        await trio.testing.wait_all_tasks_blocked()
+        assert server.closed
+        with pytest.raises(KabomuIOError):
+            await read_all_bytes(stream)
+
+async def test_reset():
+    client, server, _, _ = _create_pair()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(_run, client)
+        nursery.start_soon(_run, server)
+        s = await client.open_stream()
+        await s.send_all(b"abc")
+        r = await server.accept_stream()
+        assert await r.receive_some() == b"abc"
+
+        # assert that closing stream before end of read stops sender.
+        await r.aclose()
+        await trio.testing.wait_all_tasks_blocked()
+        with pytest.raises(KabomuIOError) as ex_info:
+            await s.send_all(b"def")
+        assert "reset" in str(ex_info.value)
+        assert await s.receive_some() == b""
+        await s.aclose()
+        assert client.stream_count == 0
+        assert server.stream_count == 0
+        nursery.cancel_scope.cancel()
+
+async def test_connection_failure():
+    client, server, a, _ = _create_pair()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(_run, client)
+        nursery.start_soon(_run, server)
+        s = await client.open_stream()
+        await s.send_all(b"abc")
+        r = await server.accept_stream()
+        await a.aclose()
+        await trio.testing.wait_all_tasks_blocked()
+        assert server.closed
+        assert await server.accept_stream() is None
+        assert await r.receive_some() == b"abc"
+        with pytest.raises(KabomuIOError):
+            await r.receive_some()
+        with pytest.raises(KabomuIOError):
+            await r.send_all(b"def")
+        with pytest.raises(KabomuIOError):
+            await server.open_stream()
+
+async def test_max_concurrent_streams():
+    client, server, _, _ = _create_pair(max_concurrent_streams=1)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(_run, client)
+        nursery.start_soon(_run, server)
+        s1 = await client.open_stream()
+        s2 = await client.open_stream()
+        await s1.send_all(b"1")
+        await s2.send_all(b"2")
+        r1 = await server.accept_stream()
+        assert await r1.receive_some() == b"1"
+        async def accept():
+            await server.accept_stream()
+        nursery.start_soon(accept)
+        await trio.testing.wait_all_tasks_blocked()
+
+        # assert that stream beyond limit got refused.
+        with pytest.raises(KabomuIOError, match="reset"):
+            await s2.send_all(b"2")
+        nursery.cancel_scope.cancel()
+
+async def test_cancelled_sends():
+    a, b = trio.testing.memory_stream_pair()
+    # let writes get stuck until asked to proceed.
+    write_gate = trio.Event()
+    written = []
+    class GatedStream:
+        async def send_all(self, data):
+            await write_gate.wait()
+            written.append(bytes(data))
+    connection = MultiplexedConnection(a, GatedStream(), True,
+        receive_window_size=INITIAL_WINDOW_SIZE)
+    s1 = await connection.open_stream()
+    s2 = await connection.open_stream()
+    payload = bytearray(b"abc")
+    cancel_scope = trio.CancelScope()
+    async def send_cancelled():
+        with cancel_scope:
+            await s2.send_all(payload)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(s1.send_all, b"first")
+        await trio.testing.wait_all_tasks_blocked()
+        nursery.start_soon(send_cancelled)
+        await trio.testing.wait_all_tasks_blocked()
+        cancel_scope.cancel()
+        await trio.testing.wait_all_tasks_blocked()
+
+        # assert that frame of cancelled send is left out of
+        # later writes.
+        payload[:] = b"xyz"
+        write_gate.set()
+    await s1.send_all(b"second")
+    assert b"first" in written[0]
+    assert b"second" in written[-1]
+    assert not any(b"abc" in w or b"xyz" in w for w in written)
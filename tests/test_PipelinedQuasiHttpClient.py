@@ -0,0 +1,383 @@
+import pytest
+import trio
+import trio.testing
+
+from types import SimpleNamespace
+
+from kabomu.PipelinedQuasiHttpClient import PipelinedQuasiHttpClient
+from kabomu.PooledQuasiHttpClientTransport import\
+    PooledQuasiHttpClientTransport
+from kabomu.abstractions import DefaultTimeoutResult,\
+    QuasiHttpProcessingOptions
+from kabomu.errors import QuasiHttpError,\
+    QUASI_HTTP_ERROR_REASON_GENERAL,\
+    QUASI_HTTP_ERROR_REASON_TIMEOUT
+from kabomu import protocol_utils_internal
+
+from tests.shared.comparison_utils import create_byte_array_input_stream,\
+    read_all_bytes
+
+class _StallingStream:
+    # supplies data, and then stalls without ending.
+    def __init__(self, data):
+        self.data = data
+
+    async def receive_some(self, max_bytes=None):
+        if not self.data:
+            await trio.sleep_forever()
+        data, self.data = self.data, b""
+        return data
+
+async def _serve(stream, server):
+    # answers requests in batches, so that clients which wait for
+    # each response before sending next request get stuck.
+    # first request is answered alone, as it has to be before clients
+    # can learn that connection will be kept alive.
+    connection = SimpleNamespace()
+    request_count = 0
+    while True:
+        requests = []
+        first = not request_count
+        try:
+            while len(requests) < (1 if first else server.batch_size):
+                request = await protocol_utils_internal.read_entity_from_transport(
+                    False, stream, connection)
+                if request.body:
+                    await read_all_bytes(request.body)
+                requests.append(request)
+        except Exception:
+            break
+        for request in requests:
+            request_count += 1
+            server.targets.append(request.target)
+            keep_alive = server.keep_alive and \
+                protocol_utils_internal.has_keep_alive_header(
+                    request.headers)
+            if request_count == server.max_requests:
+                # close without answering rest of requests.
+                keep_alive = False
+            connection.keep_alive = keep_alive
+            res_body = server.res_body
+            response = SimpleNamespace(status_code=200,
+                content_length=len(res_body),
+                body=create_byte_array_input_stream(res_body)
+                    if res_body else None,
+                headers={"target": request.target})
+            if request.target == "/stall":
+                response.content_length = -1
+                response.body = _StallingStream(res_body)
+            await protocol_utils_internal.write_entity_to_transport(
+                True, response, stream, connection)
+            if request.target == "/crash" or not keep_alive:
+                await stream.aclose()
+                return
+    await stream.aclose()
+
+class _TransportImpl:
+    def __init__(self, nursery, keep_alive=True, batch_size=1,
+                 max_requests=0, res_body=b""):
+        self.nursery = nursery
+        self.keep_alive = keep_alive
+        self.batch_size = batch_size
+        self.max_requests = max_requests
+        self.res_body = res_body
+        self.targets = []
+        self.connections = []
+
+    async def allocate_connection(self, remote_endpoint, send_options):
+        client_stream, server_stream = trio.testing.memory_stream_pair()
+        self.nursery.start_soon(_serve, server_stream, self)
+        connection = SimpleNamespace(stream=client_stream, released=False,
+            processing_options=send_options)
+        timeout_millis = getattr(send_options, "timeout_millis", None)
+        if timeout_millis:
+            async def schedule_timeout(proc):
+                with trio.move_on_after(timeout_millis / 1000.0):
+                    return DefaultTimeoutResult(response=await proc())
+                return DefaultTimeoutResult(timeout=True)
+            connection.schedule_timeout = schedule_timeout
+        self.connections.append(connection)
+        return connection
+
+    async def establish_connection(self, connection):
+        pass
+
+    async def release_connection(self, connection, response):
+        if response and response.body:
+            return
+        connection.released = True
+        await connection.stream.aclose()
+
+    def get_readable_stream(self, connection):
+        return connection.stream
+
+    def get_writable_stream(self, connection):
+        return connection.stream
+
+async def _send_all(client, targets, results, req_body=None):
+    async def send(i, target):
+        try:
+            request = SimpleNamespace(target=target)
+            if req_body:
+                request.body = create_byte_array_input_stream(req_body)
+                request.content_length = -1
+            res = await client.send("a", request)
+            body = res.body and await read_all_bytes(res.body)
+            await res.release()
+            results[i] = (res.headers["target"][0], body)
+        except QuasiHttpError as ex:
+            results[i] = ex
+    async with trio.open_nursery() as nursery:
+        for i, target in enumerate(targets):
+            nursery.start_soon(send, i, target)
+            # keep order of sending predictable.
+            await trio.testing.wait_all_tasks_blocked()
+
+async def test_pipelining():
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            inner = _TransportImpl(nursery, batch_size=4, res_body=b"r")
+            client = PipelinedQuasiHttpClient(
+                PooledQuasiHttpClientTransport(inner), max_pipeline_depth=4)
+
+            # send first request alone for server to agree to
+            # keep-alive.
+            results = [None]
+            await _send_all(client, ["/0"], results)
+            assert results == [("/0", b"r")]
+
+            targets = [f"/{i}" for i in range(1, 9)]
+            results = [None] * len(targets)
+            await _send_all(client, targets, results)
+            assert results == [(t, b"r") for t in targets]
+            assert inner.targets == ["/0"] + targets
+            assert len(inner.connections) == 1
+            nursery.cancel_scope.cancel()
+
+async def test_pipeline_depth_bound():
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            # server needs 3 requests before it answers, so depth of 2
+            # must get stuck.
+            inner = _TransportImpl(nursery, batch_size=3)
+            client = PipelinedQuasiHttpClient(
+                PooledQuasiHttpClientTransport(inner), max_pipeline_depth=2)
+            await _send_all(client, ["/"], [None])
+            results = [None] * 3
+            with trio.move_on_after(1):
+                await _send_all(client, ["/1", "/2", "/3"], results)
+            assert results == [None] * 3
+            assert inner.targets == ["/"]
+            nursery.cancel_scope.cancel()
+
+async def test_no_pipelining_without_keep_alive():
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            inner = _TransportImpl(nursery, keep_alive=False)
+            client = PipelinedQuasiHttpClient(inner)
+            targets = ["/0", "/1", "/2"]
+            results = [None] * len(targets)
+            await _send_all(client, targets, results)
+            assert results == [(t, None) for t in targets]
+            assert len(inner.connections) == 3
+            assert all(c.released for c in inner.connections)
+            nursery.cancel_scope.cancel()
+
+@pytest.mark.parametrize("req_body", [None, b"data"])
+async def test_server_closing_pipeline(req_body):
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            inner = _TransportImpl(nursery, batch_size=2, max_requests=2)
+            client = PipelinedQuasiHttpClient(
+                PooledQuasiHttpClientTransport(inner))
+            await _send_all(client, ["/0"], [None], req_body)
+            results = [None] * 2
+            await _send_all(client, ["/1", "/2"], results, req_body)
+            assert results[0] == ("/1", None)
+            if req_body:
+                # requests whose bodies were consumed can't be sent again.
+                assert isinstance(results[1], QuasiHttpError)
+                assert "closed by remote endpoint" in str(results[1])
+                assert inner.targets == ["/0", "/1"]
+            else:
+                assert results[1] == ("/2", None)
+                assert inner.targets == ["/0", "/1", "/2"]
+                assert len(inner.connections) == 2
+            nursery.cancel_scope.cancel()
+
+async def test_failure_propagation():
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            inner = _TransportImpl(nursery, batch_size=4)
+            client = PipelinedQuasiHttpClient(
+                PooledQuasiHttpClientTransport(inner))
+            await _send_all(client, ["/0"], [None])
+            results = [None] * 4
+            await _send_all(client, ["/1", "/crash", "/3", "/4"], results)
+            assert results[:2] == [("/1", None), ("/crash", None)]
+            for ex in results[2:]:
+                assert isinstance(ex, QuasiHttpError)
+            assert "earlier exchange" in str(results[3])
+
+            # assert that failed connection is given up.
+            assert all(c.released for c in inner.connections)
+            results = [None]
+            await _send_all(client, ["/5"], results)
+            assert results == [("/5", None)]
+            assert len(inner.connections) == 2
+            nursery.cancel_scope.cancel()
+
+async def test_response_release():
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            inner = _TransportImpl(nursery, batch_size=3, res_body=b"hello")
+            client = PipelinedQuasiHttpClient(
+                PooledQuasiHttpClientTransport(inner), max_drain_size=2)
+            res = await client.send("a", SimpleNamespace(target="/"))
+            assert await read_all_bytes(res.body) == b"hello"
+            await res.release()
+
+            # assert that next response is only read after release
+            # of earlier one.
+            responses = []
+            errors = []
+            async def send(target):
+                try:
+                    responses.append(await client.send("a",
+                        SimpleNamespace(target=target)))
+                except QuasiHttpError as ex:
+                    errors.append(ex)
+            nursery.start_soon(send, "/0")
+            await trio.testing.wait_all_tasks_blocked()
+            nursery.start_soon(send, "/1")
+            await trio.testing.wait_all_tasks_blocked()
+            nursery.start_soon(send, "/2")
+            await trio.testing.wait_all_tasks_blocked()
+            assert len(responses) == 1
+            assert await responses[0].body.receive_some(3) == b"hel"
+            await responses[0].release()
+            await trio.testing.wait_all_tasks_blocked()
+            assert len(responses) == 2
+
+            # assert that bodies which can't be drained fail the rest.
+            await responses[1].release()
+            await trio.testing.wait_all_tasks_blocked()
+            assert len(responses) == 2
+            assert len(errors) == 1
+            assert "earlier exchange" in str(errors[0])
+            assert "could not be drained" in str(errors[0].__cause__)
+            assert inner.connections[0].released
+            nursery.cancel_scope.cancel()
+
+async def test_drain_of_stalled_body(autojump_clock):
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery, res_body=b"hello")
+        client = PipelinedQuasiHttpClient(
+            PooledQuasiHttpClientTransport(inner), drain_timeout_millis=1000)
+        await (await client.send("a", SimpleNamespace(target="/0"))).release()
+        responses = []
+        errors = []
+        async def send(target):
+            try:
+                responses.append(await client.send("a",
+                    SimpleNamespace(target=target)))
+            except QuasiHttpError as ex:
+                errors.append(ex)
+        nursery.start_soon(send, "/stall")
+        await trio.testing.wait_all_tasks_blocked()
+        nursery.start_soon(send, "/1")
+        await trio.testing.wait_all_tasks_blocked()
+        assert len(responses) == 1
+        assert await responses[0].body.receive_some(1) == b"h"
+
+        # assert that release gives up on body whose peer stopped
+        # sending, and fails exchange queued behind it.
+        start_time = trio.current_time()
+        await responses[0].release()
+        assert trio.current_time() - start_time == 1
+        await trio.testing.wait_all_tasks_blocked()
+        assert len(errors) == 1
+        assert "could not be drained" in str(errors[0].__cause__)
+        assert inner.connections[0].released
+        nursery.cancel_scope.cancel()
+
+async def test_timeout(autojump_clock):
+    async with trio.open_nursery() as nursery:
+        # server needs 4 requests before it answers, so it stalls.
+        inner = _TransportImpl(nursery, batch_size=4)
+        client = PipelinedQuasiHttpClient(
+            PooledQuasiHttpClientTransport(inner))
+        send_options = QuasiHttpProcessingOptions(timeout_millis=1000)
+        await client.send("a", SimpleNamespace(target="/0"), send_options)
+        errors = []
+        async def send(target):
+            try:
+                await client.send("a", SimpleNamespace(target=target),
+                                  send_options)
+            except QuasiHttpError as ex:
+                errors.append((ex, trio.current_time()))
+        start_time = trio.current_time()
+        async with trio.open_nursery() as senders:
+            senders.start_soon(send, "/1")
+            await trio.sleep(0.5)
+            senders.start_soon(send, "/2")
+
+        # assert that timeout of first exchange fails the one queued
+        # behind it, and closes connection.
+        assert [ex.reason_code for ex, _ in errors] == [
+            QUASI_HTTP_ERROR_REASON_TIMEOUT, QUASI_HTTP_ERROR_REASON_GENERAL]
+        assert all(t - start_time == pytest.approx(1) for _, t in errors)
+        assert inner.connections[0].released
+
+        # assert that a new connection is used afterwards.
+        res = await client.send("a", SimpleNamespace(target="/3"),
+                                send_options)
+        assert res.headers["target"] == ["/3"]
+        assert len(inner.connections) == 2
+        nursery.cancel_scope.cancel()
+
+async def test_serializers_and_shared_send_options():
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            inner = _TransportImpl(nursery)
+            calls = []
+            async def request_serializer(connection, request):
+                calls.append(("request", request.target))
+                return False
+            async def response_deserializer(connection):
+                response = await protocol_utils_internal.read_entity_from_transport(
+                    True, connection.stream, connection)
+                calls.append(("response", response.headers["target"][0]))
+                return response
+            inner.request_serializer = request_serializer
+            inner.response_deserializer = response_deserializer
+            client = PipelinedQuasiHttpClient(
+                PooledQuasiHttpClientTransport(inner))
+            for target in ["/0", "/1"]:
+                # assert that send options of the same values share
+                # connections.
+                await client.send("a", SimpleNamespace(target=target),
+                    QuasiHttpProcessingOptions(timeout_millis=1000))
+            assert calls == [("request", "/0"), ("response", "/0"),
+                             ("request", "/1"), ("response", "/1")]
+            assert len(inner.connections) == 1
+            nursery.cancel_scope.cancel()
+
+async def test_eager_response_body_buffering():
+    with trio.fail_after(5):
+        async with trio.open_nursery() as nursery:
+            inner = _TransportImpl(nursery, res_body=b"hello")
+            client = PipelinedQuasiHttpClient(
+                PooledQuasiHttpClientTransport(inner))
+            send_options = QuasiHttpProcessingOptions(
+                max_eager_response_body_size=5)
+            responses = []
+            for target in ["/0", "/1", "/2"]:
+                # assert that unreleased responses don't hold up
+                # later ones.
+                responses.append(await client.send("a",
+                    SimpleNamespace(target=target), send_options))
+            for res in responses:
+                assert await read_all_bytes(res.body) == b"hello"
+            assert len(inner.connections) == 1
+            nursery.cancel_scope.cancel()
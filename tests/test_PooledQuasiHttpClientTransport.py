@@ -0,0 +1,369 @@
+import fcntl
+import os
+
+import pytest
+import trio
+import trio.testing
+
+from types import SimpleNamespace
+
+from kabomu.PooledQuasiHttpClientTransport import\
+    PooledQuasiHttpClientTransport, _is_readable_now
+from kabomu.StandardQuasiHttpClient import StandardQuasiHttpClient
+from kabomu import protocol_utils_internal
+
+from tests.shared.comparison_utils import create_byte_array_input_stream,\
+    read_all_bytes
+
+class _StallingStream:
+    # supplies data, and then stalls without ending.
+    def __init__(self, data):
+        self.data = data
+
+    async def receive_some(self, max_bytes=None):
+        if not self.data:
+            await trio.sleep_forever()
+        data, self.data = self.data, b""
+        return data
+
+async def _serve(stream, keep_alive, res_body, stall_body=False):
+    # answers requests on stream until client closes it.
+    connection = SimpleNamespace(keep_alive=keep_alive)
+    while True:
+        try:
+            request = await protocol_utils_internal.read_entity_from_transport(
+                False, stream, connection)
+        except Exception:
+            break
+        if request.body:
+            await read_all_bytes(request.body)
+        response = SimpleNamespace(status_code=200,
+            content_length=len(res_body),
+            body=create_byte_array_input_stream(res_body)
+                if res_body else None,
+            headers={"target": request.target})
+        if stall_body:
+            response.content_length = -1
+            response.body = _StallingStream(res_body)
+        await protocol_utils_internal.write_entity_to_transport(
+            True, response, stream, connection)
+        if not keep_alive:
+            break
+    await stream.aclose()
+
+class _TransportImpl:
+    def __init__(self, nursery, keep_alive=True, res_body=b"",
+                 stall_body=False):
+        self.nursery = nursery
+        self.keep_alive = keep_alive
+        self.res_body = res_body
+        self.stall_body = stall_body
+        self.connections = []
+        self.establish_count = 0
+
+    async def allocate_connection(self, remote_endpoint, send_options):
+        client_stream, server_stream = trio.testing.memory_stream_pair()
+        self.nursery.start_soon(_serve, server_stream, self.keep_alive,
+                                self.res_body, self.stall_body)
+        connection = SimpleNamespace(stream=client_stream,
+            processing_options=send_options, released=False)
+        self.connections.append(connection)
+        return connection
+
+    async def establish_connection(self, connection):
+        self.establish_count += 1
+
+    async def release_connection(self, connection, response):
+        if response and response.body:
+            return
+        connection.released = True
+        await connection.stream.aclose()
+
+    def get_readable_stream(self, connection):
+        return connection.stream
+
+    def get_writable_stream(self, connection):
+        return connection.stream
+
+async def _send(client, target, remote_endpoint="a", send_options=None):
+    return await client.send(remote_endpoint,
+        SimpleNamespace(target=target), send_options)
+
+async def test_reuse():
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery)
+        pool = PooledQuasiHttpClientTransport(inner)
+        client = StandardQuasiHttpClient(pool)
+        for i in range(3):
+            res = await _send(client, f"/{i}")
+            assert res.headers["target"] == [f"/{i}"]
+            assert res.headers["connection"] == ["keep-alive"]
+            await res.release()
+        assert len(inner.connections) == 1
+        assert inner.establish_count == 1
+        assert pool.stats.created == 1
+        assert pool.stats.reused == 2
+        assert pool.stats.pooled == 3
+        assert pool.idle_connection_count == 1
+
+        # assert that other endpoints and send options get their own
+        # connections, while send options of the same values
+        # share them.
+        await (await _send(client, "/", "b")).release()
+        for _ in range(2):
+            await (await _send(client, "/", "a",
+                SimpleNamespace(timeout_millis=1000,
+                    extra_connectivity_params={"x": [1]},
+                    idempotent=True))).release()
+        await (await _send(client, "/", "a",
+            SimpleNamespace(timeout_millis=1000,
+                extra_connectivity_params={"x": [1]}))).release()
+        await (await _send(client, "/", "a",
+            SimpleNamespace(timeout_millis=None))).release()
+        assert len(inner.connections) == 3
+        assert pool.idle_connection_count == 3
+
+        await pool.close_idle_connections()
+        assert pool.idle_connection_count == 0
+        assert pool.stats.discarded == 3
+        assert all(c.released for c in inner.connections)
+        nursery.cancel_scope.cancel()
+
+async def test_no_reuse_without_server_agreement():
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery, keep_alive=None)
+        pool = PooledQuasiHttpClientTransport(inner)
+        client = StandardQuasiHttpClient(pool)
+        for i in range(2):
+            res = await _send(client, "/")
+            assert "connection" not in res.headers
+        assert len(inner.connections) == 2
+        assert pool.stats.reused == 0
+        assert pool.stats.discarded == 2
+        assert all(c.released for c in inner.connections)
+        nursery.cancel_scope.cancel()
+
+@pytest.mark.parametrize("bytes_to_read, max_drain_size, expected_reuse",
+    [
+        (None, None, True),
+        (0, None, True),
+        (3, 2, True),
+        (0, 2, False),
+    ])
+async def test_reuse_after_body_release(bytes_to_read, max_drain_size,
+        expected_reuse):
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery, res_body=b"hello")
+        pool = PooledQuasiHttpClientTransport(inner,
+            max_drain_size=max_drain_size)
+        client = StandardQuasiHttpClient(pool)
+        res = await _send(client, "/")
+        if bytes_to_read is None:
+            assert await read_all_bytes(res.body) == b"hello"
+        elif bytes_to_read:
+            assert await res.body.receive_some(bytes_to_read) == \
+                b"hello"[:bytes_to_read]
+
+        # assert that connection is not reused before body is released.
+        res2 = await _send(client, "/")
+        assert len(inner.connections) == 2
+
+        await res.release()
+        assert inner.connections[0].released != expected_reuse
+        assert pool.idle_connection_count == (1 if expected_reuse else 0)
+
+        # assert that releasing more than once has no effect.
+        await res.release()
+        assert pool.idle_connection_count == (1 if expected_reuse else 0)
+        await res2.release()
+        nursery.cancel_scope.cancel()
+
+@pytest.mark.parametrize("drain_timeout_millis, expected_time",
+    [(None, 5), (1000, 1)])
+async def test_drain_of_stalled_body(autojump_clock, drain_timeout_millis,
+                                     expected_time):
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery, res_body=b"hello", stall_body=True)
+        pool = PooledQuasiHttpClientTransport(inner,
+            drain_timeout_millis=drain_timeout_millis)
+        client = StandardQuasiHttpClient(pool)
+        res = await _send(client, "/")
+        assert await res.body.receive_some(1) == b"h"
+
+        # assert that release gives up on body whose peer stopped
+        # sending, and discards its connection.
+        start_time = trio.current_time()
+        await res.release()
+        assert trio.current_time() - start_time == expected_time
+        assert inner.connections[0].released
+        assert pool.idle_connection_count == 0
+        assert pool.stats.discarded == 1
+        nursery.cancel_scope.cancel()
+
+async def test_expiry(autojump_clock):
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery)
+        pool = PooledQuasiHttpClientTransport(inner,
+            idle_timeout_millis=1000, max_lifetime_millis=5000)
+        client = StandardQuasiHttpClient(pool)
+        await (await _send(client, "/")).release()
+        await trio.sleep(0.9)
+        await (await _send(client, "/")).release()
+        assert len(inner.connections) == 1
+
+        # exceed idle timeout.
+        await trio.sleep(1.1)
+        await (await _send(client, "/")).release()
+        assert len(inner.connections) == 2
+        assert inner.connections[0].released
+
+        # exceed max lifetime with connection in use.
+        for _ in range(6):
+            await trio.sleep(0.9)
+            await (await _send(client, "/")).release()
+        assert len(inner.connections) == 3
+        assert inner.connections[1].released
+        assert pool.stats.discarded == 2
+        nursery.cancel_scope.cancel()
+
+async def test_pruning_of_idle_connections(autojump_clock):
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery)
+        pool = PooledQuasiHttpClientTransport(inner,
+            idle_timeout_millis=1000, max_idle_connections=2)
+        client = StandardQuasiHttpClient(pool)
+        for endpoint in ["a", "b", "c"]:
+            await (await _send(client, "/", endpoint)).release()
+        # assert that least recently used connection across endpoints
+        # got closed.
+        assert pool.idle_connection_count == 2
+        assert [c.released for c in inner.connections] == \
+            [True, False, False]
+
+        # assert that expired connections of other endpoints are
+        # closed, rather than only those of the same endpoint.
+        await trio.sleep(1)
+        await (await _send(client, "/", "d")).release()
+        assert pool.idle_connection_count == 1
+        assert [c.released for c in inner.connections] == \
+            [True, True, True, False]
+        assert pool.stats.discarded == 3
+        nursery.cancel_scope.cancel()
+
+async def test_max_idle_connections_per_endpoint():
+    async with trio.open_nursery() as nursery:
+        # let bodies keep connections in use till their release.
+        inner = _TransportImpl(nursery, res_body=b"x")
+        pool = PooledQuasiHttpClientTransport(inner,
+            max_idle_connections_per_endpoint=2)
+        client = StandardQuasiHttpClient(pool)
+        responses = [await _send(client, "/") for _ in range(3)]
+        for res in responses:
+            await res.release()
+        assert pool.idle_connection_count == 2
+        # assert that least recently used connection got closed.
+        assert [c.released for c in inner.connections] == \
+            [True, False, False]
+
+        await _send(client, "/")
+        assert pool.idle_connection_count == 1
+        assert len(inner.connections) == 3
+        assert pool.stats.reused == 1
+        nursery.cancel_scope.cancel()
+
+@pytest.mark.parametrize("is_async", [False, True])
+async def test_health_check(is_async):
+    async with trio.open_nursery() as nursery:
+        inner = _TransportImpl(nursery)
+        checked_connections = []
+        def health_check(connection):
+            checked_connections.append(connection)
+            return len(checked_connections) > 1
+        async def async_health_check(connection):
+            return health_check(connection)
+        pool = PooledQuasiHttpClientTransport(inner,
+            health_check=async_health_check if is_async else health_check)
+        client = StandardQuasiHttpClient(pool)
+        await (await _send(client, "/")).release()
+        await (await _send(client, "/")).release()
+        await (await _send(client, "/")).release()
+        assert checked_connections == inner.connections
+        assert [c.released for c in inner.connections] == [True, False]
+        nursery.cancel_scope.cancel()
+
+async def test_default_health_check_with_socket():
+    sockets = []
+    class SocketTransportImpl:
+        async def allocate_connection(self, remote_endpoint, send_options):
+            sock_a, sock_b = trio.socket.socketpair()
+            sockets.append(sock_b)
+            return SimpleNamespace(stream=trio.SocketStream(sock_a))
+        async def release_connection(self, connection, response):
+            await connection.stream.aclose()
+        def get_readable_stream(self, connection):
+            return connection.stream
+    pool = PooledQuasiHttpClientTransport(SocketTransportImpl())
+    response = SimpleNamespace(
+        headers={"connection": "keep-alive"})
+    connection = await pool.allocate_connection("a", None)
+    await pool.release_connection(connection, response)
+    assert await pool.allocate_connection("a", None) is connection
+    await pool.release_connection(connection, response)
+
+    # assert that connections closed by peer are not reused.
+    sockets[0].close()
+    connection2 = await pool.allocate_connection("a", None)
+    assert connection2 is not connection
+    assert pool.stats.discarded == 1
+    await pool.release_connection(connection2, response)
+
+    # assert that unexpected bytes from peer cause discarding.
+    await sockets[1].send(b"x")
+    assert await pool.allocate_connection("a", None) is not connection2
+    sockets[1].close()
+    sockets[2].close()
+
+async def test_default_health_check_with_high_fd():
+    # assert that descriptors beyond FD_SETSIZE can be checked.
+    sock_a, sock_b = trio.socket.socketpair()
+    try:
+        high_fd = fcntl.fcntl(sock_a.fileno(), fcntl.F_DUPFD, 1100)
+    except OSError:
+        sock_a.close()
+        sock_b.close()
+        pytest.skip("can't get descriptors beyond FD_SETSIZE")
+    stream = SimpleNamespace(socket=SimpleNamespace(
+        fileno=lambda: high_fd))
+    try:
+        assert not _is_readable_now(stream)
+        await sock_b.send(b"x")
+        assert _is_readable_now(stream)
+    finally:
+        os.close(high_fd)
+        sock_a.close()
+        sock_b.close()
+
+async def test_unpooled_connections():
+    released = []
+    class TransportImpl:
+        async def allocate_connection(self, remote_endpoint, send_options):
+            # connection which can't take new attributes.
+            return ()
+        async def release_connection(self, connection, response):
+            released.append((connection, response))
+        async def request_serializer(self, connection, request):
+            return True
+    pool = PooledQuasiHttpClientTransport(TransportImpl())
+    response = SimpleNamespace(headers={"connection": "keep-alive"})
+    connection = await pool.allocate_connection("a", None)
+    await pool.release_connection(connection, response)
+    assert released == [((), response)]
+
+    # assert that unhashable endpoints are not pooled.
+    connection = await pool.allocate_connection({}, None)
+    await pool.release_connection(connection, response)
+    assert released == [((), response), ((), response)]
+
+    # assert that optional members of wrapped transport are exposed.
+    assert await pool.request_serializer(connection, None)
+    assert not hasattr(pool, "response_deserializer")
@@ -1,12 +1,23 @@
 import pytest
+import trio
+import trio.testing
 
 from types import SimpleNamespace
 
 from kabomu.abstractions import IQuasiHttpApplication,\
     IQuasiHttpAltTransport, IQuasiHttpClientTransport,\
-    IQuasiHttpServerTransport
+    IQuasiHttpServerTransport, DefaultSendManyItem,\
+    QuasiHttpProcessingOptions
+from kabomu.errors import QuasiHttpError, QUASI_HTTP_ERROR_REASON_GENERAL
 from kabomu.StandardQuasiHttpClient import StandardQuasiHttpClient
 from kabomu.StandardQuasiHttpServer import StandardQuasiHttpServer
+from kabomu.HedgingPolicy import HedgingPolicy
+from kabomu.PooledQuasiHttpClientTransport import\
+    PooledQuasiHttpClientTransport
+from kabomu.MultiplexedQuasiHttpClientTransport import\
+    MultiplexedQuasiHttpClientTransport
+from kabomu.MultiplexedQuasiHttpServerTransport import\
+    MultiplexedQuasiHttpServerTransport
 
 from kabomu.quasi_http_utils import _bind_method
 
@@ -626,3 +637,563 @@ def create_server_transport_impl(
         instance.release_connection = _bind_method(
             release_connection, instance)
         return instance
+
+class _KeepAliveTransportImpl:
+    # client transport whose connections are served by a
+    # StandardQuasiHttpServer running in nursery.
+    def __init__(self, nursery, server_processing_options):
+        self.nursery = nursery
+        self.server_processing_options = server_processing_options
+        self.requests = []
+        self.released_server_connections = []
+        async def process_request(request):
+            self.requests.append(request)
+            body = None
+            if request.target == "/echo":
+                body = create_byte_array_input_stream(
+                    await read_all_bytes(request.body))
+            return SimpleNamespace(status_code=200, body=body,
+                content_length=-1 if body else 0)
+        def get_stream(self, connection):
+            return connection.stream
+        async def release_connection(connection):
+            self.released_server_connections.append(connection)
+            await connection.stream.aclose()
+        server_transport = SimpleNamespace(
+            release_connection=release_connection)
+        server_transport.get_readable_stream = _bind_method(get_stream,
+            server_transport)
+        server_transport.get_writable_stream = _bind_method(get_stream,
+            server_transport)
+        self.server = StandardQuasiHttpServer(
+            application=SimpleNamespace(process_request=process_request),
+            transport=server_transport)
+        self.server_connections = []
+
+    async def allocate_connection(self, remote_endpoint, send_options):
+        client_stream, server_stream = trio.testing.memory_stream_pair()
+        server_connection = SimpleNamespace(stream=server_stream,
+            processing_options=self.server_processing_options)
+        self.server_connections.append(server_connection)
+        self.nursery.start_soon(self.server.accept_connection,
+                                server_connection)
+        return SimpleNamespace(stream=client_stream,
+                               processing_options=send_options)
+
+    async def establish_connection(self, connection):
+        pass
+
+    async def release_connection(self, connection, response):
+        if response and response.body:
+            return
+        await connection.stream.aclose()
+
+    def get_readable_stream(self, connection):
+        return connection.stream
+
+    def get_writable_stream(self, connection):
+        return connection.stream
+
+@pytest.mark.parametrize("""server_processing_options,
+        expected_connection_headers, expected_connection_count""",
+    [
+        (None, [None, None, None], 3),
+        (
+            SimpleNamespace(keep_alive_enabled=False),
+            [None, None, None],
+            3
+        ),
+        (
+            SimpleNamespace(keep_alive_enabled=True),
+            [["keep-alive"], ["keep-alive"], ["keep-alive"]],
+            1
+        ),
+        (
+            SimpleNamespace(keep_alive_enabled=True,
+                            max_requests_per_connection=2),
+            [["keep-alive"], ["close"], ["keep-alive"]],
+            2
+        ),
+    ])
+async def test_server_keep_alive(server_processing_options,
+        expected_connection_headers, expected_connection_count):
+    async with trio.open_nursery() as nursery:
+        instance = _KeepAliveTransportImpl(nursery,
+            server_processing_options)
+        pool = PooledQuasiHttpClientTransport(instance)
+        client = StandardQuasiHttpClient(transport=pool)
+        actual_connection_headers = []
+        for i in range(3):
+            # leave some request bodies unread by server application,
+            # to test draining.
+            target = "/echo" if i == 1 else "/"
+            req_body = f"body-{i}".encode()
+            res = await client.send("a", SimpleNamespace(target=target,
+                body=create_byte_array_input_stream(req_body),
+                content_length=-1))
+            assert res.status_code == 200
+            if target == "/echo":
+                assert await read_all_bytes(res.body) == req_body
+            actual_connection_headers.append(
+                (res.headers or {}).get("connection"))
+            await res.release()
+        assert actual_connection_headers == expected_connection_headers
+        assert [r.target for r in instance.requests] == ["/", "/echo", "/"]
+        assert len(instance.server_connections) == \
+            expected_connection_count
+        if not getattr(server_processing_options, "keep_alive_enabled",
+                       None):
+            # assert that request headers were left undecoded.
+            assert all(r.headers._entries is None
+                       for r in instance.requests)
+
+        # assert that server releases connections once clients close them.
+        await pool.close_idle_connections()
+        await trio.testing.wait_all_tasks_blocked()
+        assert instance.released_server_connections == \
+            instance.server_connections
+
+async def test_server_keep_alive_idle_timeout(autojump_clock):
+    async with trio.open_nursery() as nursery:
+        instance = _KeepAliveTransportImpl(nursery,
+            SimpleNamespace(keep_alive_enabled=True,
+                            keep_alive_idle_timeout_millis=1000))
+        # memory streams don't reveal closure by server, so let pool
+        # expire connections no later than server does.
+        pool = PooledQuasiHttpClientTransport(instance,
+            idle_timeout_millis=1000)
+        client = StandardQuasiHttpClient(transport=pool)
+        await (await client.send("a", SimpleNamespace())).release()
+        await trio.sleep(0.9)
+        assert not instance.released_server_connections
+        await (await client.send("a", SimpleNamespace())).release()
+        assert len(instance.server_connections) == 1
+
+        # assert that server closes connection after idle timeout.
+        await trio.sleep(1.1)
+        assert instance.released_server_connections == \
+            instance.server_connections
+        await (await client.send("a", SimpleNamespace())).release()
+        assert len(instance.server_connections) == 2
+        await pool.close_idle_connections()
+
+def _create_multiplexed_client(nursery, process_request):
+    # returns client whose requests are served over multiplexed
+    # connections by a StandardQuasiHttpServer running in nursery.
+    def get_stream(self, connection):
+        return connection.stream
+    async def release_connection(connection, response=None):
+        await connection.stream.aclose()
+    inner_transport = SimpleNamespace(release_connection=release_connection)
+    inner_transport.get_readable_stream = _bind_method(get_stream,
+        inner_transport)
+    inner_transport.get_writable_stream = _bind_method(get_stream,
+        inner_transport)
+    server = StandardQuasiHttpServer(
+        application=SimpleNamespace(process_request=process_request))
+    server.transport = MultiplexedQuasiHttpServerTransport(inner_transport,
+        server)
+    server_connections = []
+    async def allocate_connection(remote_endpoint, send_options):
+        client_stream, server_stream = \
+            trio.testing.memory_stream_pair()
+        server_connection = SimpleNamespace(stream=server_stream)
+        server_connections.append(server_connection)
+        nursery.start_soon(server.transport.accept_connection,
+                           server_connection)
+        return SimpleNamespace(stream=client_stream)
+    async def establish_connection(connection):
+        pass
+    client_inner_transport = SimpleNamespace(
+        allocate_connection=allocate_connection,
+        establish_connection=establish_connection,
+        release_connection=release_connection,
+        get_readable_stream=inner_transport.get_readable_stream,
+        get_writable_stream=inner_transport.get_writable_stream)
+    transport = MultiplexedQuasiHttpClientTransport(
+        client_inner_transport, nursery)
+    return StandardQuasiHttpClient(transport), server_connections
+
+async def test_multiplexed_transports():
+    upload_gate = trio.Event()
+    async def process_request(request):
+        if request.target == "/upload":
+            # hold up reading of large body.
+            await upload_gate.wait()
+        req_body = await read_all_bytes(request.body)
+        return SimpleNamespace(status_code=200,
+            body=create_byte_array_input_stream(req_body),
+            content_length=len(req_body))
+
+    with trio.fail_after(10):
+        async with trio.open_nursery() as nursery:
+            client, server_connections = _create_multiplexed_client(
+                nursery, process_request)
+            transport = client.transport
+
+            large_body = b"x" * 1_000_000
+            results = {}
+            async def send(target, req_body):
+                res = await client.send("a", SimpleNamespace(target=target,
+                    body=create_byte_array_input_stream(req_body),
+                    content_length=-1))
+                results[target] = await read_all_bytes(res.body)
+                await res.release()
+            nursery.start_soon(send, "/upload", large_body)
+            await trio.testing.wait_all_tasks_blocked()
+
+            # assert that small exchanges complete while large upload
+            # is stuck.
+            async with trio.open_nursery() as small_nursery:
+                for i in range(5):
+                    small_nursery.start_soon(send, f"/{i}", f"body-{i}".encode())
+            assert results == {f"/{i}": f"body-{i}".encode()
+                               for i in range(5)}
+            assert len(server_connections) == 1
+
+            upload_gate.set()
+            while "/upload" not in results:
+                await trio.sleep(0.01)
+            assert results["/upload"] == large_body
+            assert len(server_connections) == 1
+
+            await transport.close_connections()
+
+async def test_multiplexed_connection_sharing():
+    async def process_request(request):
+        return SimpleNamespace(status_code=200)
+
+    with trio.fail_after(10):
+        async with trio.open_nursery() as nursery:
+            client, server_connections = _create_multiplexed_client(
+                nursery, process_request)
+            transport = client.transport
+
+            # assert that send options of the same values share
+            # connections, while those of other values don't.
+            for _ in range(2):
+                await client.send("a", SimpleNamespace(target="/"),
+                    SimpleNamespace(timeout_millis=1000))
+            assert len(server_connections) == 1
+            await client.send("a", SimpleNamespace(target="/"),
+                SimpleNamespace(timeout_millis=2000))
+            assert len(server_connections) == 2
+            assert len(transport._entries) == 2
+            assert not transport._locks
+
+            # assert that entries are dropped once their
+            # connections close.
+            entry = next(iter(transport._entries.values()))
+            await entry.connection.stream.aclose()
+            await trio.testing.wait_all_tasks_blocked()
+            assert len(transport._entries) == 1
+
+            # assert that send options which can't be compared get
+            # connections of their own, which are closed with their
+            # streams.
+            for i in range(2):
+                await client.send("a", SimpleNamespace(target="/"),
+                    SimpleNamespace(extra_connectivity_params=[bytearray()]))
+                assert len(server_connections) == 3 + i
+                await trio.testing.wait_all_tasks_blocked()
+                assert not transport._unshared_entries
+            assert len(transport._entries) == 1
+
+            await transport.close_connections()
+
+async def test_multiplexed_stream_failures(caplog, autojump_clock):
+    reset_gate = trio.Event()
+    async def process_request(request):
+        if request.target == "/fail":
+            raise ValueError("application failed")
+        # wait for client to give up on request.
+        await reset_gate.wait()
+        if request.body:
+            await read_all_bytes(request.body)
+        return SimpleNamespace(status_code=200)
+
+    with trio.fail_after(10):
+        async with trio.open_nursery() as nursery:
+            client, server_connections = _create_multiplexed_client(
+                nursery, process_request)
+
+            # assert that failures of applications are logged, and
+            # that streams get reset.
+            with pytest.raises(QuasiHttpError):
+                await client.send("a", SimpleNamespace(target="/fail"))
+            await trio.testing.wait_all_tasks_blocked()
+            assert [r.message for r in caplog.records] == \
+                ["stream processing error"]
+            assert "application failed" in caplog.text
+
+            # assert that streams reset by clients aren't logged.
+            caplog.clear()
+            with trio.move_on_after(1):
+                try:
+                    await client.send("a", SimpleNamespace(target="/",
+                        body=create_byte_array_input_stream(b"data"),
+                        content_length=-1))
+                except QuasiHttpError:
+                    pass
+            reset_gate.set()
+            await trio.testing.wait_all_tasks_blocked()
+            assert not caplog.records
+
+            # assert that other streams are unaffected.
+            res = await client.send("a", SimpleNamespace(target="/"))
+            assert res.status_code == 200
+            assert len(server_connections) == 1
+            await client.transport.close_connections()
+
+class _SendManyRecorder:
+    # stands in for send() and send2() of a client, completing requests
+    # after as many seconds as their targets say.
+    def __init__(self):
+        self.in_progress = {}
+        self.max_in_progress = {}
+        self.max_total_in_progress = 0
+        self.started = []
+        self.released = []
+
+    async def send(self, remote_endpoint, request, options=None):
+        self.started.append(request.target)
+        in_progress = self.in_progress
+        in_progress[remote_endpoint] = \
+            in_progress.get(remote_endpoint, 0) + 1
+        self.max_in_progress[remote_endpoint] = max(
+            in_progress[remote_endpoint],
+            self.max_in_progress.get(remote_endpoint, 0))
+        self.max_total_in_progress = max(self.max_total_in_progress,
+                                         sum(in_progress.values()))
+        try:
+            await trio.sleep(int(request.target.split("-")[0]))
+            if request.target.endswith("fail"):
+                raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_GENERAL,
+                                     request.target)
+        finally:
+            in_progress[remote_endpoint] -= 1
+        async def release():
+            self.released.append(request.target)
+        return SimpleNamespace(status_code=200, release=release)
+
+    async def send2(self, remote_endpoint, request_func, options=None):
+        return await self.send(remote_endpoint, await request_func(None),
+                               options)
+
+def _create_send_many_client():
+    recorder = _SendManyRecorder()
+    client = StandardQuasiHttpClient()
+    client.send = recorder.send
+    client.send2 = recorder.send2
+    return client, recorder
+
+async def test_send_many(autojump_clock):
+    client, recorder = _create_send_many_client()
+    async def request_func(env):
+        return SimpleNamespace(target="5-b")
+    async def create_items():
+        yield DefaultSendManyItem("a", SimpleNamespace(target="4-a"))
+        yield DefaultSendManyItem("a", SimpleNamespace(target="1-a"))
+        yield DefaultSendManyItem("a", SimpleNamespace(target="3-a-fail"))
+        yield DefaultSendManyItem("b", request_func=request_func)
+        yield DefaultSendManyItem("b", SimpleNamespace(target="5-b"))
+    actual = []
+    async with client.send_many(create_items(), concurrency=3,
+                                per_endpoint_limit=2) as results:
+        async for result in results:
+            if result.error:
+                actual.append(("error", str(result.error)))
+            else:
+                actual.append((result.item.remote_endpoint,
+                               result.response.status_code))
+                await result.response.release()
+    # 4-a, 1-a and first 5-b start at 0, while 3-a-fail waits for a
+    # slot of "a" without taking up room of second 5-b, which starts
+    # at 1. 3-a-fail starts at 4.
+    assert actual == [("a", 200), ("a", 200), ("b", 200), ("b", 200),
+                      ("error", "3-a-fail")]
+    assert recorder.max_in_progress == {"a": 2, "b": 2}
+    assert recorder.max_total_in_progress == 3
+
+async def test_send_many_with_mixed_endpoints(autojump_clock):
+    client, recorder = _create_send_many_client()
+    # runs of 8 items per endpoint, which exceed per endpoint limit.
+    items = [DefaultSendManyItem(f"e{i // 8 % 4}",
+                                 SimpleNamespace(target=f"2-{i}"))
+             for i in range(80)]
+    start_time = trio.current_time()
+    async with client.send_many(items, concurrency=16,
+                                per_endpoint_limit=4) as results:
+        count = 0
+        async for result in results:
+            await result.response.release()
+            count += 1
+    assert count == 80
+    # assert that items waiting for their endpoints didn't hold up
+    # items of other endpoints.
+    assert recorder.max_total_in_progress == 16
+    # 10 seconds would need all items to be taken at once.
+    assert trio.current_time() - start_time <= 12
+    assert set(recorder.max_in_progress.values()) == {4}
+
+async def test_send_many_backpressure(autojump_clock):
+    client, recorder = _create_send_many_client()
+    pulled = []
+    def create_items():
+        for i in range(10):
+            pulled.append(i)
+            yield DefaultSendManyItem("a", SimpleNamespace(target=f"1-{i}"))
+    async with client.send_many(create_items(), concurrency=2) as results:
+        await trio.sleep(10)
+        # assert that results which weren't taken stop further sending,
+        # and further consumption of items.
+        assert recorder.started == ["1-0", "1-1"]
+        assert pulled == [0, 1]
+        taken = (await results.receive()).item.request.target
+        await trio.sleep(10)
+        assert recorder.started == ["1-0", "1-1", "1-2"]
+    # assert that leaving early releases responses never taken.
+    assert sorted(recorder.released + [taken]) == ["1-0", "1-1", "1-2"]
+    assert recorder.started == ["1-0", "1-1", "1-2"]
+
+class _HedgingTransportImpl(_KeepAliveTransportImpl):
+    # stalls first request for 10 seconds.
+    def __init__(self, nursery):
+        super().__init__(nursery, None)
+        self.remote_endpoints = []
+        self.released_client_connections = 0
+        async def process_request(request):
+            self.requests.append(request)
+            if len(self.requests) == 1:
+                await trio.sleep(10)
+            return SimpleNamespace(status_code=200,
+                headers={"n": [str(len(self.requests))]})
+        self.server.application = SimpleNamespace(
+            process_request=process_request)
+        accept_connection = self.server.accept_connection
+        async def accept_connection_quietly(connection):
+            try:
+                await accept_connection(connection)
+            except QuasiHttpError:
+                pass # expected for connections which clients gave up.
+        self.server.accept_connection = accept_connection_quietly
+
+    async def allocate_connection(self, remote_endpoint, send_options):
+        self.remote_endpoints.append(remote_endpoint)
+        return await super().allocate_connection(remote_endpoint,
+                                                 send_options)
+
+    async def release_connection(self, connection, response):
+        self.released_client_connections += 1
+        await super().release_connection(connection, response)
+
+@pytest.mark.parametrize("idempotent, use_send2, req_body, expected_hedged",
+    [
+        (True, False, None, True),
+        (True, True, b"data", True),
+        (None, False, None, False),
+        (False, True, None, False),
+        # bodies given to send() can't be sent twice.
+        (True, False, b"data", False),
+    ])
+async def test_hedged_send(autojump_clock, idempotent, use_send2,
+                           req_body, expected_hedged):
+    async with trio.open_nursery() as nursery:
+        instance = _HedgingTransportImpl(nursery)
+        policy = HedgingPolicy(initial_delay_millis=50, max_hedge_ratio=1,
+            hedge_endpoint_func=lambda e: e + "-hedge")
+        client = StandardQuasiHttpClient(transport=instance,
+                                         hedging_policy=policy)
+        options = QuasiHttpProcessingOptions(idempotent=idempotent)
+        def create_request():
+            request = SimpleNamespace(target="/")
+            if req_body:
+                request.body = create_byte_array_input_stream(req_body)
+                request.content_length = -1
+            return request
+        start_time = trio.current_time()
+        if use_send2:
+            async def request_func(env):
+                return create_request()
+            res = await client.send2("a", request_func, options)
+        else:
+            res = await client.send("a", create_request(), options)
+        elapsed = trio.current_time() - start_time
+        await res.release()
+        await trio.testing.wait_all_tasks_blocked()
+        if expected_hedged:
+            assert res.headers["n"] == ["2"]
+            assert elapsed < 1
+            assert instance.remote_endpoints == ["a", "a-hedge"]
+            assert policy.stats == SimpleNamespace(requests=1, hedged=1,
+                                                   hedge_wins=1)
+            assert policy.hedge_rate == 1
+            assert policy.hedge_win_rate == 1
+        else:
+            assert res.headers["n"] == ["1"]
+            assert elapsed >= 10
+            assert instance.remote_endpoints == ["a"]
+            assert policy.stats.hedged == 0
+        # assert that connection of loser got released too.
+        assert instance.released_client_connections == \
+            len(instance.remote_endpoints)
+
+async def test_hedged_send_primary_wins(autojump_clock):
+    async with trio.open_nursery() as nursery:
+        instance = _HedgingTransportImpl(nursery)
+        policy = HedgingPolicy(initial_delay_millis=50, max_hedge_ratio=1)
+        client = StandardQuasiHttpClient(transport=instance,
+                                         hedging_policy=policy)
+        options = QuasiHttpProcessingOptions(idempotent=True)
+        # get past stalled first request, without hedging.
+        instance.requests.append(None)
+        for _ in range(3):
+            res = await client.send("a", SimpleNamespace(), options)
+            await res.release()
+        assert instance.remote_endpoints == ["a"] * 3
+        assert policy.stats == SimpleNamespace(requests=3, hedged=0,
+                                               hedge_wins=0)
+        assert policy.hedge_rate == 0
+
+@pytest.mark.parametrize("max_eager_response_body_size, res_body_size, " +
+        "known_length, expected_buffered",
+    [
+        (None, 10, True, False),
+        (0, 10, True, False),
+        (10, 10, True, True),
+        (10, 10, False, True),
+        (9, 10, True, False),
+        (9, 10, False, False),
+        (100_000, 50_000, False, True),
+    ])
+async def test_eager_response_body_buffering(max_eager_response_body_size,
+        res_body_size, known_length, expected_buffered):
+    async with trio.open_nursery() as nursery:
+        instance = _KeepAliveTransportImpl(nursery,
+            SimpleNamespace(keep_alive_enabled=True))
+        res_body = bytes(i % 256 for i in range(res_body_size))
+        async def process_request(request):
+            return SimpleNamespace(status_code=200,
+                body=create_byte_array_input_stream(res_body),
+                content_length=res_body_size if known_length else -1)
+        instance.server.application = SimpleNamespace(
+            process_request=process_request)
+        pool = PooledQuasiHttpClientTransport(instance)
+        client = StandardQuasiHttpClient(transport=pool)
+        options = QuasiHttpProcessingOptions(
+            max_eager_response_body_size=max_eager_response_body_size)
+        res = await client.send("a", SimpleNamespace(), options)
+
+        # assert that connection is back in pool before body is read,
+        # only if body got buffered.
+        assert pool.idle_connection_count == (1 if expected_buffered else 0)
+        assert await read_all_bytes(res.body) == res_body
+        await res.release()
+        assert pool.idle_connection_count == 1
+
+        # assert that connection is reusable in either case.
+        res = await client.send("a", SimpleNamespace(), options)
+        assert await read_all_bytes(res.body) == res_body
+        await res.release()
+        assert len(instance.server_connections) == 1
+        await pool.close_idle_connections()
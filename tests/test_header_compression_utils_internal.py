@@ -0,0 +1,118 @@
+import pytest
+
+from kabomu import header_compression_utils_internal
+from kabomu.errors import ExpectationViolationError
+
+@pytest.mark.parametrize("flags, prefix_bits, n, expected",
+    [
+        (0, 5, 10, bytes([0x0a])),
+        (0xe0, 5, 10, bytes([0xea])),
+        (0, 5, 1337, bytes([0x1f, 0x9a, 0x0a])),
+        (0, 8, 42, bytes([0x2a])),
+        (0x80, 7, 127, bytes([0xff, 0])),
+    ])
+def test_integer_codec(flags, prefix_bits, n, expected):
+    dest = bytearray()
+    header_compression_utils_internal.encode_integer(
+        dest, flags, prefix_bits, n)
+    assert dest == expected
+    actual = header_compression_utils_internal.decode_integer(
+        expected, 0, prefix_bits)
+    assert actual == (n, len(expected))
+
+def test_decode_integer_for_errors():
+    with pytest.raises(ExpectationViolationError):
+        header_compression_utils_internal.decode_integer(
+            bytes([0x7f] + [0xff] * 6), 0, 7)
+    with pytest.raises(IndexError):
+        header_compression_utils_internal.decode_integer(
+            bytes([0x7f, 0xff]), 0, 7)
+
+def test_header_table():
+    instance = header_compression_utils_internal.HeaderTable()
+    static_len = len(header_compression_utils_internal.STATIC_TABLE)
+    assert instance.find(":method", "GET") == 1
+    assert instance.find("x-a", "1") == 0
+    assert instance.find("content-type", "text/csv") < 0
+
+    # entries too big for table are not added.
+    instance.add("x-a", "1")
+    assert len(instance) == 0
+
+    instance.set_max_size(80)
+    instance.add("x-a", "1")
+    instance.add("x-b", "2")
+    assert instance.size == 72
+    assert instance.get(static_len + 1) == ("x-b", "2")
+    assert instance.get(static_len + 2) == ("x-a", "1")
+    assert instance.find("x-a", "1") == static_len + 2
+    assert instance.find("x-a", "3") == -(static_len + 2)
+
+    # adding evicts oldest entries.
+    instance.add("x-c", "3")
+    assert len(instance) == 2
+    assert instance.get(static_len + 2) == ("x-b", "2")
+    assert instance.find("x-a", "1") == 0
+    with pytest.raises(ExpectationViolationError):
+        instance.get(static_len + 3)
+    with pytest.raises(ExpectationViolationError):
+        instance.get(0)
+
+    # shrinking table also evicts oldest entries.
+    instance.set_max_size(40)
+    assert len(instance) == 1
+    assert instance.find("x-c", "3") == static_len + 1
+
+    instance.clear()
+    assert len(instance) == 0
+    assert instance.size == 0
+    assert instance.max_size == 40
+
+def test_header_fields_codec():
+    encoder_table = header_compression_utils_internal.HeaderTable()
+    encoder_table.set_max_size(4096)
+    decoder_table = header_compression_utils_internal.HeaderTable()
+    fields = [
+        (":method", "GET"),
+        (":target", "/orders/1"),
+        (":version", ""),
+        (":content-length", "0"),
+        ("content-type", "application/json"),
+        ("x-request-id", "ab"),
+        ("authorization", "Bearer xyz"),
+    ]
+    first = header_compression_utils_internal.encode_header_fields(
+        encoder_table, fields)
+    assert header_compression_utils_internal.decode_header_fields(
+        decoder_table, first, 1000) == fields
+
+    # repeated fields are sent as table indices.
+    fields[1] = (":target", "/orders/2")
+    fields[3] = (":content-length", "12")
+    fields[5] = ("x-request-id", "cd")
+    second = header_compression_utils_internal.encode_header_fields(
+        encoder_table, fields)
+    assert len(second) < len(first) - 16
+    assert header_compression_utils_internal.decode_header_fields(
+        decoder_table, second, 1000) == fields
+    assert len(decoder_table) == len(encoder_table)
+
+    # ensure size of decoded fields is limited.
+    with pytest.raises(ExpectationViolationError) as actual_ex:
+        header_compression_utils_internal.decode_header_fields(
+            decoder_table, second, 40)
+    assert "decoded header fields exceed max size of 40" in \
+        str(actual_ex.value)
+
+@pytest.mark.parametrize("data",
+    [
+        bytes([0x80]),
+        bytes([0xff, 0x7f]),
+        bytes([0x40, 0x05, 0x61]),
+        bytes([0x3f, 0xff, 0xff, 0x07]),
+    ])
+def test_decode_header_fields_for_errors(data):
+    decoder_table = header_compression_utils_internal.HeaderTable()
+    with pytest.raises(Exception):
+        header_compression_utils_internal.decode_header_fields(
+            decoder_table, data, 1000)
@@ -1,4 +1,10 @@
+import os
+
+from types import SimpleNamespace
+
 import pytest
+import trio
+import trio.testing
 
 from kabomu import io_utils_internal
 
@@ -69,3 +75,506 @@ async def test_copy(src_data: str):
 
     # assert
     assert writer_stream.to_byte_array() == expected
+
+async def test_buffered_readable_stream():
+    # arrange
+    data = bytes(range(20))
+    receive_sizes = []
+    backing_stream = comparison_utils.create_byte_array_input_stream(data)
+    class CountingStream:
+        async def receive_some(self, max_bytes=None):
+            receive_sizes.append(max_bytes)
+            return await backing_stream.receive_some(max_bytes)
+    instance = io_utils_internal.create_buffered_readable_stream(
+        CountingStream(), 8)
+
+    # act and assert that small reads are served from buffer.
+    assert await io_utils_internal.read_bytes_fully(instance, 3) == data[:3]
+    assert await instance.receive_some(2) == data[3:5]
+    assert instance.buffered_byte_count == 3
+    assert receive_sizes == [8]
+
+    # assert that peeking doesn't consume bytes.
+    assert await instance.peek() == data[5:8]
+    assert await instance.receive_some() == data[5:8]
+    assert receive_sizes == [8]
+
+    # assert that large reads bypass empty buffer.
+    assert await instance.receive_some(10) == data[8:18]
+    assert receive_sizes == [8, 10]
+
+    assert await instance.peek() == data[18:]
+    assert await io_utils_internal.read_bytes_fully(instance, 2) == data[18:]
+    assert await instance.peek() == b""
+    assert await instance.receive_some(3) == b""
+    assert receive_sizes == [8, 10, 8, 8, 8]
+    assert instance.backing_stream is not backing_stream
+
+async def test_buffered_readable_stream_with_randomized_reads():
+    data = bytes(range(256)) * 10
+    instance = io_utils_internal.create_buffered_readable_stream(
+        comparison_utils.create_randomized_read_input_stream(data), 16)
+    actual = bytearray()
+    for n in [1, 4, 4, 20, 100, 3, 1000, 5000]:
+        actual.extend(await io_utils_internal.read_bytes_fully(
+            instance, min(n, len(data) - len(actual))))
+    assert actual == data
+    assert await instance.receive_some() == b""
+
+@pytest.mark.parametrize("sizes, expected_send_count",
+    [
+        ([], 1),
+        ([8, 100], 1),
+        ([8, 16_376], 1),
+        ([8, 16_377], 2),
+    ])
+async def test_send_all_gathered(sizes, expected_send_count):
+    buffers = [bytes([i]) * n for i, n in enumerate(sizes)]
+    dest = comparison_utils.create_byte_array_output_stream()
+    send_count = 0
+    class CountingStream:
+        async def send_all(self, data):
+            nonlocal send_count
+            send_count += 1
+            await dest.send_all(data)
+    await io_utils_internal.send_all_gathered(CountingStream(), buffers)
+    assert send_count == expected_send_count
+    assert dest.to_byte_array() == b"".join(buffers)
+
+async def test_send_all_gathered_with_socket():
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_a = trio.SocketStream(sock_a)
+    stream_b = trio.SocketStream(sock_b)
+    # exceed socket buffer sizes to cause partial sends.
+    buffers = [b"header", b"x" * 3_000_000, b"", bytearray(b"y" * 1000)]
+    expected = b"".join(buffers)
+    actual = bytearray()
+    async def receive():
+        while len(actual) < len(expected):
+            actual.extend(await stream_b.receive_some())
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(receive)
+        await io_utils_internal.send_all_gathered(stream_a, buffers)
+    assert actual == expected
+    await stream_a.aclose()
+    await stream_b.aclose()
+
+async def test_send_all_gathered_with_failing_socket():
+    # assert that closed peers are reported as by send_all.
+    buffers = [b"header", b"x" * 100_000]
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_a = trio.SocketStream(sock_a)
+    sock_b.close()
+    with pytest.raises(trio.BrokenResourceError):
+        await io_utils_internal.send_all_gathered(stream_a, buffers)
+    await stream_a.aclose()
+    with pytest.raises(trio.ClosedResourceError):
+        await io_utils_internal.send_all_gathered(stream_a, buffers)
+
+    # assert that streams which merely expose sockets are written
+    # through send_all.
+    sent = []
+    class SocketStreamWrapper:
+        def __init__(self, stream):
+            self.socket = stream.socket
+        async def send_all(self, data):
+            sent.append(bytes(data))
+    sock_a, sock_b = trio.socket.socketpair()
+    with sock_a, sock_b:
+        await io_utils_internal.send_all_gathered(
+            SocketStreamWrapper(trio.SocketStream(sock_a)), buffers)
+    assert sent == buffers
+
+async def test_receive_some_into():
+    # test fallback to receive_some.
+    reader = comparison_utils.create_byte_array_input_stream(
+        bytes([0, 1, 2, 3, 4]))
+    buffer = bytearray(3)
+    assert await io_utils_internal.receive_some_into(reader, buffer) == 3
+    assert buffer == bytes([0, 1, 2])
+    assert await io_utils_internal.receive_some_into(reader, buffer) == 2
+    assert buffer == bytes([3, 4, 2])
+    assert await io_utils_internal.receive_some_into(reader, buffer) == 0
+    assert await io_utils_internal.receive_some_into(
+        reader, bytearray()) == 0
+
+    # test streams supporting reading into buffers.
+    class NativeStream:
+        async def receive_some_into(self, buffer):
+            buffer[0] = 7
+            return 1
+    assert await io_utils_internal.receive_some_into(
+        NativeStream(), buffer) == 1
+    assert buffer == bytes([7, 4, 2])
+
+    class FileLikeStream:
+        async def read(self, n):
+            raise AssertionError("unexpected call")
+        async def readinto(self, buffer):
+            buffer[:2] = b"ab"
+            return 2
+    assert await io_utils_internal.receive_some_into(
+        FileLikeStream(), memoryview(buffer)) == 2
+    assert buffer == b"ab\x02"
+
+async def test_send_all_with_short_writes():
+    written = bytearray()
+    write_args = []
+    class ShortWriteFile:
+        async def write(self, data):
+            write_args.append(data)
+            n = min(len(data), 3)
+            written.extend(data[:n])
+            return n
+    data = b"abcdefgh"
+    await io_utils_internal.send_all(ShortWriteFile(), data)
+    assert written == data
+    assert len(write_args) == 3
+    assert write_args[0] is data
+    # assert that remainders are sliced without copying.
+    assert all(isinstance(arg, memoryview) for arg in write_args[1:])
+
+async def test_stream_adapter():
+    class FileLikeStream:
+        def __init__(self, data):
+            self._src = comparison_utils.create_byte_array_input_stream(
+                data)
+            self.written = bytearray()
+        async def read(self, n):
+            return await self._src.receive_some(n)
+        async def write(self, data):
+            self.written.extend(data[:2])
+            return min(len(data), 2)
+    f = FileLikeStream(b"abcdef")
+    instance = io_utils_internal.create_stream_adapter(f)
+    assert instance.stream is f
+    assert io_utils_internal.create_stream_adapter(instance) is instance
+    assert not instance.supports_receive_some_into
+    assert await instance.receive_some(2) == b"ab"
+    buffer = bytearray(3)
+    assert await instance.receive_some_into(buffer) == 3
+    assert buffer == b"cde"
+    assert await instance.receive_some() == b"f"
+    assert await instance.receive_some() == b""
+    await instance.send_all(b"xyz")
+    assert f.written == b"xyz"
+
+    src = comparison_utils.create_byte_array_input_stream(b"abc")
+    reader = io_utils_internal.create_buffered_readable_stream(src)
+    instance = io_utils_internal.create_stream_adapter(reader)
+    assert instance.supports_receive_some_into
+    assert instance.send_all is None
+    assert await instance.receive_some_into(memoryview(buffer)[:2]) == 2
+    assert buffer == b"abe"
+    assert await instance.receive_some() == b"c"
+
+    sock_a, sock_b = trio.socket.socketpair()
+    with sock_a, sock_b:
+        stream_a = trio.SocketStream(sock_a)
+        stream_b = trio.SocketStream(sock_b)
+        await io_utils_internal.create_stream_adapter(stream_a).send_all(
+            b"ab")
+        instance = io_utils_internal.create_stream_adapter(stream_b)
+        assert instance.supports_receive_some_into
+        assert await instance.receive_some_into(buffer) == 2
+        assert buffer == b"abe"
+
+async def test_buffered_readable_stream_receive_some_into():
+    data = bytes(range(20))
+    receive_sizes = []
+    backing_stream = comparison_utils.create_byte_array_input_stream(data)
+    class CountingStream:
+        async def receive_some(self, max_bytes=None):
+            receive_sizes.append(max_bytes)
+            return await backing_stream.receive_some(max_bytes)
+    instance = io_utils_internal.create_buffered_readable_stream(
+        CountingStream(), 8)
+    buffer = bytearray(10)
+    assert await instance.receive_some_into(memoryview(buffer)[:3]) == 3
+    assert buffer[:3] == data[:3]
+    assert await instance.receive_some_into(buffer) == 5
+    assert buffer[:5] == data[3:8]
+    assert receive_sizes == [8]
+
+    # assert that large reads bypass empty buffer.
+    assert await instance.receive_some_into(buffer) == 10
+    assert buffer == data[8:18]
+    assert receive_sizes == [8, 10]
+
+    assert await comparison_utils.read_all_bytes_into(instance) == data[18:]
+
+@pytest.mark.parametrize("src_data",
+    [b"", b"a", bytes(range(256)) * 100])
+async def test_read_all_bytes(src_data):
+    reader_stream = comparison_utils.create_randomized_read_input_stream(
+        src_data)
+    actual = await io_utils_internal.read_all_bytes(reader_stream)
+    assert isinstance(actual, bytearray)
+    assert actual == src_data
+
+async def test_copy_reuses_buffer():
+    expected = bytes(range(256)) * 100
+    reader_stream = comparison_utils.create_randomized_read_input_stream(
+        expected)
+    writer_stream = comparison_utils.create_byte_array_output_stream()
+    await io_utils_internal.copy(reader_stream, writer_stream)
+    assert writer_stream.to_byte_array() == expected
+
+async def test_receive_some_into_with_socket():
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_a = trio.SocketStream(sock_a)
+    stream_b = trio.SocketStream(sock_b)
+    await stream_a.send_all(b"abcdef")
+    await stream_a.send_eof()
+    actual = await io_utils_internal.read_bytes_fully(stream_b, 6)
+    assert actual == b"abcdef"
+    assert await io_utils_internal.receive_some_into(
+        stream_b, bytearray(2)) == 0
+    await stream_a.aclose()
+    await stream_b.aclose()
+
+async def test_receive_some_into_with_failing_socket():
+    # assert that reset connections are reported as by receive_some.
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_b = trio.SocketStream(sock_b)
+    await sock_b.send(b"unread")
+    sock_a.close()
+    with pytest.raises(trio.BrokenResourceError):
+        await io_utils_internal.receive_some_into(stream_b, bytearray(2))
+    await stream_b.aclose()
+    with pytest.raises(trio.ClosedResourceError):
+        await io_utils_internal.receive_some_into(stream_b, bytearray(2))
+
+    # assert that closing during a read is reported.
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_b = trio.SocketStream(sock_b)
+    errors = []
+    async def receive():
+        try:
+            await io_utils_internal.receive_some_into(stream_b,
+                bytearray(2))
+        except trio.ClosedResourceError as ex:
+            errors.append(ex)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(receive)
+        await trio.testing.wait_all_tasks_blocked()
+        await stream_b.aclose()
+    assert len(errors) == 1
+    sock_a.close()
+
+async def test_receive_some_into_with_other_socket_streams():
+    # assert that streams which merely expose sockets are read
+    # through receive_some.
+    class SocketStreamWrapper:
+        def __init__(self, stream):
+            self.stream = stream
+            self.socket = stream.socket
+        async def receive_some(self, max_bytes=None):
+            return (await self.stream.receive_some(max_bytes)).upper()
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_b = SocketStreamWrapper(trio.SocketStream(sock_b))
+    await sock_a.send(b"ab")
+    buffer = bytearray(2)
+    assert await io_utils_internal.receive_some_into(stream_b, buffer) == 2
+    assert buffer == b"AB"
+    sock_a.close()
+    await stream_b.stream.aclose()
+
+@pytest.mark.parametrize("src_data, buffer_size, depth",
+    [
+        (b"", None, None),
+        (b"ab", 1, 1),
+        (b"abcdefghi", 2, 3),
+        (bytes(range(256)) * 1000, 1000, 2),
+    ])
+async def test_copy_pipelined(src_data, buffer_size, depth):
+    # test both with and without support for reading into buffers.
+    reader_stream = comparison_utils.create_randomized_read_input_stream(
+        src_data)
+    writer_stream = comparison_utils.create_byte_array_output_stream()
+    await io_utils_internal.copy_pipelined(reader_stream, writer_stream,
+        buffer_size, depth)
+    assert writer_stream.to_byte_array() == src_data
+
+    reader_stream = io_utils_internal.create_buffered_readable_stream(
+        comparison_utils.create_randomized_read_input_stream(src_data), 7)
+    writer_stream = comparison_utils.create_byte_array_output_stream()
+    await io_utils_internal.copy_pipelined(reader_stream, writer_stream,
+        buffer_size, depth)
+    assert writer_stream.to_byte_array() == src_data
+
+async def test_copy_pipelined_for_errors():
+    reader_stream = comparison_utils.create_byte_array_input_stream(
+        b"abc")
+    class FailingStream:
+        async def send_all(self, data):
+            raise KabomuIOError("write failed")
+    async def test_routine():
+        await io_utils_internal.copy_pipelined(reader_stream,
+            FailingStream())
+    actual_ex = await comparison_utils.assert_throws(
+        test_routine, KabomuIOError)
+    assert "write failed" in str(actual_ex)
+
+    class FailingReader:
+        async def receive_some(self, max_bytes=None):
+            raise KabomuIOError("read failed")
+    writer_stream = comparison_utils.create_byte_array_output_stream()
+    async def test_routine():
+        await io_utils_internal.copy_pipelined(FailingReader(),
+            writer_stream)
+    actual_ex = await comparison_utils.assert_throws(
+        test_routine, KabomuIOError)
+    assert "read failed" in str(actual_ex)
+
+async def test_get_send_file_source(tmp_path):
+    file_path = tmp_path / "data"
+    file_path.write_bytes(b"abc")
+    async with await trio.open_file(file_path, "rb") as f:
+        assert io_utils_internal.get_send_file_source(f) is f.wrapped
+    async with await trio.open_file(file_path, "r") as f:
+        assert io_utils_internal.get_send_file_source(f) is None
+    async with await trio.open_file(file_path, "ab") as f:
+        assert io_utils_internal.get_send_file_source(f) is None
+    assert io_utils_internal.get_send_file_source(
+        comparison_utils.create_byte_array_input_stream(b"abc")) is None
+
+    assert not io_utils_internal.supports_send_file(
+        comparison_utils.create_byte_array_output_stream())
+    sock_a, sock_b = trio.socket.socketpair()
+    with sock_a, sock_b:
+        assert io_utils_internal.supports_send_file(trio.SocketStream(sock_a))
+        # assert that streams which merely expose sockets are skipped.
+        assert not io_utils_internal.supports_send_file(
+            SimpleNamespace(socket=sock_a))
+
+async def test_send_file_with_failing_socket(tmp_path):
+    file_path = tmp_path / "data"
+    file_path.write_bytes(b"x" * 100_000)
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_a = trio.SocketStream(sock_a)
+    sock_b.close()
+    with open(file_path, "rb") as f:
+        # assert that closed peers are reported as by send_all.
+        with pytest.raises(trio.BrokenResourceError):
+            await io_utils_internal.send_file(stream_a, f, 100_000)
+        assert f.tell() == 0
+        await stream_a.aclose()
+        with pytest.raises(trio.ClosedResourceError):
+            await io_utils_internal.send_file(stream_a, f, 100_000)
+
+@pytest.mark.parametrize("chunk_size", [None, 1000, 1_000_000])
+async def test_copy_file(tmp_path, monkeypatch, chunk_size):
+    sendfile_calls = 0
+    original_sendfile = os.sendfile
+    def counting_sendfile(*args):
+        nonlocal sendfile_calls
+        sendfile_calls += 1
+        return original_sendfile(*args)
+    monkeypatch.setattr(os, "sendfile", counting_sendfile)
+
+    # exceed socket buffer sizes to cause writes to block.
+    data = bytes(range(256)) * 12_000
+    file_path = tmp_path / "data"
+    file_path.write_bytes(data)
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_a = trio.SocketStream(sock_a)
+    stream_b = trio.SocketStream(sock_b)
+    actual = bytearray()
+    async def receive():
+        while len(actual) < len(data) - 5:
+            actual.extend(await stream_b.receive_some())
+    async with await trio.open_file(file_path, "rb") as f:
+        # start from position left behind by buffered read.
+        assert await f.read(5) == data[:5]
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(receive)
+            await io_utils_internal.copy_file(
+                io_utils_internal.get_send_file_source(f), stream_a,
+                chunk_size)
+        assert await f.tell() == len(data)
+        assert await f.read() == b""
+    assert actual == data[5:]
+    assert sendfile_calls > 0
+    await stream_a.aclose()
+    await stream_b.aclose()
+
+@pytest.mark.parametrize("offset, length, expected_slice",
+    [
+        (0, None, slice(None)),
+        (0, 0, slice(0, 0)),
+        (5, None, slice(5, None)),
+        (5, 10, slice(5, 15)),
+        # exceed allocation granularity.
+        (70_000, 100, slice(70_000, 70_100)),
+        (100_000, None, slice(100_000, None)),
+        (200_000, None, slice(0, 0)),
+    ])
+async def test_memory_mapped_readable_stream(tmp_path,
+        offset, length, expected_slice):
+    data = bytes(range(256)) * 400
+    file_path = tmp_path / "data"
+    file_path.write_bytes(data)
+    expected = data[expected_slice]
+    with open(file_path, "rb") as f:
+        instance = io_utils_internal.create_memory_mapped_readable_stream(
+            f, offset, length)
+    assert instance.content_length == len(expected)
+    first_chunk = await instance.receive_some(3)
+    assert isinstance(first_chunk, memoryview)
+    assert first_chunk == expected[:3]
+    assert instance.content_length == max(len(expected) - 3, 0)
+    assert await comparison_utils.read_all_bytes(instance) == expected[3:]
+    assert instance.content_length == 0
+    assert await instance.receive_some() == b""
+
+    # assert that closing with slices in use does not fail.
+    await instance.aclose()
+    assert await instance.receive_some() == b""
+    assert first_chunk == expected[:3]
+    await instance.aclose()
+
+async def test_memory_mapped_readable_stream_for_errors(tmp_path):
+    file_path = tmp_path / "data"
+    file_path.write_bytes(b"abc")
+    with open(file_path, "rb") as f:
+        with pytest.raises(ValueError):
+            io_utils_internal.create_memory_mapped_readable_stream(f, -1)
+        with pytest.raises(ValueError):
+            io_utils_internal.create_memory_mapped_readable_stream(
+                f, 0, -1)
+        with pytest.raises(ValueError):
+            io_utils_internal.create_memory_mapped_readable_stream(
+                f.fileno(), 0, 4)
+
+@pytest.mark.parametrize("src_data, max_size, expected",
+    [
+        (b"", 0, True),
+        (b"", 2, True),
+        (b"a", 0, False),
+        (b"ab", 2, True),
+        (b"abc", 2, False),
+        (b"abcdefghijklmn", 20, True),
+    ])
+async def test_drain(src_data, max_size, expected):
+    reader = comparison_utils.create_randomized_read_input_stream(src_data)
+    actual = await io_utils_internal.drain(reader, max_size)
+    assert actual == expected
+    if expected:
+        assert await reader.receive_some(1) == b""
+
+async def test_bytes_readable_stream():
+    instance = io_utils_internal.create_bytes_readable_stream(b"abcdef")
+    assert instance.content_length == 6
+    assert await instance.receive_some(4) == b"abcd"
+    assert instance.content_length == 2
+    buffer = bytearray(5)
+    assert await io_utils_internal.receive_some_into(instance, buffer) == 2
+    assert buffer[:2] == b"ef"
+    assert await instance.receive_some() == b""
+
+    # assert that rest is read after bytes.
+    rest = comparison_utils.create_randomized_read_input_stream(b"ghij")
+    instance = io_utils_internal.create_bytes_readable_stream(b"abc", rest)
+    assert instance.content_length is None
+    assert await comparison_utils.read_all_bytes(instance) == b"abcghij"
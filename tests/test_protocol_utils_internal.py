@@ -1,9 +1,13 @@
+import random
+
 import pytest
+import trio
 
 from types import SimpleNamespace
 
-from kabomu.abstractions import IQuasiHttpConnection
-from kabomu import protocol_utils_internal
+from kabomu.abstractions import IQuasiHttpConnection, Headers
+from kabomu import protocol_utils_internal, header_compression_utils_internal,\
+    io_utils_internal
 from kabomu.errors import QuasiHttpError,\
     QUASI_HTTP_ERROR_REASON_TIMEOUT,\
     QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION
@@ -295,6 +299,59 @@ def test_encode_quasi_http_headers_for_errors(
     assert actual_ex.value.reason_code == QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION
     assert expected in str(actual_ex.value)
 
+@pytest.mark.parametrize("is_response, req_or_status_line, remaining_headers, max_headers_size, expected",
+    [
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            {
+                "Content:Type": ["text/plain"]
+            },
+            None,
+            "quasi http header name contains characters other than hyphen"
+        ),
+        (
+            True,
+            ["HTTP/1.1", 200, "OK", 0],
+            {
+                "Content-Type": ["text/plain\r"]
+            },
+            None,
+            "quasi http header value contains newlines"
+        ),
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            None,
+            24,
+            "quasi http headers exceed max size (25 > 24)"
+        ),
+        (
+            True,
+            ["HTTP/1.1", 200, "OK", 0],
+            {
+                "Accept": ["text/plain"],
+                # must not be reached.
+                "": ["text/csv"]
+            },
+            40,
+            "quasi http headers exceed max size (48 > 40)"
+        )
+    ])
+def test_encode_quasi_http_headers_for_more_errors(
+        is_response, req_or_status_line, remaining_headers,
+        max_headers_size, expected):
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        protocol_utils_internal.encode_quasi_http_headers(
+            is_response, req_or_status_line, remaining_headers,
+            max_headers_size)
+    assert expected in str(actual_ex.value)
+
+def test_encode_quasi_http_headers_within_max_size():
+    actual = protocol_utils_internal.encode_quasi_http_headers(
+        False, ["GET", "/", "HTTP/1.1", 0], None, 25)
+    assert actual == b'"GET","/","HTTP/1.1","0"\n'
+
 @pytest.mark.parametrize("is_response, s, expected_headers, expected_req_or_status_line",
     [
         (
@@ -368,3 +425,746 @@ def test_decode_quasi_http_headers_for_errors(is_response, s,
             is_response, s.encode(), {})
     assert actual_ex.value.reason_code == QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION
     assert expected_error_message in str(actual_ex.value)
+
+def _decode_quasi_http_headers_with_csv_reader(is_response, buffer):
+    # reference implementation, which relies entirely on csv module.
+    headers_receiver = {}
+    csv_data = protocol_utils_internal._decode_csv_rows(buffer)
+    special_header = csv_data[0]
+    if len(special_header) < 4:
+        raise QuasiHttpError(QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION,
+            "invalid quasi http " +
+            ("status" if is_response else "request") + " line")
+    for header_row in csv_data[1:]:
+        if len(header_row) < 2:
+            continue
+        header_name = header_row[0].lower()
+        if header_name not in headers_receiver:
+            headers_receiver[header_name] = []
+        headers_receiver[header_name].extend(header_row[1:])
+    return special_header, headers_receiver
+
+def _create_header_decoding_corpus():
+    corpus = [
+        b'"GET","/","HTTP/1.1","0"\n',
+        b'"GET","/","HTTP/1.1","0"',
+        b'"GET","/","HTTP/1.1","0"\r\n',
+        b'"HTTP/1.1","200","OK","0"\n"A","b"\n"a","c","d"\n',
+        b'"HTTP/1.1","200","OK","0"\n"A"\n"a","c"\n',
+        b'"HTTP/1.1","200","OK","0"\n\n"a","c"\n',
+        b'"","","",""\n"x",""\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","a""b"\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","a\nb"\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","a\rb"\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","a,b"\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","a"b\n',
+        b'"GET","/","HTTP/1.1","0"\n"x",a"b\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","\xc3\xa9"\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","\xc3"\n',
+        b'"GET","/","HTTP/1.1","0"\n"x","\x00"\n',
+        b'"GET","/","HTTP/1.1","0"\n"\n',
+        b'"GET","/","HTTP/1.1","0"\n""\n',
+        b'"GET","/","HTTP/1.1","0"\n","\n',
+        b'"GET","/","HTTP/1.1","0"\n"""\n',
+        b'"\n"\n',
+        b'"\n',
+        b'\n',
+        b'',
+    ]
+    rnd = random.Random(7)
+    alphabet = ['"', ',', '\n', '\r', 'a', 'B', ' ', '\x00',
+                'é', '""', '","', '"\n']
+    for _ in range(500):
+        rows = []
+        for i in range(rnd.randint(1, 4)):
+            field_count = 4 if not i else rnd.randint(1, 3)
+            rows.append(",".join(
+                '"' + "".join(rnd.choice(alphabet[4:])
+                    for _ in range(rnd.randint(0, 3))) + '"'
+                for _ in range(field_count)))
+        corpus.append(("\n".join(rows) + "\n").encode())
+        corpus.append("".join(rnd.choice(alphabet)
+            for _ in range(rnd.randint(0, 20))).encode())
+    return corpus
+
+@pytest.mark.parametrize("is_response", [False, True])
+def test_decode_quasi_http_headers_against_csv_reader(is_response):
+    for buffer in _create_header_decoding_corpus():
+        try:
+            expected = _decode_quasi_http_headers_with_csv_reader(
+                is_response, buffer)
+        except QuasiHttpError as ex:
+            expected = ex
+        for b in [buffer, bytearray(buffer)]:
+            headers_receiver = {}
+            try:
+                actual = protocol_utils_internal.decode_quasi_http_headers(
+                    is_response, b, headers_receiver), headers_receiver
+            except QuasiHttpError as ex:
+                actual = ex
+            if isinstance(expected, QuasiHttpError):
+                assert isinstance(actual, QuasiHttpError), buffer
+                assert str(actual) == str(expected)
+                assert actual.reason_code == expected.reason_code
+            else:
+                assert actual == expected, buffer
+
+def test_decode_quasi_http_headers_merges_into_existing_headers():
+    headers_receiver = {
+        "accept": ["text/csv"]
+    }
+    protocol_utils_internal.decode_quasi_http_headers(
+        False,
+        b'"GET","/","HTTP/1.1","0"\n"Accept","text/plain"\n"te","x"\n',
+        headers_receiver)
+    assert headers_receiver == {
+        "accept": ["text/csv", "text/plain"],
+        "te": ["x"]
+    }
+
+def test_decode_quasi_http_headers_lazily():
+    buffer = bytearray(b'"HTTP/1.1","200","OK","0"\n' +
+        b'"Content-Type","text/plain"\n"content-type","text/csv"\n' +
+        b'"Accept","*/*"\n')
+    actual_status_line, actual_headers = \
+        protocol_utils_internal.decode_quasi_http_headers_lazily(
+            True, buffer)
+    assert actual_status_line == ["HTTP/1.1", "200", "OK", "0"]
+    assert isinstance(actual_headers, Headers)
+    assert actual_headers.get_raw_rows() == buffer[26:]
+    assert actual_headers == {
+        "content-type": ["text/plain", "text/csv"],
+        "accept": ["*/*"]
+    }
+    assert "accept" in actual_headers
+    assert actual_headers.get_raw_rows() == buffer[26:]
+
+    # test that modifications are detected.
+    actual_headers["accept"].append("text/html")
+    assert actual_headers.get_raw_rows() is None
+    actual_headers["accept"].pop()
+    assert actual_headers.get_raw_rows() == buffer[26:]
+    del actual_headers["accept"]
+    assert actual_headers.get_raw_rows() is None
+    assert actual_headers == {
+        "content-type": ["text/plain", "text/csv"]
+    }
+
+@pytest.mark.parametrize("is_response, s, expected_headers, expected_req_or_status_line",
+    [
+        (
+            False,
+            '"GET","/","HTTP/1.1","0"\n',
+            {},
+            ["GET", "/", "HTTP/1.1", "0"]
+        ),
+        (
+            False,
+            'GET,/,HTTP/1.1,0\nAccept,"text/plain"\n',
+            {
+                "accept": ["text/plain"]
+            },
+            ["GET", "/", "HTTP/1.1", "0"]
+        ),
+        (
+            True,
+            '"HTTP/1.1","200","OK","0"\n"A"\n"b","c",""\n',
+            {
+                "b": ["c", ""]
+            },
+            ["HTTP/1.1", "200", "OK", "0"]
+        )
+    ])
+def test_decode_quasi_http_headers_lazily_2(is_response, s, expected_headers,
+                                            expected_req_or_status_line):
+    actual_req_or_status_line, actual_headers = \
+        protocol_utils_internal.decode_quasi_http_headers_lazily(
+            is_response, s.encode())
+    assert actual_req_or_status_line == expected_req_or_status_line
+    assert actual_headers == expected_headers
+
+@pytest.mark.parametrize("is_response, s, expected_error_message",
+    [
+        (
+            False,
+            '"GET","/","HTTP/1.1"\n',
+            "invalid quasi http request line"
+        ),
+        (
+            True,
+            '"HTTP/1.1","200","OK","0"\n"k\n,lopp',
+            "invalid quasi http headers"
+        )
+    ])
+def test_decode_quasi_http_headers_lazily_for_errors(is_response, s,
+                                                     expected_error_message):
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        _, actual_headers = \
+            protocol_utils_internal.decode_quasi_http_headers_lazily(
+                is_response, s.encode())
+        # errors in rows after request or status line surface on access.
+        len(actual_headers)
+    assert actual_ex.value.reason_code == QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION
+    assert expected_error_message in str(actual_ex.value)
+
+@pytest.mark.parametrize("raw_rows, expected",
+    [
+        (
+            b'"Content-Type","text/plain"\n"content-type","a""b"\n',
+            b'"Content-Type","text/plain"\n"content-type","a""b"\n'
+        ),
+        (
+            b'"Content-Type",text/plain\n',
+            b'"content-type","text/plain"\n'
+        ),
+        (
+            b'"Content-Type","text/plain"\n"x"\n',
+            b'"content-type","text/plain"\n'
+        )
+    ])
+def test_encode_quasi_http_headers_with_raw_rows(raw_rows, expected):
+    _, headers = protocol_utils_internal.decode_quasi_http_headers_lazily(
+        False, b'"GET","/","HTTP/1.1","0"\n' + raw_rows)
+    actual = protocol_utils_internal.encode_quasi_http_headers(
+        False, ["POST", "/", "HTTP/1.1", 0], headers, 100)
+    assert actual == b'"POST","/","HTTP/1.1","0"\n' + expected
+
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        protocol_utils_internal.encode_quasi_http_headers(
+            False, ["POST", "/", "HTTP/1.1", 0], headers, 30)
+    assert "quasi http headers exceed max size" in str(actual_ex.value)
+
+@pytest.mark.parametrize("is_response, req_or_status_line, remaining_headers, expected, expected_req_or_status_line, expected_headers",
+    [
+        (
+            False,
+            ["GET", "/home/index?q=results", "HTTP/1.1", -1],
+            {
+                "Content-Type": ["text/plain"]
+            },
+            bytes([0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff,
+                0, 1, 0, 1,
+                0, 3, 0, 21, 0, 8, 0, 12, 0, 10]) +
+                b"GET/home/index?q=resultsHTTP/1.1Content-Typetext/plain",
+            ["GET", "/home/index?q=results", "HTTP/1.1", -1],
+            {
+                "content-type": ["text/plain"]
+            }
+        ),
+        (
+            True,
+            ["HTTP/1.1", 200, "OK", 12],
+            {
+                "Content-Type": ["text/plain", "text/csv"],
+                "content-type": "text/html",
+                "Accept": [],
+                "Accept-Charset": ["utf-8"]
+            },
+            bytes([0, 0, 0, 200,
+                0, 0, 0, 0, 0, 0, 0, 12,
+                0, 3, 0, 2, 0, 1, 0, 1,
+                0, 8, 0, 2, 0, 12, 0, 10, 0, 8, 0, 12, 0, 9,
+                0, 14, 0, 5]) +
+                b"HTTP/1.1OKContent-Typetext/plaintext/csv" +
+                b"content-typetext/htmlAccept-Charsetutf-8",
+            ["HTTP/1.1", 200, "OK", 12],
+            {
+                "content-type": ["text/plain", "text/csv", "text/html"],
+                "accept-charset": ["utf-8"]
+            }
+        ),
+        (
+            False,
+            [None, None, None, 0],
+            None,
+            bytes([0, 0, 0, 0, 0, 0, 0, 0,
+                0, 0,
+                0, 0, 0, 0, 0, 0]),
+            ["", "", "", 0],
+            {}
+        )
+    ])
+def test_binary_quasi_http_headers_codec(
+        is_response, req_or_status_line, remaining_headers, expected,
+        expected_req_or_status_line, expected_headers):
+    actual = protocol_utils_internal.encode_binary_quasi_http_headers(
+        is_response, req_or_status_line, remaining_headers)
+    assert actual == expected
+
+    headers_receiver = {}
+    actual_req_or_status_line = \
+        protocol_utils_internal.decode_binary_quasi_http_headers(
+            is_response, actual, headers_receiver)
+    assert actual_req_or_status_line == expected_req_or_status_line
+    assert headers_receiver == expected_headers
+
+@pytest.mark.parametrize("is_response, req_or_status_line, remaining_headers, max_headers_size, expected",
+    [
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", "x"],
+            None,
+            None,
+            "invalid quasi http request line field"
+        ),
+        (
+            True,
+            ["HTTP/1.1", 2_147_483_648, "OK", 0],
+            None,
+            None,
+            "invalid quasi http status line field"
+        ),
+        (
+            True,
+            ["HTTP 1.1", 200, "OK", 0],
+            None,
+            None,
+            "quasi http status line field contains spaces"
+        ),
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            {
+                "x": ["a" * 65_536]
+            },
+            None,
+            "quasi http header field exceeds max binary length"
+        ),
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            {
+                "x": ["b\n"]
+            },
+            None,
+            "quasi http header value contains newlines"
+        ),
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            {
+                "x": ["b"]
+            },
+            30,
+            "quasi http headers exceed max size (36 > 30)"
+        )
+    ])
+def test_encode_binary_quasi_http_headers_for_errors(
+        is_response, req_or_status_line, remaining_headers,
+        max_headers_size, expected):
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        protocol_utils_internal.encode_binary_quasi_http_headers(
+            is_response, req_or_status_line, remaining_headers,
+            max_headers_size)
+    assert expected in str(actual_ex.value)
+
+@pytest.mark.parametrize("is_response, buffer",
+    [
+        (False, b""),
+        (False, bytes([0, 1]) + b"GET"),
+        (True, bytes([0, 0, 0, 0, 0, 200, 0, 0])),
+        (False, bytes([0, 0, 0, 0, 0, 0, 0, 0,
+            0, 0, 0, 0, 0, 0, 0, 0, 0x61])),
+        (False, bytes([0, 0, 0, 0, 0, 0, 0, 0,
+            0, 0, 0, 1, 0, 0, 0, 0, 0xc3])),
+        (True, bytes([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+            0, 1, 0, 1, 0, 0, 0, 0, 0, 0, 0])),
+    ])
+def test_decode_binary_quasi_http_headers_for_errors(is_response, buffer):
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        protocol_utils_internal.decode_binary_quasi_http_headers(
+            is_response, buffer, {})
+    assert actual_ex.value.reason_code == QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION
+    assert "invalid quasi http headers" in str(actual_ex.value)
+
+@pytest.mark.parametrize("binary_headers_enabled, header_table",
+    [
+        (False, None),
+        (True, None),
+        (False, header_compression_utils_internal.HeaderTable()),
+    ])
+async def test_quasi_http_headers_tag_dispatch(binary_headers_enabled,
+                                               header_table):
+    dest = comparison_utils.create_byte_array_output_stream()
+    await protocol_utils_internal.write_quasi_http_headers(
+        True, dest, ["HTTP/1.1", 404, "Not Found", 0],
+        { "Accept": "text/plain" }, None, binary_headers_enabled,
+        header_table)
+    src = comparison_utils.create_randomized_read_input_stream(
+        dest.to_byte_array())
+    headers_receiver = {}
+    actual = await protocol_utils_internal.read_quasi_http_headers(
+        True, src, headers_receiver, None)
+    assert [str(v) for v in actual] == ["HTTP/1.1", "404", "Not Found", "0"]
+    assert headers_receiver == { "accept": ["text/plain"] }
+
+@pytest.mark.parametrize("is_response, req_or_status_line, remaining_headers, expected_req_or_status_line, expected_headers",
+    [
+        (
+            False,
+            ["POST", "/home/index?q=results", "HTTP/1.1", -1],
+            {
+                "Content-Type": ["text/plain", "text/csv"],
+                "content-type": "text/html",
+                "Accept": [],
+                "X-Trace": ["a", "a"]
+            },
+            ["POST", "/home/index?q=results", "HTTP/1.1", "-1"],
+            {
+                "content-type": ["text/plain", "text/csv", "text/html"],
+                "x-trace": ["a", "a"]
+            }
+        ),
+        (
+            True,
+            ["HTTP/1.1", 200, "Everything Fine", 12],
+            None,
+            ["HTTP/1.1", "200", "Everything Fine", "12"],
+            {}
+        ),
+        (
+            False,
+            [None, None, None, 0],
+            {},
+            ["", "", "", "0"],
+            {}
+        )
+    ])
+def test_compressed_quasi_http_headers_codec(
+        is_response, req_or_status_line, remaining_headers,
+        expected_req_or_status_line, expected_headers):
+    encoder_table = header_compression_utils_internal.HeaderTable()
+    encoder_table.set_max_size(256)
+    decoder_table = header_compression_utils_internal.HeaderTable()
+    for _ in range(2):
+        encoded = protocol_utils_internal.encode_compressed_quasi_http_headers(
+            is_response, req_or_status_line, remaining_headers,
+            encoder_table)
+        headers_receiver = {}
+        actual_req_or_status_line = \
+            protocol_utils_internal.decode_compressed_quasi_http_headers(
+                is_response, encoded, decoder_table, headers_receiver)
+        assert actual_req_or_status_line == expected_req_or_status_line
+        assert headers_receiver == expected_headers
+        assert len(decoder_table) == len(encoder_table)
+
+@pytest.mark.parametrize("is_response, req_or_status_line, remaining_headers, max_headers_size, expected",
+    [
+        (
+            True,
+            ["HTTP 1.1", 200, "OK", 0],
+            None,
+            None,
+            "quasi http status line field contains spaces"
+        ),
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            {
+                "x": ["b\n"]
+            },
+            None,
+            "quasi http header value contains newlines"
+        ),
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            {
+                "x y": ["b"]
+            },
+            None,
+            "quasi http header name contains characters"
+        ),
+        (
+            False,
+            ["GET", "/", "HTTP/1.1", 0],
+            {
+                "x-a": ["b"]
+            },
+            50,
+            "quasi http headers exceed max size (54 > 50)"
+        )
+    ])
+def test_encode_compressed_quasi_http_headers_for_errors(
+        is_response, req_or_status_line, remaining_headers,
+        max_headers_size, expected):
+    encoder_table = header_compression_utils_internal.HeaderTable()
+    encoder_table.set_max_size(256)
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        protocol_utils_internal.encode_compressed_quasi_http_headers(
+            is_response, req_or_status_line, remaining_headers,
+            encoder_table, max_headers_size)
+    assert expected in str(actual_ex.value)
+    # ensure nothing was added to table.
+    assert not len(encoder_table)
+
+def test_encode_compressed_quasi_http_headers_clears_table():
+    # fields are within limit, but not their encoding.
+    encoder_table = header_compression_utils_internal.HeaderTable()
+    encoder_table.set_max_size(256)
+    encoder_table.add("x-a", "1")
+    remaining_headers = { chr(c): "1" for c in range(ord("a"), ord("u")) }
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        protocol_utils_internal.encode_compressed_quasi_http_headers(
+            False, ["GET", "/", "", 0], remaining_headers, encoder_table, 90)
+    assert "quasi http headers exceed max size (107 > 90)" in \
+        str(actual_ex.value)
+    assert not len(encoder_table)
+
+@pytest.mark.parametrize("is_response, buffer",
+    [
+        (False, b""),
+        (True, bytes([0x81, 0x89, 0x8d, 0x97])),
+        (False, bytes([0x81, 0x89, 0x8d, 0x97, 0x81])),
+        (False, bytes([0x81, 0x89, 0x8d, 0x97, 0xff, 0x7f])),
+        (False, bytes([0x81, 0x89, 0x8d, 0x97, 0x00, 0x05])),
+    ])
+def test_decode_compressed_quasi_http_headers_for_errors(is_response,
+                                                         buffer):
+    decoder_table = header_compression_utils_internal.HeaderTable()
+    with pytest.raises(QuasiHttpError) as actual_ex:
+        protocol_utils_internal.decode_compressed_quasi_http_headers(
+            is_response, buffer, decoder_table, {})
+    assert actual_ex.value.reason_code == QUASI_HTTP_ERROR_REASON_PROTOCOL_VIOLATION
+    assert "invalid quasi http headers" in str(actual_ex.value)
+
+async def test_entities_with_compressed_headers():
+    # ensure compression context is kept with connection.
+    processing_options = SimpleNamespace(max_header_table_size=4096)
+    sender = SimpleNamespace(processing_options=processing_options)
+    receiver = SimpleNamespace()
+    dest = comparison_utils.create_byte_array_output_stream()
+    request = SimpleNamespace(http_method="GET", target="/",
+        headers={ "X-Custom": "some value" })
+    await protocol_utils_internal.write_entity_to_transport(
+        False, request, dest, sender)
+    first_len = len(dest.to_byte_array())
+    await protocol_utils_internal.write_entity_to_transport(
+        False, request, dest, sender)
+    assert len(dest.to_byte_array()) - first_len < first_len
+    assert sender.header_compression_context
+
+    src = comparison_utils.create_randomized_read_input_stream(
+        dest.to_byte_array())
+    for _ in range(2):
+        actual = await protocol_utils_internal.read_entity_from_transport(
+            False, src, receiver)
+        assert actual.http_method == "GET"
+        assert actual.target == "/"
+        assert actual.content_length == 0
+        assert dict(actual.headers) == { "x-custom": ["some value"] }
+    assert receiver.header_compression_context
+
+async def test_read_entity_from_transport_with_buffering():
+    dest = comparison_utils.create_byte_array_output_stream()
+    request = SimpleNamespace(http_method="POST", target="/", content_length=-1,
+        headers={ "X-Custom": "some value" },
+        body=comparison_utils.create_byte_array_input_stream(b"abc"))
+    await protocol_utils_internal.write_entity_to_transport(
+        False, request, dest, None)
+    request.body = comparison_utils.create_byte_array_input_stream(b"de")
+    await protocol_utils_internal.write_entity_to_transport(
+        False, request, dest, None)
+    backing_stream = comparison_utils.create_byte_array_input_stream(
+        dest.to_byte_array())
+    receive_count = 0
+    class CountingStream:
+        async def receive_some(self, max_bytes=None):
+            nonlocal receive_count
+            receive_count += 1
+            return await backing_stream.receive_some(max_bytes)
+    readable_stream = CountingStream()
+    connection = SimpleNamespace()
+
+    actual = await protocol_utils_internal.read_entity_from_transport(
+        False, readable_stream, connection)
+    assert await comparison_utils.read_all_bytes(actual.body) == b"abc"
+    # both messages fit into a single buffer fill.
+    assert receive_count == 1
+
+    # ensure bytes read ahead are kept with connection.
+    buffered_stream = connection.buffered_readable_stream
+    actual = await protocol_utils_internal.read_entity_from_transport(
+        False, readable_stream, connection)
+    assert await comparison_utils.read_all_bytes(actual.body) == b"de"
+    assert connection.buffered_readable_stream is buffered_stream
+    assert protocol_utils_internal.get_buffered_readable_stream(
+        None, buffered_stream) is buffered_stream
+
+@pytest.mark.parametrize("content_length, body_len, write_coalescing_threshold, expected_send_count",
+    [
+        (3, 3, None, 1),
+        (3, 3, -1, 2),
+        (3, 3, 3, 1),
+        (4, 4, 3, 2),
+        (2, 3, 2, 2),
+        (2, 6, 2, 2),
+        (2, 3, 3, 2),
+        (3, 2, 3, 1),
+        (16_384, 16_384, None, 1),
+        (16_385, 16_385, None, 2),
+    ])
+@pytest.mark.parametrize("in_memory", [True, False])
+async def test_write_entity_to_transport_with_coalescing(
+        content_length, body_len, write_coalescing_threshold,
+        expected_send_count, in_memory):
+    body_data = b"a" * body_len
+    dest = comparison_utils.create_byte_array_output_stream()
+    send_count = 0
+    class CountingStream:
+        async def send_all(self, data):
+            nonlocal send_count
+            send_count += 1
+            await dest.send_all(data)
+    connection = SimpleNamespace(processing_options=SimpleNamespace(
+        write_coalescing_threshold=write_coalescing_threshold))
+    if in_memory:
+        body = io_utils_internal.create_bytes_readable_stream(body_data)
+    else:
+        body = comparison_utils.create_byte_array_input_stream(body_data)
+        # assert that only bodies held in memory are coalesced.
+        expected_send_count = 2
+    response = SimpleNamespace(status_code=200,
+        content_length=content_length, body=body)
+    await protocol_utils_internal.write_entity_to_transport(
+        True, response, CountingStream(), connection)
+    assert send_count == expected_send_count
+
+    # ensure body bytes beyond content length are written as well.
+    expected = comparison_utils.concat_buffers(
+        *protocol_utils_internal.encode_quasi_http_header_section(
+            True, ["", 200, "", content_length], None, None), body_data)
+    assert dest.to_byte_array() == expected
+
+async def test_write_entity_to_transport_with_coalescing_and_slow_body(
+        autojump_clock):
+    # body which supplies its declared length only later.
+    class SlowStream:
+        def __init__(self):
+            self.data = b"hello"
+        async def receive_some(self, max_bytes=None):
+            await trio.sleep(5)
+            data, self.data = self.data, b""
+            return data
+    send_times = []
+    class RecordingStream:
+        async def send_all(self, data):
+            send_times.append(trio.current_time())
+    response = SimpleNamespace(status_code=200, content_length=5,
+        body=SlowStream())
+    await protocol_utils_internal.write_entity_to_transport(
+        True, response, RecordingStream(), SimpleNamespace())
+    # assert that headers are not held back by body.
+    assert send_times == [0, 5]
+
+@pytest.mark.parametrize("content_length", [-1, 76_800])
+async def test_write_entity_to_transport_with_pipelined_copy(content_length):
+    body_data = bytes(range(256)) * 300
+    dest = comparison_utils.create_byte_array_output_stream()
+    connection = SimpleNamespace(processing_options=SimpleNamespace(
+        body_copy_buffer_size=1000, body_copy_pipeline_depth=3))
+    request = SimpleNamespace(http_method="PUT", target="/",
+        content_length=content_length,
+        body=comparison_utils.create_randomized_read_input_stream(
+            body_data))
+    await protocol_utils_internal.write_entity_to_transport(
+        False, request, dest, connection)
+    src = comparison_utils.create_randomized_read_input_stream(
+        dest.to_byte_array())
+    actual = await protocol_utils_internal.read_entity_from_transport(
+        False, src, SimpleNamespace())
+    assert actual.content_length == content_length
+    assert await comparison_utils.read_all_bytes(actual.body) == body_data
+
+@pytest.mark.parametrize("content_length, chunk_size",
+    [(-1, None), (-1, 10_000), (76_800, None), (76_800, 10_000)])
+async def test_write_entity_to_transport_with_send_file(tmp_path,
+        content_length, chunk_size):
+    body_data = bytes(range(256)) * 300
+    file_path = tmp_path / "body"
+    file_path.write_bytes(body_data)
+    sock_a, sock_b = trio.socket.socketpair()
+    stream_a = trio.SocketStream(sock_a)
+    stream_b = trio.SocketStream(sock_b)
+    connection = SimpleNamespace(processing_options=SimpleNamespace(
+        body_copy_buffer_size=chunk_size))
+    async with await trio.open_file(file_path, "rb") as body:
+        request = SimpleNamespace(http_method="PUT", target="/",
+            content_length=content_length, body=body)
+        async def write():
+            await protocol_utils_internal.write_entity_to_transport(
+                False, request, stream_a, connection)
+            await stream_a.send_eof()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(write)
+            actual = await protocol_utils_internal.read_entity_from_transport(
+                False, stream_b, SimpleNamespace())
+            assert actual.content_length == content_length
+            assert await comparison_utils.read_all_bytes(
+                actual.body) == body_data
+        assert await body.tell() == len(body_data)
+    await stream_a.aclose()
+    await stream_b.aclose()
+
+@pytest.mark.parametrize("content_length, expected_content_length",
+    [(None, 76_790), (-1, -1), (76_790, 76_790)])
+async def test_write_entity_to_transport_with_memory_mapped_body(tmp_path,
+        content_length, expected_content_length):
+    body_data = bytes(range(256)) * 300
+    file_path = tmp_path / "body"
+    file_path.write_bytes(body_data)
+    with open(file_path, "rb") as f:
+        body = io_utils_internal.create_memory_mapped_readable_stream(
+            f, 10)
+    dest = comparison_utils.create_byte_array_output_stream()
+    response = SimpleNamespace(status_code=200,
+        content_length=content_length, body=body)
+    await protocol_utils_internal.write_entity_to_transport(
+        True, response, dest, SimpleNamespace())
+    await body.aclose()
+    src = comparison_utils.create_randomized_read_input_stream(
+        dest.to_byte_array())
+    actual = await protocol_utils_internal.read_entity_from_transport(
+        True, src, SimpleNamespace())
+    assert actual.content_length == expected_content_length
+    assert await comparison_utils.read_all_bytes(
+        actual.body) == body_data[10:]
+
+@pytest.mark.parametrize("keep_alive, headers, expected_headers",
+    [
+        (None, None, {}),
+        (None, {"a": "b"}, {"a": ["b"]}),
+        (True, None, {"connection": ["keep-alive"]}),
+        (False, {"a": "b"}, {"a": ["b"], "connection": ["close"]}),
+        (True, {"Connection": "close"}, {"connection": ["close"]}),
+    ])
+async def test_write_entity_to_transport_with_keep_alive(keep_alive,
+        headers, expected_headers):
+    dest = comparison_utils.create_byte_array_output_stream()
+    connection = SimpleNamespace(keep_alive=keep_alive)
+    request = SimpleNamespace(http_method="GET", headers=headers)
+    await protocol_utils_internal.write_entity_to_transport(
+        False, request, dest, connection)
+    src = comparison_utils.create_randomized_read_input_stream(
+        dest.to_byte_array())
+    actual = await protocol_utils_internal.read_entity_from_transport(
+        False, src, SimpleNamespace())
+    assert dict(actual.headers) == expected_headers
+    assert protocol_utils_internal.has_keep_alive_header(
+        actual.headers) == (expected_headers.get("connection") ==
+            ["keep-alive"])
+    # assert that request headers are left as they are.
+    assert request.headers == headers
+
+@pytest.mark.parametrize("headers, expected",
+    [
+        (None, False),
+        ({}, False),
+        ({"connection": "keep-alive"}, True),
+        ({"connection": ["Keep-Alive"]}, True),
+        ({"connection": ["close"]}, False),
+        ({"keep-alive": ["connection"]}, False),
+    ])
+def test_has_keep_alive_header(headers, expected):
+    assert protocol_utils_internal.has_keep_alive_header(
+        headers) == expected
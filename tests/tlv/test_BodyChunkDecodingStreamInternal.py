@@ -57,15 +57,19 @@ from tests.shared import comparison_utils
                 bytes([2, 3, 2, 3, 45, 62,
                     91, 100, 2, 3, 45, 62, 70, 87]))
     ])
+@pytest.mark.parametrize("read_into", [False, True])
 async def test_reading(src_data, expected_tag,
-                       tag_to_ignore, expected):
+                       tag_to_ignore, expected, read_into):
     instance = comparison_utils.create_randomized_read_input_stream(
         src_data)
     instance = tlv_utils.create_tlv_decoding_readable_stream(
         instance, expected_tag, tag_to_ignore)
 
     # act
-    actual = await comparison_utils.read_all_bytes(instance)
+    if read_into:
+        actual = await comparison_utils.read_all_bytes_into(instance)
+    else:
+        actual = await comparison_utils.read_all_bytes(instance)
 
     # assert
     assert actual == expected
@@ -104,8 +108,9 @@ async def test_reading(src_data, expected_tag,
                 0, 0, 0, 0]), 14, 15,
                 "invalid tag value length: -20")
     ])
+@pytest.mark.parametrize("read_into", [False, True])
 async def test_decoding_for_errors(src_data, expected_tag,
-                                   tag_to_ignore, expected):
+                                   tag_to_ignore, expected, read_into):
     # arrange
     instance = comparison_utils.create_byte_array_input_stream(src_data)
     instance = tlv_utils.create_tlv_decoding_readable_stream(
@@ -113,7 +118,10 @@ async def test_decoding_for_errors(src_data, expected_tag,
     
     # act
     async def test_routine():
-        await comparison_utils.read_all_bytes(instance)
+        if read_into:
+            await comparison_utils.read_all_bytes_into(instance)
+        else:
+            await comparison_utils.read_all_bytes(instance)
     actual_ex = await comparison_utils.assert_throws(
         test_routine, KabomuIOError)
     assert expected in str(actual_ex)
\ No newline at end of file
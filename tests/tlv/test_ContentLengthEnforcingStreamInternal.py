@@ -19,7 +19,8 @@ from tests.shared import comparison_utils
         (5, "abcde", "abcde"),
         (6, "abcdefghi", "abcdef")
     ])
-async def test_reading(content_length, src_data, expected):
+@pytest.mark.parametrize("read_into", [False, True])
+async def test_reading(content_length, src_data, expected, read_into):
     # arrange
     stream = comparison_utils.create_randomized_read_input_stream(
         src_data.encode())
@@ -27,7 +28,11 @@ async def test_reading(content_length, src_data, expected):
         stream, content_length)
 
     # act
-    actual = await comparison_utils.read_as_string(instance)
+    if read_into:
+        actual = (await comparison_utils.read_all_bytes_into(
+            instance)).decode()
+    else:
+        actual = await comparison_utils.read_as_string(instance)
 
     # assert
     assert actual == expected
@@ -39,7 +44,8 @@ async def test_reading(content_length, src_data, expected):
         (5, "abcd"),
         (15, "abcdef")
     ])
-async def test_reading_for_errors(content_length, src_data):
+@pytest.mark.parametrize("read_into", [False, True])
+async def test_reading_for_errors(content_length, src_data, read_into):
     # arrange
     stream = comparison_utils.create_byte_array_input_stream(
         src_data.encode())
@@ -48,7 +54,10 @@ async def test_reading_for_errors(content_length, src_data):
 
     # act
     async def test_routine():
-        await comparison_utils.read_all_bytes(instance)
+        if read_into:
+            await comparison_utils.read_all_bytes_into(instance)
+        else:
+            await comparison_utils.read_all_bytes(instance)
     actual_ex = await comparison_utils.assert_throws(
         test_routine, KabomuIOError)
     assert "end of read" in str(actual_ex)
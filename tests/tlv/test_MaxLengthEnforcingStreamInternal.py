@@ -19,7 +19,8 @@ from tests.shared import comparison_utils
         (5, "abcde"),
         (60, "abcdefghi")
     ])
-async def test_reading(max_length, expected):
+@pytest.mark.parametrize("read_into", [False, True])
+async def test_reading(max_length, expected, read_into):
     # arrange
     stream = comparison_utils.create_randomized_read_input_stream(
         expected.encode())
@@ -27,7 +28,11 @@ async def test_reading(max_length, expected):
         stream, max_length)
 
     # act
-    actual = await comparison_utils.read_as_string(instance)
+    if read_into:
+        actual = (await comparison_utils.read_all_bytes_into(
+            instance)).decode()
+    else:
+        actual = await comparison_utils.read_as_string(instance)
 
     # assert
     assert actual == expected
@@ -41,7 +46,8 @@ async def test_reading(max_length, expected):
         (5, "abcdefxyz")
     ])
 
-async def test_reading_for_errors(max_length, src_data):
+@pytest.mark.parametrize("read_into", [False, True])
+async def test_reading_for_errors(max_length, src_data, read_into):
     # arrange
     stream = comparison_utils.create_byte_array_input_stream(
         src_data.encode())
@@ -50,7 +56,10 @@ async def test_reading_for_errors(max_length, src_data):
 
     # act
     async def test_routine():
-        await comparison_utils.read_all_bytes(instance)
+        if read_into:
+            await comparison_utils.read_all_bytes_into(instance)
+        else:
+            await comparison_utils.read_all_bytes(instance)
     actual_ex = await comparison_utils.assert_throws(
         test_routine, KabomuIOError)
     assert f"exceeds limit of {max_length}" in str(actual_ex)
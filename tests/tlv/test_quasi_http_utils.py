@@ -2,6 +2,9 @@ import pytest
 from types import SimpleNamespace
 
 from kabomu import quasi_http_utils
+from kabomu.errors import KabomuIOError
+
+from tests.shared import comparison_utils
 
 def test_constant_values():
     assert quasi_http_utils.METHOD_CONNECT == "CONNECT"
@@ -27,6 +30,52 @@ def test_constant_values():
     assert quasi_http_utils.STATUS_CODE_CLIENT_ERROR_UNPROCESSABLE_ENTITY == 422
     assert quasi_http_utils.STATUS_CODE_CLIENT_ERROR_TOO_MANY_REQUESTS == 429
 
+@pytest.mark.parametrize("content_length, body_data, limit, expected",
+    [
+        (None, None, None, b""),
+        (0, b"abc", None, b"abc"),
+        (-1, b"abc", None, b"abc"),
+        (3, b"abc", 3, b"abc"),
+        # assert that reading stops at content length.
+        (2, b"abc", None, b"ab"),
+        (-1, b"abc", 3, b"abc"),
+        (-1, b"abc", -1, b"abc"),
+        (3, b"abc", -1, b"abc"),
+        (-1, bytes(range(256)) * 100, None, bytes(range(256)) * 100),
+    ])
+async def test_read_body_fully(content_length, body_data, limit, expected):
+    body = None
+    if body_data is not None:
+        body = comparison_utils.create_randomized_read_input_stream(
+            body_data)
+    entity = SimpleNamespace(content_length=content_length, body=body)
+    actual = await quasi_http_utils.read_body_fully(entity, limit)
+    assert actual == expected
+
+async def test_read_body_fully_with_advertised_content_length():
+    data = b"abcdef"
+    receive_sizes = []
+    class AdvertisingStream:
+        content_length = 6
+        async def receive_some_into(self, buffer):
+            receive_sizes.append(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+    entity = SimpleNamespace(content_length=-1, body=AdvertisingStream())
+    assert await quasi_http_utils.read_body_fully(entity) == data
+    assert receive_sizes == [6]
+
+@pytest.mark.parametrize("content_length",
+    [-1, 0, 4])
+async def test_read_body_fully_for_errors(content_length):
+    entity = SimpleNamespace(content_length=content_length,
+        body=comparison_utils.create_byte_array_input_stream(b"abcd"))
+    async def test_routine():
+        await quasi_http_utils.read_body_fully(entity, 3)
+    actual_ex = await comparison_utils.assert_throws(
+        test_routine, KabomuIOError)
+    assert "limit of 3 bytes" in str(actual_ex)
+
 def test_merge_processing_options_1():
     preferred = None
     fallback = None
@@ -58,6 +107,16 @@ def test_merge_processing_options_4():
     expected.max_headers_size = 0
     expected.max_response_body_size = 0
     expected.timeout_millis = 0
+    expected.binary_headers_enabled = False
+    expected.max_header_table_size = 0
+    expected.write_coalescing_threshold = 0
+    expected.body_copy_buffer_size = 0
+    expected.body_copy_pipeline_depth = 0
+    expected.keep_alive_enabled = False
+    expected.keep_alive_idle_timeout_millis = 0
+    expected.max_requests_per_connection = 0
+    expected.idempotent = False
+    expected.max_eager_response_body_size = 0
     assert actual == expected
 
 def test_merge_processing_options_5():
@@ -69,6 +128,16 @@ def test_merge_processing_options_5():
             self.max_headers_size = 10
             self.max_response_body_size = -1
             self.timeout_millis = 0
+            self.binary_headers_enabled = None
+            self.max_header_table_size = -1
+            self.write_coalescing_threshold = None
+            self.body_copy_buffer_size = 16_384
+            self.body_copy_pipeline_depth = None
+            self.keep_alive_enabled = False
+            self.keep_alive_idle_timeout_millis = None
+            self.max_requests_per_connection = -2
+            self.idempotent = None
+            self.max_eager_response_body_size = -1
     class FallbackCls:
         def __init__(self):
             self.extra_connectivity_params = {
@@ -78,6 +147,16 @@ def test_merge_processing_options_5():
             self.max_headers_size = 30
             self.max_response_body_size = 40
             self.timeout_millis = -1
+            self.binary_headers_enabled = True
+            self.max_header_table_size = 4096
+            self.write_coalescing_threshold = -1
+            self.body_copy_buffer_size = 1024
+            self.body_copy_pipeline_depth = 3
+            self.keep_alive_enabled = True
+            self.keep_alive_idle_timeout_millis = -1
+            self.max_requests_per_connection = 100
+            self.idempotent = True
+            self.max_eager_response_body_size = 4096
     actual = quasi_http_utils.merge_processing_options(
         PreferredCls(), FallbackCls())
     expected = SimpleNamespace()
@@ -88,6 +167,16 @@ def test_merge_processing_options_5():
     expected.max_headers_size = 10
     expected.max_response_body_size = -1
     expected.timeout_millis = -1
+    expected.binary_headers_enabled = True
+    expected.max_header_table_size = 4096
+    expected.write_coalescing_threshold = -1
+    expected.body_copy_buffer_size = 16_384
+    expected.body_copy_pipeline_depth = 3
+    expected.keep_alive_enabled = False
+    expected.keep_alive_idle_timeout_millis = -1
+    expected.max_requests_per_connection = 100
+    expected.idempotent = True
+    expected.max_eager_response_body_size = 4096
     assert actual == expected
 
 @pytest.mark.parametrize("preferred, fallback1, default_value, expected",  
@@ -155,6 +244,21 @@ def test_determine_effective_positive_integer_option_for_errors(
         quasi_http_utils._determine_effective_positive_integer_option(
             preferred, fallback1, default_value)
 
+@pytest.mark.parametrize("preferred, fallback1, default_value, expected",  
+    [
+        (None, True, False, True),
+        (False, True, True, False),
+        (None, None, True, True),
+        (None, None, False, False),
+        (1, None, False, True),
+        (None, 0, True, False)
+    ])
+def test_determine_effective_boolean_option(
+        preferred, fallback1, default_value, expected):
+    actual = quasi_http_utils._determine_effective_boolean_option(
+        preferred, fallback1, default_value)
+    assert actual == expected
+
 @pytest.mark.parametrize("preferred, fallback, expected",  
     [
         (
@@ -28,6 +28,27 @@ def test_encode_tag_and_length_for_errors(tag: int, length: int):
     with pytest.raises(Exception):
         tlv_utils.encode_tag_and_length(tag, length)
 
+@pytest.mark.parametrize("stream_id, frame_tag, payload_length, expected",
+    [
+        (1, tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_DATA, 5,
+            bytes([0x62, 0x65, 0x78, 0x74, 0, 0, 0, 13,
+                   0, 0, 0, 1, 0x73, 0x64, 0x61, 0x74])),
+        (0x102, tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_END, 0,
+            bytes([0x62, 0x65, 0x78, 0x74, 0, 0, 0, 8,
+                   0, 0, 1, 2, 0x73, 0x65, 0x6e, 0x64])),
+    ])
+def test_encode_stream_frame_header(stream_id, frame_tag, payload_length,
+                                    expected):
+    actual = tlv_utils.encode_stream_frame_header(stream_id, frame_tag,
+                                                  payload_length)
+    assert actual == expected
+    assert len(actual) == tlv_utils.STREAM_FRAME_HEADER_LENGTH
+
+def test_encode_stream_frame_header_for_errors():
+    with pytest.raises(Exception):
+        tlv_utils.encode_stream_frame_header(0,
+            tlv_utils.TAG_FOR_QUASI_HTTP_STREAM_DATA, 1)
+
 @pytest.mark.parametrize("data, offset, expected",  
     [
         (bytes([0, 0, 0, 1]), 0, 1),
@@ -121,3 +142,22 @@ async def test_body_chunk_codec_streams(expected, tag_to_use):
 
     # assert
     assert actual == expected
+
+def test_stream_factories_reuse_classes():
+    backing_stream = comparison_utils.create_byte_array_input_stream(b"")
+    factories = [
+        lambda: tlv_utils.create_content_length_enforcing_stream(
+            backing_stream, 1),
+        lambda: tlv_utils.create_max_length_enforcing_stream(
+            backing_stream, 1),
+        lambda: tlv_utils.create_tlv_encoding_writable_stream(
+            backing_stream, 1),
+        lambda: tlv_utils.create_tlv_decoding_readable_stream(
+            backing_stream, 1, 2),
+        lambda: io_utils_internal.create_buffered_readable_stream(
+            backing_stream),
+    ]
+    for factory in factories:
+        first, second = factory(), factory()
+        assert type(first) is type(second)
+        assert not hasattr(first, "__dict__")